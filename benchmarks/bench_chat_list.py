@@ -0,0 +1,88 @@
+"""Список чатов: join с участниками против строк InboxEntry
+
+Пользователь состоит в --chats чатах среди --total чатов в базе:
+python benchmarks/bench_chat_list.py [--chats 300] [--total 3000] [--messages 20]
+"""
+import argparse
+
+from common import setup_django, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=300)
+    parser.add_argument('--total', type=int, default=3000)
+    parser.add_argument('--members', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=20, help='Сообщений в каждом чате')
+    parser.add_argument('--page', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.db.models import Max
+    from django.test import RequestFactory
+
+    from messenger import inbox
+    from messenger.fast_serializers import serialize_chats, serialize_inbox
+    from messenger.models import Chat, Message
+    from users.models import CustomUser
+
+    users = CustomUser.objects.bulk_create([
+        CustomUser(phone_number='+7900%07d' % i) for i in range(args.members * 10)
+    ])
+    me = users[0]
+    for i in range(args.total):
+        chat = Chat.objects.create(chat_name='Chat %d' % i, is_group=True)
+        members = [users[(i + j) % len(users)] for j in range(1, args.members)]
+        chat.participants.set(members + [me] if i < args.chats else members)
+        Message.objects.bulk_create([
+            Message(chat=chat, author=members[j % len(members)], content='hi %d' % j) for j in range(args.messages)
+        ])
+        inbox.on_message(Message.objects.filter(chat=chat).last())
+
+    request = RequestFactory().get('/api/v1/chats/')
+    request.user = me
+
+    def join_order():
+        # Прежний запрос: join с участниками и сортировка по активности
+        return Chat.objects.filter(participants=me).annotate(last=Max('messages__created_at')).order_by('-last')
+
+    def join_list():
+        return serialize_chats(join_order(), request)
+
+    def inbox_list():
+        return serialize_inbox(inbox.chat_list(me.id)[0], request)
+
+    assert [chat['id'] for chat in join_list()] == [chat['id'] for chat in inbox_list()]
+    print('chats=%d total=%d members=%d messages=%d' % (args.chats, args.total, args.members, args.messages))
+    print('%-26s %10s %10s' % ('', 'order ms', 'list ms'))
+    print('%-26s %10.2f %10.2f' % (
+        'join + Max(messages)',
+        timeit(lambda: list(join_order().values_list('id', flat=True)), args.repeat),
+        timeit(join_list, args.repeat),
+    ))
+    print('%-26s %10.2f %10.2f' % (
+        'InboxEntry range scan',
+        timeit(lambda: inbox.chat_list(me.id), args.repeat),
+        timeit(inbox_list, args.repeat),
+    ))
+
+    # Страница из середины списка: OFFSET по join против курсора
+    offset = args.chats // 2
+    _, cursor = inbox.chat_list(me.id, limit=offset)
+    print('%-26s %10.2f' % (
+        'page %d, join + OFFSET' % (offset // args.page + 1),
+        timeit(lambda: list(join_order().values_list('id', flat=True)[offset:offset + args.page]), args.repeat),
+    ))
+    print('%-26s %10.2f' % (
+        'page %d, inbox cursor' % (offset // args.page + 1),
+        timeit(lambda: inbox.chat_list(me.id, cursor=cursor, limit=args.page), args.repeat),
+    ))
+
+    chat = Chat.objects.filter(participants=me).first()
+    message = Message.objects.filter(chat=chat).first()
+    print('%-26s %10.2f ms' % ('fan-out on send', timeit(lambda: inbox.on_message(message), args.repeat)))
+
+
+if __name__ == '__main__':
+    main()
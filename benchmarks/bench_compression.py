@@ -0,0 +1,77 @@
+"""Размер таблицы сообщений и время чтения страницы со сжатием и без
+
+Часть сообщений — длинные вставки журналов, остальные короткие:
+python benchmarks/bench_compression.py [--messages 2000] [--long-share 0.1]
+"""
+import argparse
+import random
+
+from common import setup_django, timeit
+
+
+def table_size(connection):
+    """Байт текста в content и страниц БД после VACUUM"""
+    with connection.cursor() as cursor:
+        cursor.execute('VACUUM')
+        cursor.execute('SELECT SUM(LENGTH(CAST(content AS BLOB))) FROM messenger_message')
+        content_bytes = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_count')
+        pages = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_size')
+        page_size = cursor.fetchone()[0]
+    return content_bytes, pages * page_size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--long-share', type=float, default=0.1)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.db import connection
+
+    from messenger.fast_serializers import serialize_messages
+    from messenger.fields import decompress
+    from messenger.models import Chat, Message
+    from users.models import CustomUser
+
+    random.seed(1)
+    user = CustomUser.objects.create(phone_number='+79000000000')
+    chat = Chat.objects.create(chat_name='Benchmark', is_group=True)
+    chat.participants.add(user)
+    log_line = '2024-05-01 12:00:%02d ERROR worker-%d: таймаут запроса к /api/v1/chats/%d/messages/'
+    Message.objects.bulk_create([
+        Message(chat=chat, author=user, content='\n'.join(
+            log_line % (j % 60, j % 7, random.randint(1, 10 ** 6)) for j in range(random.randint(40, 400))
+        ) if random.random() < args.long_share else 'Короткое сообщение %d' % i)
+        for i in range(args.messages)
+    ])
+
+    def read_page():
+        return serialize_messages(chat.messages.order_by('-id')[:50])
+
+    def read_all():
+        return list(Message.objects.values_list('content', flat=True))
+
+    rows = []
+    content_bytes, db_bytes = table_size(connection)
+    rows.append(('compressed', content_bytes, db_bytes, timeit(read_page, args.repeat), timeit(read_all, 3)))
+
+    # Тот же набор без сжатия: распаковываем значения прямо в БД
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT id, content FROM messenger_message')
+        plain = [(decompress(content), message_id) for message_id, content in cursor.fetchall()]
+        cursor.executemany('UPDATE messenger_message SET content = %s WHERE id = %s', plain)
+    content_bytes, db_bytes = table_size(connection)
+    rows.append(('plain', content_bytes, db_bytes, timeit(read_page, args.repeat), timeit(read_all, 3)))
+
+    print('messages=%d long share=%.0f%%' % (args.messages, args.long_share * 100))
+    print('%-12s %14s %12s %14s %14s' % ('storage', 'content KiB', 'db KiB', 'page of 50 ms', 'full scan ms'))
+    for name, content_bytes, db_bytes, page_ms, scan_ms in rows:
+        print('%-12s %14.1f %12.1f %14.2f %14.2f' % (name, content_bytes / 1024, db_bytes / 1024, page_ms, scan_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""Отправка сообщений с групповой фиксацией и без неё
+
+Та же нагрузка, что в bench_sqlite_concurrency.py, на профиле
+settings_production.py: каждый запрос пишет своей транзакцией
+(GROUP_COMMIT выключен) или сообщения пишет поток-писатель пачками:
+python benchmarks/bench_group_commit.py [--threads 16] [--seconds 5]
+"""
+import argparse
+import os
+import tempfile
+
+from bench_sqlite_concurrency import probe
+
+SETTINGS = 'messenger_project.settings_production'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-delay-ms', type=float, default=1)
+    args = parser.parse_args()
+
+    print('threads=%d, seconds=%.0f' % (args.threads, args.seconds))
+    for name, enabled in (('per-request commit', False), ('group commit', True)):
+        overrides = {'GROUP_COMMIT': {'ENABLED': enabled, 'MAX_BATCH': args.max_batch,
+                                      'MAX_DELAY_MS': args.max_delay_ms}}
+        with tempfile.TemporaryDirectory() as directory:
+            result = probe(SETTINGS, os.path.join(directory, 'bench.sqlite3'), args.threads, args.seconds, overrides)
+        writer = result['writer']
+        print('%-20s %7.1f msg/s  database is locked: %4d  p50 %6.1f ms  p99 %7.1f ms  average batch %5.1f' % (
+            name, result['sent'] / args.seconds, result['locked'], result['p50'] * 1000, result['p99'] * 1000,
+            writer['average_batch']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Диспетчер запланированных сообщений на большой таблице расписаний
+
+--pending расписаний на ближайшие сутки, из них --due уже наступили.
+Сравнивает ежесекундный опрос таблицы (SELECT наступивших) с проходом
+диспетчера, когда ничего не наступило, и показывает время первой загрузки
+окна и отправки наступивших пачками:
+python benchmarks/bench_scheduled_dispatch.py [--pending 200000] [--due 2000]
+"""
+import argparse
+import random
+import time
+from datetime import timedelta
+
+from common import seed_chat, setup_django, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pending', type=int, default=200000)
+    parser.add_argument('--due', type=int, default=2000)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.utils import timezone
+
+    from messenger import scheduled
+    from messenger.models import Message, ScheduledMessage
+
+    chat, users = seed_chat(members=20, messages=0)
+    now = timezone.now()
+    rows = [
+        ScheduledMessage(chat=chat, author=users[i % len(users)], content='Запланировано %d' % i,
+                         send_at=now + timedelta(seconds=random.randint(60, 86400)))
+        for i in range(args.pending - args.due)
+    ]
+    rows += [
+        ScheduledMessage(chat=chat, author=users[i % len(users)], content='Наступило %d' % i,
+                         send_at=now - timedelta(seconds=random.randint(0, 60)))
+        for i in range(args.due)
+    ]
+    ScheduledMessage.objects.bulk_create(rows, batch_size=5000)
+    print('pending=%d due=%d' % (args.pending, args.due))
+
+    # Ожидающих не отправляем: только выборка, которую делал бы опрос
+    poll = timeit(lambda: list(scheduled.pending().filter(send_at__lte=timezone.now())
+                               .values_list('id', flat=True)[:scheduled.get_config()['BATCH_SIZE']]))
+    print('%-34s %8.2f ms' % ('poll query (every second)', poll))
+
+    dispatcher = scheduled.Dispatcher()
+    started = time.perf_counter()
+    dispatcher.tick()
+    first = (time.perf_counter() - started) * 1000
+    stats = dispatcher.stats()
+    print('%-34s %8.1f ms  sent %d, in heap %d, messages %d' % (
+        'first tick (load window + send)', first, stats['sent'], stats['queued'], Message.objects.count()))
+    idle = timeit(dispatcher.tick)
+    print('%-34s %8.2f ms' % ('tick, nothing due', idle))
+
+    def refresh_tick():
+        dispatcher._refresh_at = None
+        dispatcher.tick()
+
+    refresh = timeit(refresh_tick)
+    print('%-34s %8.2f ms  (every REFRESH_SECONDS)' % ('tick with refresh', refresh))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Сравнение MessageSerializer/JSONRenderer с values()-сериализацией
+и нормализованным форматом с общим словарём users
+
+python benchmarks/bench_serialization.py [--messages 200] [--members 20]
+"""
+import argparse
+
+from common import seed_chat, setup_django, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--members', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.test import RequestFactory
+    from rest_framework.renderers import JSONRenderer
+
+    from messenger.fast_serializers import serialize_messages, serialize_messages_normalized
+    from messenger.serializers import MessageSerializer
+    from messenger_project.renderers import FastJSONRenderer
+
+    chat, users = seed_chat(members=args.members, messages=args.messages)
+    request = RequestFactory().get('/api/v1/chats/%d/' % chat.id)
+    request.user = users[0]
+    messages = chat.messages.order_by('created_at')
+
+    def model_serializer():
+        data = MessageSerializer(messages, many=True, context={'request': request}).data
+        return JSONRenderer().render(data)
+
+    def fast_path():
+        return FastJSONRenderer().render(serialize_messages(messages, request))
+
+    def normalized():
+        messages_data, users = serialize_messages_normalized(messages, request)
+        return FastJSONRenderer().render({'messages': messages_data, 'users': users})
+
+    assert model_serializer() == fast_path(), 'Ответы различаются'
+
+    slow = timeit(model_serializer, args.repeat)
+    fast = timeit(fast_path, args.repeat)
+    side_loaded = timeit(normalized, args.repeat)
+    print('messages=%d members=%d' % (args.messages, args.members))
+    print('ModelSerializer + JSONRenderer: %8.2f ms %8d bytes' % (slow, len(model_serializer())))
+    print('values_list + FastJSONRenderer: %8.2f ms %8d bytes' % (fast, len(fast_path())))
+    print('normalized users map:           %8.2f ms %8d bytes' % (side_loaded, len(normalized())))
+    print('speedup: %.1fx' % (slow / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Всплеск чтений одного чата со склейкой одинаковых запросов и без неё
+
+--threads участников одновременно запрашивают GET /api/v1/chats/<pk>/,
+как после сообщения в большой группе; показывает время всплеска, число
+вычислений ответа и долю склеенных запросов:
+python benchmarks/bench_single_flight.py [--threads 32] [--messages 200] [--rounds 20]
+"""
+import argparse
+import threading
+import time
+
+from common import seed_chat, setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.urls import reverse
+    from rest_framework.test import APIClient
+
+    from messenger.views import chat_detail_flight
+
+    settings.ALLOWED_HOSTS = ['*']
+    chat, users = seed_chat(members=args.threads, messages=args.messages)
+    url = reverse('chat-detail-update', kwargs={'pk': chat.pk})
+    clients = []
+    for user in users:
+        client = APIClient()
+        client.force_authenticate(user=user)
+        clients.append(client)
+
+    def burst():
+        barrier = threading.Barrier(len(clients))
+
+        def read(client):
+            barrier.wait()
+            assert client.get(url).status_code == 200
+
+        threads = [threading.Thread(target=read, args=(client,)) for client in clients]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    print('threads=%d messages=%d rounds=%d' % (args.threads, args.messages, args.rounds))
+    for name, enabled in (('every request computes', False), ('single-flight', True)):
+        settings.SINGLE_FLIGHT = {**settings.SINGLE_FLIGHT, 'ENABLED': enabled}
+        chat_detail_flight.reset_stats()
+        best = min(burst() for _ in range(args.rounds))
+        stats = chat_detail_flight.stats()
+        computed = stats['leaders'] / args.rounds if enabled else args.threads
+        print('%-24s burst %7.1f ms  computations per burst %5.1f  shared %5.1f%%' % (
+            name, best * 1000, computed, stats['shared_ratio'] * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Пропускная способность записи в SQLite при одновременной отправке
+
+Несколько потоков отправляют сообщения через services.send_message (та
+же транзакция, что у POST /api/v1/messages/) в файловую базу: с
+настройками settings.py (журнал DELETE, BEGIN DEFERRED) и с
+settings_production.py (WAL, pragma, BEGIN IMMEDIATE). Каждый профиль —
+отдельный процесс и новая база:
+python benchmarks/bench_sqlite_concurrency.py [--threads 8] [--seconds 5]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from common import ROOT
+
+PROBE = r'''
+import json, os, sys, threading, time
+sys.path.insert(0, %(root)r)
+os.environ['DJANGO_SETTINGS_MODULE'] = %(settings)r
+from django.conf import settings
+settings.DATABASES['default']['NAME'] = %(path)r
+for name, value in json.loads(%(overrides)r).items():
+    setattr(settings, name, value)
+import django
+django.setup()
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from messenger.models import Chat
+from messenger.services import send_message
+from users.models import CustomUser
+
+call_command('migrate', verbosity=0)
+users = [CustomUser.objects.create(phone_number='+7900%%07d' %% i) for i in range(%(threads)d)]
+chat = Chat.objects.create(chat_name='Benchmark', is_group=True)
+chat.participants.set(users)
+connection.close()
+
+sent, locked, latencies = [0], [0], []
+lock = threading.Lock()
+deadline = time.perf_counter() + %(seconds)f
+
+def worker(user):
+    own_sent, own_locked, own_latencies = 0, 0, []
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            send_message(chat, user, 'Сообщение под нагрузкой')
+            own_sent += 1
+            own_latencies.append(time.perf_counter() - started)
+        except OperationalError:
+            own_locked += 1
+    connection.close()
+    with lock:
+        sent[0] += own_sent
+        locked[0] += own_locked
+        latencies.extend(own_latencies)
+
+threads = [threading.Thread(target=worker, args=(user,)) for user in users]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+latencies.sort()
+from messenger.services import writer_stats
+print(json.dumps({'sent': sent[0], 'locked': locked[0], 'writer': writer_stats(),
+                  'p50': latencies[len(latencies) // 2] if latencies else 0,
+                  'p99': latencies[int(len(latencies) * 0.99)] if latencies else 0}))
+'''
+
+PROFILES = (
+    ('settings.py', 'messenger_project.settings'),
+    ('settings_production.py', 'messenger_project.settings_production'),
+)
+
+
+def probe(settings_module, path, threads, seconds, overrides=None):
+    """Запускает отправку в отдельном процессе; overrides — значения настроек поверх модуля"""
+    code = PROBE % {'root': ROOT, 'settings': settings_module, 'path': path, 'threads': threads, 'seconds': seconds,
+                    'overrides': json.dumps(overrides or {})}
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True, cwd=ROOT)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print('threads=%d, seconds=%.0f' % (args.threads, args.seconds))
+    for name, settings_module in PROFILES:
+        with tempfile.TemporaryDirectory() as directory:
+            result = probe(settings_module, os.path.join(directory, 'bench.sqlite3'), args.threads, args.seconds)
+        print('%-24s %7.1f msg/s  database is locked: %5d  p50 %6.1f ms  p99 %7.1f ms' % (
+            name, result['sent'] / args.seconds, result['locked'], result['p50'] * 1000, result['p99'] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Время старта воркера и первого запроса к схеме OpenAPI
+
+Каждый замер — новый процесс Python, как при запуске воркера: импорт
+Django и urls.py, затем первый запрос к /swagger/docs/ со схемой из
+файла сборки и без неё (генерация при запросе, как у SpectacularAPIView),
+и первый запрос к API. Заодно показывает, какие модули drf-spectacular и
+yaml загружены после старта:
+python benchmarks/bench_startup.py [--repeat 5]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from common import ROOT
+
+PROBE = r'''
+import json, os, sys, time
+sys.path.insert(0, %(root)r)
+os.environ['DJANGO_SETTINGS_MODULE'] = 'messenger_project.settings'
+started = time.perf_counter()
+import django
+django.setup()
+from django.conf import settings
+settings.OPENAPI_SCHEMA_DIR = %(schema_dir)r
+settings.ALLOWED_HOSTS = ['*']
+from django.urls import get_resolver
+get_resolver().url_patterns
+booted = time.perf_counter()
+docs_loaded = sorted(name for name in sys.modules if name.split('.')[0] in ('drf_spectacular', 'drf_yasg', 'yaml'))
+from django.test import Client
+client = Client()
+response = client.get('/swagger/docs/')
+assert response.status_code == 200, response.status_code
+schema = time.perf_counter()
+client.get('/api/v1/chats/')
+api = time.perf_counter()
+print(json.dumps({'boot': booted - started, 'schema': schema - booted, 'api': api - schema,
+                  'docs_loaded': docs_loaded}))
+'''
+
+
+def probe(schema_dir):
+    code = PROBE % {'root': ROOT, 'schema_dir': schema_dir}
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True, cwd=ROOT)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as built, tempfile.TemporaryDirectory() as empty:
+        subprocess.run([sys.executable, 'manage.py', 'build_openapi_schema', '--dir', built],
+                       check=True, capture_output=True, cwd=ROOT)
+        print('repeat=%d, лучшее время в мс' % args.repeat)
+        for name, schema_dir in (('prebuilt schema', built), ('generated on request', empty)):
+            runs = [probe(schema_dir) for _ in range(args.repeat)]
+            loaded = runs[0]['docs_loaded']
+            print('%-22s boot %7.1f  first schema request %7.1f  first API request %6.1f' % (
+                name,
+                min(run['boot'] for run in runs) * 1000,
+                min(run['schema'] for run in runs) * 1000,
+                min(run['api'] for run in runs) * 1000,
+            ))
+            # @extend_schema обращается к AutoSchema, поэтому drf_spectacular.openapi
+            # и yaml загружены при старте; страницы и генератор схемы — нет
+            print('%-22s loaded at boot: %d modules (%s); views/generators: %s' % (
+                '', len(loaded),
+                ', '.join(sorted({module.split('.')[0] for module in loaded})) or '-',
+                ', '.join(module for module in loaded
+                          if module in ('drf_spectacular.views', 'drf_spectacular.generators')) or 'not loaded',
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Накладные расходы ограничителя частоты на один запрос
+
+Сравнивает ScopedSlidingWindowThrottle с хранилищем в памяти и в кеше
+Django со ScopedRateThrottle из DRF (список отметок времени в кеше):
+python benchmarks/bench_throttling.py [--users 1000] [--calls 100000]
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+
+from common import setup_django
+
+
+def per_call_us(func, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        func(i)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--calls', type=int, default=100000)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.core.cache import cache
+    from django.test import override_settings
+    from rest_framework.test import APIRequestFactory
+    from rest_framework.throttling import ScopedRateThrottle
+    from rest_framework.views import APIView
+
+    from messenger_project.throttling import MemoryStore, ScopedSlidingWindowThrottle
+    from users.models import CustomUser
+
+    class View(APIView):
+        throttle_scope = 'message_send'
+
+    # Лимит недостижим: меряем путь пропуска запроса
+    throttle_rates = {'message_send': '1000000/min'}
+    rates = {'REST_FRAMEWORK': {'DEFAULT_THROTTLE_RATES': throttle_rates}}
+
+    class DRFThrottle(ScopedRateThrottle):
+        # ScopedRateThrottle читает лимиты при импорте, а не из override_settings
+        THROTTLE_RATES = throttle_rates
+    users = [CustomUser(pk=i, phone_number=str(i)) for i in range(args.users)]
+    factory = APIRequestFactory()
+    requests = []
+    for user in users:
+        request = View().initialize_request(factory.post('/api/v1/messages/'))
+        request.user = user
+        requests.append(request)
+    view = View()
+
+    print('users=%d calls=%d' % (args.users, args.calls))
+    with override_settings(**rates):
+        for name, store_settings, throttle_class in (
+            ('sliding window, memory', {'STORE': 'memory'}, ScopedSlidingWindowThrottle),
+            ('sliding window, cache', {'STORE': 'cache'}, ScopedSlidingWindowThrottle),
+            ('DRF ScopedRateThrottle', {}, DRFThrottle),
+        ):
+            cache.clear()
+            with override_settings(THROTTLING=store_settings):
+                # Каждый запрос получает свой экземпляр, как в APIView.get_throttles
+                cost = per_call_us(
+                    lambda i: throttle_class().allow_request(requests[i % args.users], view), args.calls)
+            print('%-26s %8.2f us/request' % (name, cost))
+
+    # Память хранилища при MAX_KEYS ключей
+    tracemalloc.start()
+    store = MemoryStore(max_keys=args.users)
+    for i in range(args.users * 2):
+        store.hit('message_send:%d' % i, 30, 60, time.time())
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('memory store: %d keys, %.1f KiB (%.0f bytes/key)' % (
+        len(store.counters), size / 1024, size / len(store.counters)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+"""Сравнение JSONRenderer, FastJSONRenderer и MessagePackRenderer
+
+Кодирование страницы чата (формат ChatDetailSerializer) и размер ответа:
+python benchmarks/bench_wire_format.py [--messages 200] [--members 20]
+"""
+import argparse
+import gzip
+
+from common import seed_chat, setup_django, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--members', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.test import RequestFactory
+    from rest_framework.renderers import JSONRenderer
+
+    from messenger.serializers import ChatDetailSerializer
+    from messenger_project.msgpack_codec import unpackb
+    from messenger_project.renderers import FastJSONRenderer, MessagePackRenderer
+
+    chat, users = seed_chat(members=args.members, messages=args.messages)
+    request = RequestFactory().get('/api/v1/chats/%d/' % chat.id)
+    request.user = users[0]
+    data = ChatDetailSerializer(chat, context={'request': request}).data
+
+    json_body = FastJSONRenderer().render(data)
+    msgpack_body = MessagePackRenderer().render(data)
+    assert unpackb(msgpack_body) == __import__('json').loads(json_body), 'Структуры ответов различаются'
+
+    print('messages=%d members=%d' % (args.messages, args.members))
+    print('%-22s %10s %10s %10s' % ('renderer', 'encode ms', 'bytes', 'gzip bytes'))
+    for name, renderer in (
+        ('JSONRenderer', JSONRenderer()),
+        ('FastJSONRenderer', FastJSONRenderer()),
+        ('MessagePackRenderer', MessagePackRenderer()),
+    ):
+        body = renderer.render(data)
+        elapsed = timeit(lambda: renderer.render(data), args.repeat)
+        print('%-22s %10.2f %10d %10d' % (name, elapsed, len(body), len(gzip.compress(body))))
+
+
+if __name__ == '__main__':
+    main()
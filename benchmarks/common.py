@@ -0,0 +1,57 @@
+"""Общая подготовка для бенчмарков: Django поверх временной тестовой БД
+
+Запуск из корня проекта: python benchmarks/<скрипт>.py
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django():
+    """Настраивает Django и создаёт чистую тестовую БД в памяти"""
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'messenger_project.settings')
+    import django
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+
+def seed_chat(members=20, messages=200, likes_per_message=3):
+    """Групповой чат с участниками, сообщениями и лайками"""
+    from messenger.models import Chat, Message
+    from users.models import CustomUser
+
+    users = CustomUser.objects.bulk_create([
+        CustomUser(phone_number='+7900%07d' % i, first_name='User %d' % i if i % 3 else '')
+        for i in range(members)
+    ])
+    chat = Chat.objects.create(chat_name='Benchmark', is_group=True)
+    chat.participants.set(users)
+    created = Message.objects.bulk_create([
+        Message(chat=chat, author=users[i % members], content='Сообщение номер %d ' % i * 3)
+        for i in range(messages)
+    ])
+    through = Message.likes.through
+    through.objects.bulk_create([
+        through(message_id=message.id, customuser_id=users[(i + j) % members].id)
+        for i, message in enumerate(created)
+        for j in range(likes_per_message)
+    ])
+    return chat, users
+
+
+def timeit(func, repeat=20):
+    """Лучшее время из repeat запусков, в миллисекундах"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
@@ -1,13 +1,156 @@
-from django.contrib import admin
-from .models import Chat, Message
+from django.contrib import admin, messages
+from django.db.models import Q
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils import timezone
+from django.utils.html import format_html
+from users.models import CustomUser
+from . import purge
+from .admin_scaling import LargeTableAdmin, prefix_q
+from .models import Attachment, Chat, Message, PurgeJob, RequestProfile, ScheduledMessage, Task, UploadSession
 
 @admin.register(Chat)
-class ChatAdmin(admin.ModelAdmin):
-    list_display = ('id', 'created_at')
-    filter_horizontal = ('participants',)
+class ChatAdmin(LargeTableAdmin):
+    list_display = ('id', 'chat_name', 'is_group', 'member_count', 'last_activity_at', 'created_at')
+    # Участников выбираем поиском, а не списком всех пользователей
+    autocomplete_fields = ('participants',)
+    readonly_fields = ('member_count',)
+    search_fields = ('chat_name',)
+    search_help_text = 'ID чата или начало названия (с учётом регистра)'
+    actions = ['purge_selected']
+
+    def has_delete_permission(self, request, obj=None):
+        # Каскадное удаление загрузило бы в память все сообщения чата;
+        # чаты удаляются действием purge_selected
+        return False
+
+    def has_purge_permission(self, request):
+        return request.user.has_perm('messenger.delete_chat')
+
+    @admin.action(description='Удалить пачками в фоне', permissions=['purge'])
+    def purge_selected(self, request, queryset):
+        for chat_id in queryset.values_list('pk', flat=True):
+            purge.schedule(PurgeJob.KIND_CHAT, chat_id)
+        self.message_user(request, 'Чаты поставлены в очередь на удаление', messages.SUCCESS)
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        query = prefix_q('chat_name', term)
+        if term.isdigit():
+            query |= Q(pk=int(term))
+        return queryset.filter(query), False
+
+class AttachmentInline(admin.TabularInline):
+    model = Attachment
+    extra = 0
+    readonly_fields = ('file', 'filename', 'content_type', 'size', 'sha256', 'created_at')
 
 @admin.register(Message)
-class MessageAdmin(admin.ModelAdmin):
+class MessageAdmin(LargeTableAdmin):
     list_display = ('id', 'author', 'chat', 'created_at')
     list_filter = ('created_at',)
-    search_fields = ('content', 'author__phone_number')
+    list_select_related = ('author', 'chat')
+    autocomplete_fields = ('author', 'chat', 'likes')
+    search_fields = ('author__phone_number',)
+    search_help_text = 'ID сообщения, ID чата или номер автора'
+    inlines = [AttachmentInline]
+
+    def get_search_results(self, request, queryset, search_term):
+        # Только точные условия по индексам: icontains по тексту — полный
+        # проход таблицы, а сжатые сообщения он и не найдёт
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        query = Q(author__in=CustomUser.objects.filter(phone_number=term).values('pk'))
+        if term.isdigit():
+            query |= Q(pk=int(term)) | Q(chat_id=int(term))
+        return queryset.filter(query), False
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'view_name', 'method', 'path', 'status_code', 'duration_ms', 'mode', 'user',
+                    'flamegraph_link')
+    list_filter = ('mode', 'view_name')
+    search_fields = ('=request_id', 'path')
+    list_select_related = ('user',)
+    readonly_fields = [field.name for field in RequestProfile._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_urls(self):
+        urls = [
+            path(
+                '<int:pk>/collapsed/',
+                self.admin_site.admin_view(self.collapsed_view),
+                name='messenger_requestprofile_collapsed',
+            ),
+        ]
+        return urls + super().get_urls()
+
+    def collapsed_view(self, request, pk):
+        """Отдаёт свёрнутые стеки файлом для flamegraph.pl или speedscope"""
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        response = HttpResponse(profile.collapsed_stacks or profile.stats, content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="%s.%s.txt"' % (profile.request_id, profile.mode)
+        return response
+
+    @admin.display(description='Стеки')
+    def flamegraph_link(self, obj):
+        url = reverse('admin:messenger_requestprofile_collapsed', args=[obj.pk])
+        return format_html('<a href="{}">скачать</a>', url)
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'status', 'priority', 'attempts', 'run_at', 'duration_ms', 'finished_at')
+    list_filter = ('status', 'name')
+    readonly_fields = ('attempts', 'locked_by', 'locked_at', 'last_error', 'duration_ms', 'created_at',
+                       'finished_at')
+    actions = ['retry']
+
+    @admin.action(description='Перезапустить выбранные задачи')
+    def retry(self, request, queryset):
+        queryset.exclude(status=Task.STATUS_RUNNING).update(
+            status=Task.STATUS_PENDING, attempts=0, run_at=timezone.now(), last_error='',
+        )
+
+
+@admin.register(UploadSession)
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'filename', 'size', 'received', 'status', 'updated_at')
+    list_filter = ('status',)
+    list_select_related = ('user',)
+    readonly_fields = ('received', 'attachment', 'created_at', 'updated_at')
+
+
+@admin.register(PurgeJob)
+class PurgeJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'target_id', 'status', 'stage', 'deleted', 'updated_at', 'finished_at')
+    list_filter = ('status', 'kind')
+    readonly_fields = [field.name for field in PurgeJob._meta.fields]
+    actions = ['resume']
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description='Продолжить в фоне')
+    def resume(self, request, queryset):
+        for job in queryset.exclude(status=PurgeJob.STATUS_DONE):
+            purge.schedule(job.kind, job.target_id)
+
+
+@admin.register(ScheduledMessage)
+class ScheduledMessageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'author', 'chat', 'send_at', 'status', 'attempts', 'sent_at')
+    list_filter = ('status',)
+    list_select_related = ('author', 'chat')
+    autocomplete_fields = ('author', 'chat')
+    readonly_fields = ('message_id', 'attempts', 'last_error', 'created_at', 'sent_at')
+    actions = ['cancel']
+
+    @admin.action(description='Отменить выбранные')
+    def cancel(self, request, queryset):
+        queryset.filter(status=ScheduledMessage.STATUS_PENDING).update(status=ScheduledMessage.STATUS_CANCELLED)
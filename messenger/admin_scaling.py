@@ -0,0 +1,122 @@
+"""Админка для больших таблиц
+
+LargeTableAdmin — ModelAdmin, страницы которого не зависят от размера
+таблицы:
+
+- число строк без фильтров берётся из статистики БД (PostgreSQL, MySQL)
+  или по наибольшему id, а отфильтрованные строки считаются не дальше
+  EstimatedCountPaginator.exact_count_limit;
+- вместо далёких страниц по OFFSET — ссылка «Более старые записи» с
+  ?before=<id>, это диапазон по первичному ключу;
+- поиск переопределяется в наследниках точными и префиксными условиями
+  по индексированным полям (prefix_q) вместо icontains по всей таблице.
+"""
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, PAGE_VAR, ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Max, Q
+from django.utils.functional import cached_property
+
+KEYSET_VAR = 'before'
+INTEGER_PK_TYPES = ('AutoField', 'BigAutoField', 'SmallAutoField')
+# Больше любого символа, который может продолжать префикс
+PREFIX_END = '\U0010ffff'
+
+
+def estimated_count(queryset):
+    """Примерное число строк таблицы queryset без полного прохода; None, если оценить нечем"""
+    model = queryset.model
+    connection = connections[queryset.db]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+            row = cursor.fetchone()
+            # -1 — таблицу ещё не анализировали
+            if row and row[0] >= 0:
+                return row[0]
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+                [table],
+            )
+            row = cursor.fetchone()
+            if row and row[0] is not None:
+                return row[0]
+    # SQLite: наибольший id берётся из индекса первичного ключа, удалённые
+    # строки дают оценку сверху
+    if model._meta.pk.get_internal_type() in INTEGER_PK_TYPES:
+        return model._default_manager.using(queryset.db).aggregate(last=Max('pk'))['last'] or 0
+    return None
+
+
+def prefix_q(field, term):
+    """Условие «field начинается с term» диапазоном, который использует индекс
+
+    В отличие от startswith/LIKE, индекс работает и в SQLite; сравнение
+    чувствительно к регистру.
+    """
+    return Q(**{field + '__gte': term, field + '__lt': term + PREFIX_END})
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator без точного COUNT(*) по всей таблице"""
+    exact_count_limit = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_count(queryset)
+            if estimate is not None and estimate > self.exact_count_limit:
+                return estimate
+        # Отфильтрованное считаем не дальше лимита: дальше листают ссылкой before
+        return queryset.order_by()[:self.exact_count_limit + 1].count()
+
+
+class KeysetChangeList(ChangeList):
+    """Список объектов, который листается к более старым по ?before=<pk>"""
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(KEYSET_VAR, None)
+        return lookup_params
+
+    def get_queryset(self, request, *args, **kwargs):
+        queryset = super().get_queryset(request, *args, **kwargs)
+        # Только в порядке по убыванию pk, иначе before не задаёт страницу
+        ordering = queryset.query.order_by
+        self.keyset_enabled = (
+            ORDER_VAR not in self.params and bool(ordering)
+            and ordering[0] in ('-pk', '-' + self.lookup_opts.pk.name)
+        )
+        before = self.params.get(KEYSET_VAR)
+        if before and self.keyset_enabled:
+            try:
+                queryset = queryset.filter(pk__lt=int(before))
+            except ValueError:
+                raise IncorrectLookupParameters('before должен быть числом') from None
+        return queryset
+
+    def get_results(self, request):
+        super().get_results(request)
+        self.older_url = None
+        if not self.keyset_enabled or self.show_all:
+            return
+        page = list(self.result_list)
+        if len(page) == self.list_per_page:
+            self.older_url = self.get_query_string({KEYSET_VAR: page[-1].pk}, [PAGE_VAR])
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """ModelAdmin для таблиц на десятки миллионов строк"""
+    paginator = EstimatedCountPaginator
+    # Без второго COUNT(*) по всей таблице для «N из M»
+    show_full_result_count = False
+    ordering = ('-pk',)
+    change_list_template = 'admin/keyset_change_list.html'
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.utils.module_loading import autodiscover_modules
 
 
 class MessengerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'messenger'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        # Регистрирует фоновые задачи из <app>/tasks.py
+        autodiscover_modules('tasks')
@@ -0,0 +1,154 @@
+"""Журнал изменений для дельта-синхронизации (GET /api/v1/sync/)
+
+Каждое изменение, которое должен увидеть клиент, записывается в
+ChangeLogEntry в той же транзакции, что и само изменение, поэтому запись
+в журнале есть тогда и только тогда, когда изменение зафиксировано.
+Клиент хранит последний полученный seq и запрашивает всё, что новее.
+Старые записи удаляет compact(); клиенту, отставшему дальше отметки
+очистки, отвечаем, что нужна полная пересинхронизация.
+"""
+from django.db import transaction
+from django.db.models import Max
+
+from messenger_project.renderers import format_datetime
+from .fast_serializers import attachment_mapper
+from .models import Chat, ChangeLogCompaction, ChangeLogEntry
+
+DELETE_BATCH_SIZE = 5000
+
+
+class ResyncRequired(Exception):
+    """Запрошенные изменения уже удалены из журнала"""
+
+    def __init__(self, seq):
+        super().__init__(seq)
+        self.seq = seq
+
+
+def record(kind, chat_id=None, user_id=None, **payload):
+    """Записывает изменение; вызывать внутри транзакции самого изменения
+
+    user_id — кто совершил изменение (автор, лайкнувший, вступивший) или
+    чей профиль изменился.
+    """
+    return ChangeLogEntry.objects.create(kind=kind, chat_id=chat_id, user_id=user_id, payload=payload)
+
+
+def record_many(entries):
+    """Пакетная запись: entries — несохранённые ChangeLogEntry"""
+    return ChangeLogEntry.objects.bulk_create(entries)
+
+
+def message_entry(message, attachments=()):
+    """Несохранённая запись о новом сообщении"""
+    payload = {
+        'message_id': message.id,
+        'content': message.content,
+        'created_at': format_datetime(message.created_at),
+    }
+    if message.client_message_id:
+        # Другие устройства отправителя сопоставят его со своим черновиком
+        payload['client_message_id'] = message.client_message_id
+    if attachments:
+        attachment_data = attachment_mapper()
+        payload['attachments'] = [
+            attachment_data((item.id, item.file.name, item.filename, item.content_type, item.size))
+            for item in attachments
+        ]
+    return ChangeLogEntry(
+        kind=ChangeLogEntry.KIND_MESSAGE,
+        chat_id=message.chat_id,
+        user_id=message.author_id,
+        payload=payload,
+    )
+
+
+def record_message(message, attachments=()):
+    return message_entry(message, attachments).save()
+
+
+def record_deleted(messages):
+    """Записывает удаление сообщений: messages — [(id, chat_id), ...]
+
+    По записи на чат: клиент удаляет у себя сообщения message_ids.
+    """
+    by_chat = {}
+    for message_id, chat_id in messages:
+        by_chat.setdefault(chat_id, []).append(message_id)
+    return record_many([
+        ChangeLogEntry(kind=ChangeLogEntry.KIND_MESSAGES_DELETED, chat_id=chat_id, payload={'message_ids': ids})
+        for chat_id, ids in by_chat.items()
+    ])
+
+
+def serialize_entry(entry):
+    return {
+        'seq': entry.seq,
+        'kind': entry.kind,
+        'chat_id': entry.chat_id,
+        'user_id': entry.user_id,
+        'payload': entry.payload,
+        'created_at': entry.created_at,
+    }
+
+
+def latest_seq():
+    return ChangeLogEntry.objects.aggregate(seq=Max('seq'))['seq'] or 0
+
+
+def compacted_through():
+    """seq, до которого включительно журнал уже очищен"""
+    return ChangeLogCompaction.objects.aggregate(seq=Max('compacted_through'))['seq'] or 0
+
+
+def changes_since(user, since, limit):
+    """Изменения в чатах пользователя и профилях его собеседников после since
+
+    Возвращает (записи, has_more, seq): seq — курсор для следующего
+    запроса. Если since старше отметки очистки, бросает ResyncRequired.
+    """
+    if since < compacted_through():
+        raise ResyncRequired(latest_seq())
+
+    # Конец журнала читается до выборок, и выборки им ограничены: запись,
+    # зафиксированная между ними, не окажется позади курсора непрочитанной
+    bound = latest_seq()
+    chat_ids = Chat.participants.through.objects.filter(customuser_id=user.id).values('chat_id')
+    member_ids = Chat.participants.through.objects.filter(chat_id__in=chat_ids).values('customuser_id')
+
+    # Два диапазонных запроса по индексам (chat, seq) и (user, seq) вместо OR
+    chat_changes = list(
+        ChangeLogEntry.objects.filter(chat_id__in=chat_ids, seq__gt=since, seq__lte=bound).order_by('seq')[:limit + 1]
+    )
+    profile_changes = list(
+        ChangeLogEntry.objects.filter(
+            kind=ChangeLogEntry.KIND_PROFILE, chat__isnull=True, user_id__in=member_ids,
+            seq__gt=since, seq__lte=bound,
+        ).order_by('seq')[:limit + 1]
+    )
+    changes = sorted(chat_changes + profile_changes, key=lambda entry: entry.seq)
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    # Новых изменений для пользователя нет: курсор сдвигается к концу прочитанного
+    return changes, has_more, changes[-1].seq if changes else max(since, bound)
+
+
+def compact(before, batch_size=DELETE_BATCH_SIZE):
+    """Удаляет записи старше before пачками по seq; возвращает число удалённых"""
+    boundary = ChangeLogEntry.objects.filter(created_at__lt=before).aggregate(seq=Max('seq'))['seq']
+    if boundary is None or boundary <= compacted_through():
+        return 0
+
+    # Сначала отметка, потом удаление: клиент, читающий журнал в процессе
+    # очистки, уже получит сигнал пересинхронизации, а не дырявую дельту
+    ChangeLogCompaction.objects.create(compacted_through=boundary)
+
+    deleted = 0
+    low = ChangeLogEntry.objects.order_by('seq').values_list('seq', flat=True).first() or boundary
+    while low <= boundary:
+        high = min(low + batch_size - 1, boundary)
+        with transaction.atomic():
+            count, _ = ChangeLogEntry.objects.filter(seq__gte=low, seq__lte=high).delete()
+        deleted += count
+        low = high + 1
+    return deleted
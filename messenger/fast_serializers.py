@@ -0,0 +1,237 @@
+"""Быстрая read-only сериализация сообщений и чатов через values_list
+
+Выдаёт те же структуры, что MessageSerializer и ChatListSerializer, но
+без ModelSerializer на каждый объект: строки берутся кортежами, авторы,
+лайки и собеседники загружаются одним запросом на всю страницу. Даты
+остаются datetime и кодируются FastJSONRenderer.
+
+Список чатов пользователя собирается из строк InboxEntry
+(messenger/inbox.py) функцией serialize_inbox.
+
+Нормализованный формат (?normalized=true) вместо вложенного автора и
+имён лайкнувших отдаёт author_id и liked_by со списком id, а каждый
+упомянутый пользователь один раз попадает в общий словарь users.
+
+Вложения сообщений страницы загружаются одним запросом attachments_for.
+
+Лайки и вложения читаются из той же базы, что и сообщения queryset
+(шарда, см. messenger/sharding.py); имена лайкнувших в шарде берутся
+отдельным запросом к пользователям, а не JOIN.
+"""
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Min, OuterRef, Subquery
+from django.utils.timesince import timesince
+
+from users.fast_serializers import avatar_url_getter, chunked, users_by_id
+from users.models import CustomUser
+from . import sharding
+from .models import Attachment, Chat, Message
+
+MESSAGE_FIELDS = ('id', 'chat_id', 'author_id', 'content', 'created_at')
+NORMALIZED_PARAM = 'normalized'
+ATTACHMENT_FIELDS = ('id', 'file', 'filename', 'content_type', 'size')
+
+
+def wants_normalized(request):
+    """Запросил ли клиент нормализованный формат с общим словарём users"""
+    if request is None:
+        return False
+    value = request.GET.get(NORMALIZED_PARAM, '')
+    return value.lower() in ['true', '1', 'yes']
+
+
+def request_user_id(request):
+    user = getattr(request, 'user', None)
+    return user.id if user is not None and user.is_authenticated else None
+
+
+def likes_for(message_ids, using=DEFAULT_DB_ALIAS):
+    """{id сообщения: [(id пользователя, подпись), ...]} в порядке likes.all()"""
+    if using != DEFAULT_DB_ALIAS:
+        liker_ids = liker_ids_for(message_ids, using)
+        names = {}
+        for chunk in chunked({user_id for ids in liker_ids.values() for user_id in ids}):
+            for user_id, first_name, phone_number in CustomUser.objects.filter(id__in=chunk).values_list(
+                    'id', 'first_name', 'phone_number'):
+                names[user_id] = first_name or phone_number
+        return {
+            message_id: [(user_id, names[user_id]) for user_id in ids if user_id in names]
+            for message_id, ids in liker_ids.items()
+        }
+    through = Message.likes.through
+    likes = {}
+    for chunk in chunked(message_ids):
+        rows = through.objects.filter(message_id__in=chunk).order_by('message_id', 'customuser_id').values_list(
+            'message_id', 'customuser_id', 'customuser__first_name', 'customuser__phone_number')
+        for message_id, user_id, first_name, phone_number in rows:
+            likes.setdefault(message_id, []).append((user_id, first_name or phone_number))
+    return likes
+
+
+def attachment_mapper(request=None):
+    """Кортеж ATTACHMENT_FIELDS в словарь AttachmentSerializer
+
+    url — как у FileField в DRF: абсолютный, если есть запрос.
+    """
+    storage = Attachment._meta.get_field('file').storage
+    build_absolute_uri = request.build_absolute_uri if request is not None else None
+
+    def attachment_data(row):
+        attachment_id, name, filename, content_type, size = row
+        url = storage.url(name) if name else None
+        return {
+            'id': attachment_id,
+            'url': build_absolute_uri(url) if url and build_absolute_uri else url,
+            'filename': filename,
+            'content_type': content_type,
+            'size': size,
+        }
+
+    return attachment_data
+
+
+def attachments_for(message_ids, request=None, using=DEFAULT_DB_ALIAS):
+    """{id сообщения: [вложение, ...]} в порядке message.attachments.all()"""
+    attachment_data = attachment_mapper(request)
+    attachments = {}
+    for chunk in chunked(message_ids):
+        rows = Attachment.objects.using(using).filter(message_id__in=chunk).order_by('id').values_list(
+            'message_id', *ATTACHMENT_FIELDS)
+        for row in rows:
+            attachments.setdefault(row[0], []).append(attachment_data(row[1:]))
+    return attachments
+
+
+def serialize_messages(queryset, request=None):
+    """Список сообщений в формате MessageSerializer"""
+    rows = list(queryset.values_list(*MESSAGE_FIELDS))
+    if not rows:
+        return []
+    authors = users_by_id({row[2] for row in rows}, request)
+    likes = likes_for([row[0] for row in rows], queryset.db)
+    attachments = attachments_for([row[0] for row in rows], request, queryset.db)
+    user_id = request_user_id(request)
+
+    messages = []
+    for message_id, chat_id, author_id, content, created_at in rows:
+        message_likes = likes.get(message_id, ())
+        messages.append({
+            'id': message_id,
+            'chat_id': chat_id,
+            'author': authors[author_id],
+            'content': content,
+            'created_at': created_at,
+            'liked': user_id is not None and any(liker_id == user_id for liker_id, _ in message_likes),
+            'liked_by': [name for _, name in message_likes],
+            'attachments': attachments.get(message_id, []),
+        })
+    return messages
+
+
+def liker_ids_for(message_ids, using=DEFAULT_DB_ALIAS):
+    """{id сообщения: [id пользователя, ...]} в порядке likes.all()"""
+    through = Message.likes.through
+    likes = {}
+    for chunk in chunked(message_ids):
+        rows = through.objects.using(using).filter(message_id__in=chunk).order_by('message_id', 'customuser_id').values_list(
+            'message_id', 'customuser_id')
+        for message_id, user_id in rows:
+            likes.setdefault(message_id, []).append(user_id)
+    return likes
+
+
+def serialize_messages_normalized(queryset, request=None):
+    """Сообщения со ссылками на пользователей и словарь users
+
+    Возвращает (messages, users): в сообщениях author_id и liked_by со
+    списком id, в users — каждый автор и лайкнувший ровно один раз,
+    загруженные одним запросом.
+    """
+    rows = list(queryset.values_list(*MESSAGE_FIELDS))
+    if not rows:
+        return [], {}
+    likes = liker_ids_for([row[0] for row in rows], queryset.db)
+    attachments = attachments_for([row[0] for row in rows], request, queryset.db)
+    user_id = request_user_id(request)
+
+    user_ids = {row[2] for row in rows}
+    for liker_ids in likes.values():
+        user_ids.update(liker_ids)
+    users = users_by_id(user_ids, request)
+
+    messages = []
+    for message_id, chat_id, author_id, content, created_at in rows:
+        liker_ids = likes.get(message_id, [])
+        messages.append({
+            'id': message_id,
+            'chat_id': chat_id,
+            'author_id': author_id,
+            'content': content,
+            'created_at': created_at,
+            'liked': user_id in liker_ids,
+            'liked_by': liker_ids,
+            'attachments': attachments.get(message_id, []),
+        })
+    return messages, {str(key): value for key, value in users.items()}
+
+
+def serialize_chats(queryset, request):
+    """Список чатов в формате ChatListSerializer"""
+    if sharding.enabled():
+        # Сообщения в других базах: последнее берём отдельным запросом к каждому шарду
+        chats = list(queryset.values_list('id', 'chat_name'))
+        last = sharding.last_messages([chat_id for chat_id, _ in chats])
+        rows = [(chat_id, chat_name, *last.get(chat_id, (None, None))) for chat_id, chat_name in chats]
+    else:
+        last_message = Message.objects.filter(chat=OuterRef('pk')).order_by('-created_at')
+        rows = list(queryset.annotate(
+            last_content=Subquery(last_message.values('content')[:1]),
+            last_created=Subquery(last_message.values('created_at')[:1]),
+        ).values_list('id', 'chat_name', 'last_content', 'last_created'))
+
+    # Для чатов без названия показываем собеседника с наименьшим id,
+    # как participants.exclude(...).first() в ChatListSerializer
+    nameless = [row[0] for row in rows if not row[1]]
+    other_ids = {}
+    for chunk in chunked(nameless):
+        other_ids.update(
+            Chat.participants.through.objects.filter(chat_id__in=chunk)
+            .exclude(customuser_id=request_user_id(request))
+            .values('chat_id')
+            .annotate(other_id=Min('customuser_id'))
+            .values_list('chat_id', 'other_id')
+        )
+    others = {}
+    for chunk in chunked(set(other_ids.values())):
+        for user_id, phone_number, avatar in CustomUser.objects.filter(id__in=chunk).values_list(
+                'id', 'phone_number', 'avatar'):
+            others[user_id] = (phone_number, avatar)
+
+    # ChatListSerializer отдаёт avatar.url без абсолютного адреса
+    avatar_url = avatar_url_getter(absolute=False)
+    chats = []
+    for chat_id, chat_name, last_content, last_created in rows:
+        other = others.get(other_ids.get(chat_id)) if not chat_name else None
+        chats.append({
+            'id': chat_id,
+            'chat_name': chat_name or (other[0] if other else 'Без имени'),
+            'avatar': avatar_url(other[1]) if other else None,
+            'last_message': last_content if last_content is not None else '',
+            'last_time': timesince(last_created) if last_created else None,
+        })
+    return chats
+
+
+def serialize_inbox(entries, request):
+    """Список чатов из строк InboxEntry в их порядке
+
+    Поля ChatListSerializer дополнены unread, muted и pinned из строки.
+    """
+    chats = {}
+    for chunk in chunked([entry['chat_id'] for entry in entries]):
+        chats.update((chat['id'], chat) for chat in serialize_chats(Chat.objects.filter(pk__in=chunk), request))
+    return [
+        {**chats[entry['chat_id']], 'unread': entry['unread'], 'muted': entry['muted'], 'pinned': entry['pinned']}
+        for entry in entries
+        if entry['chat_id'] in chats
+    ]
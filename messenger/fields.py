@@ -0,0 +1,71 @@
+"""Текстовое поле, которое хранит длинные значения сжатыми
+
+CompressedTextField ведёт себя как TextField: в Python всегда обычная
+строка, сериализаторы и values_list получают уже распакованный текст.
+Значения длиннее threshold символов записываются как MARKER + base64
+от zlib, если так получается короче. Старые несжатые строки читаются
+как есть, поэтому поле можно включить без переписывания таблицы, а
+сжать существующие строки командой compress_messages.
+
+Поиск LIKE/icontains в БД по сжатым строкам не работает: искать по
+длинным текстам нужно по распакованному значению.
+"""
+import base64
+import zlib
+
+from django.db import models
+
+# Первый символ сжатого значения; допустим и в PostgreSQL, в отличие от \x00
+MARKER = '\x01'
+DEFAULT_THRESHOLD = 1024
+COMPRESSION_LEVEL = 6
+
+
+def compress(text, threshold=DEFAULT_THRESHOLD):
+    """Значение для записи в БД"""
+    # Текст, начинающийся с маркера, сжимаем всегда, чтобы не спутать при чтении
+    forced = text.startswith(MARKER)
+    if len(text) < threshold and not forced:
+        return text
+    raw = text.encode('utf-8')
+    packed = MARKER + base64.b64encode(zlib.compress(raw, COMPRESSION_LEVEL)).decode('ascii')
+    # Несжимаемый текст (уже сжатые данные, случайные строки) храним как есть
+    if len(packed) >= len(raw) and not forced:
+        return text
+    return packed
+
+
+def decompress(value):
+    """Исходный текст из значения в БД"""
+    if not value or value[0] != MARKER:
+        return value
+    return zlib.decompress(base64.b64decode(value[1:])).decode('utf-8')
+
+
+def is_compressed(value):
+    return bool(value) and value[0] == MARKER
+
+
+class CompressedTextField(models.TextField):
+    """TextField со сжатием значений длиннее threshold символов"""
+    description = 'Текст, длинные значения хранятся сжатыми'
+
+    def __init__(self, *args, threshold=DEFAULT_THRESHOLD, **kwargs):
+        self.threshold = threshold
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.threshold != DEFAULT_THRESHOLD:
+            kwargs['threshold'] = self.threshold
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection):
+        return decompress(value)
+
+    def get_db_prep_save(self, value, connection):
+        # Сжимаем только при записи: в фильтрах значение остаётся как есть
+        value = super().get_db_prep_save(value, connection)
+        if isinstance(value, str):
+            return compress(value, self.threshold)
+        return value
@@ -0,0 +1,157 @@
+"""Групповая фиксация: один поток-писатель на процесс
+
+В SQLite писатель один на всю базу, и каждая отправка сообщения отдельно
+берёт блокировку записи и ждёт fsync. С GROUP_COMMIT['ENABLED'] запросы
+не пишут сами, а ставят сообщение в очередь GroupCommitWriter и ждут.
+Поток-писатель забирает всё, что накопилось (до MAX_BATCH, дожидаясь
+новых не дольше MAX_DELAY_MS), пишет пачку одной транзакцией и отдаёт
+каждому запросу его сообщение с id. Пока идёт одна фиксация, в очереди
+набирается следующая пачка, поэтому при малой нагрузке задержка почти не
+растёт, а при большой блокировка берётся один раз на пачку.
+
+Если пачка не записалась (например, конфликт client_message_id с
+отправкой из другого процесса), каждое сообщение пишется отдельно, и
+ошибка достаётся только своему запросу. Запрос ждёт не дольше TIMEOUT
+секунд: после GroupCommitTimeout сообщение ещё может быть записано,
+повтор с тем же client_message_id его не продублирует.
+
+Очередь своя у каждого процесса: в нескольких воркерах писателей
+несколько, но блокировку они берут по разу на пачку.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger('messenger.group_commit')
+
+DEFAULTS = {
+    'ENABLED': False,
+    'MAX_BATCH': 64,
+    'MAX_DELAY_MS': 1,
+    'TIMEOUT': 5.0,
+    'QUEUE_SIZE': 10000,
+}
+
+# По стольким последним запросам считаются перцентили ожидания
+LATENCY_WINDOW = 1000
+
+
+class GroupCommitTimeout(Exception):
+    """Писатель не ответил за TIMEOUT секунд"""
+
+
+def get_config():
+    """Настройки групповой фиксации с подставленными значениями по умолчанию"""
+    return {**DEFAULTS, **getattr(settings, 'GROUP_COMMIT', {})}
+
+
+def enabled():
+    return get_config()['ENABLED']
+
+
+class GroupCommitWriter:
+    """Очередь и поток, который пишет её пачками
+
+    write_batch(items) пишет пачку одной транзакцией и возвращает
+    результаты в том же порядке; write_one(item) — запасной путь для
+    одного элемента, если пачка не записалась.
+    """
+
+    def __init__(self, write_batch, write_one, name='group-commit'):
+        self.write_batch = write_batch
+        self.write_one = write_one
+        self.name = name
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._counters = {'batches': 0, 'items': 0, 'fallbacks': 0, 'largest_batch': 0}
+
+    def _ensure_started(self):
+        # После fork поток родителя в дочернем процессе не существует
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._queue = queue.Queue(maxsize=get_config()['QUEUE_SIZE'])
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def submit(self, item):
+        """Ставит item в очередь; Future с результатом write_batch для него"""
+        self._ensure_started()
+        future = Future()
+        try:
+            self._queue.put((item, future, time.perf_counter()), timeout=get_config()['TIMEOUT'])
+        except queue.Full:
+            raise GroupCommitTimeout('Очередь записи переполнена') from None
+        return future
+
+    def call(self, item):
+        """submit() и ожидание результата не дольше TIMEOUT"""
+        future = self.submit(item)
+        try:
+            return future.result(timeout=get_config()['TIMEOUT'])
+        except TimeoutError:
+            raise GroupCommitTimeout('Запись не подтверждена за %s с' % get_config()['TIMEOUT']) from None
+
+    def _collect(self, first):
+        config = get_config()
+        batch = [first]
+        deadline = time.perf_counter() + config['MAX_DELAY_MS'] / 1000
+        while len(batch) < config['MAX_BATCH']:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect(self._queue.get())
+            # Запрос, который уже перестал ждать, ничего не получит, но
+            # записать его всё равно нужно: клиент повторит с тем же ключом
+            items = [item for item, _, _ in batch]
+            try:
+                results = self.write_batch(items)
+            except Exception:
+                logger.exception('Пачка из %d элементов не записалась, пишем по одному', len(items))
+                self._counters['fallbacks'] += 1
+                # Подключение могло остаться в неизвестном состоянии
+                connection.close()
+                results = []
+                for item in items:
+                    try:
+                        results.append(self.write_one(item))
+                    except Exception as exc:
+                        results.append(exc)
+            now = time.perf_counter()
+            for (_, future, enqueued_at), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+                self._latencies.append(now - enqueued_at)
+            self._counters['batches'] += 1
+            self._counters['items'] += len(batch)
+            self._counters['largest_batch'] = max(self._counters['largest_batch'], len(batch))
+
+    def stats(self):
+        """Число пачек и элементов, средний размер пачки и ожидание запросов в мс"""
+        latencies = sorted(self._latencies)
+        result = dict(self._counters)
+        result['queued'] = self._queue.qsize() if self._queue is not None else 0
+        result['average_batch'] = result['items'] / result['batches'] if result['batches'] else 0
+        for name, share in (('p50_ms', 0.5), ('p99_ms', 0.99)):
+            result[name] = latencies[min(int(len(latencies) * share), len(latencies) - 1)] * 1000 if latencies else 0
+        return result
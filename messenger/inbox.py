@@ -0,0 +1,245 @@
+"""Список чатов пользователя с разветвлением при записи (fan-out on write)
+
+Каждому участнику чата соответствует строка InboxEntry с временем
+последней активности, счётчиком непрочитанных и флагами muted/pinned.
+Отправка сообщения обновляет строки всех участников двумя UPDATE по
+chat_id, а страница списка читается диапазонным сканированием индекса
+(user, -last_activity, -chat) от курсора без join с участниками.
+
+В больших группах (больше FANOUT_LIMIT участников) обновлять строку
+каждого участника на каждое сообщение слишком дорого. Их строки помечены
+is_large: отправка меняет только Chat.last_activity_at, а активность и
+непрочитанные подставляются при чтении (fan-out on read) и сливаются с
+остальными строками. Закреплённых чатов тоже немного, они читаются
+вместе со строками больших групп и вливаются в каждую страницу.
+"""
+import base64
+import binascii
+import json
+
+from django.conf import settings
+from django.db import models
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import sharding
+from .models import Chat, InboxEntry, Message
+
+DEFAULTS = {
+    'FANOUT_LIMIT': 500,
+}
+
+ENTRY_FIELDS = ('chat_id', 'last_activity', 'unread', 'muted', 'pinned')
+BATCH_SIZE = 1000
+
+
+class InvalidCursor(ValueError):
+    """Курсор страницы испорчен или подделан"""
+
+
+def get_config():
+    """Настройки списка чатов с подставленными значениями по умолчанию"""
+    return {**DEFAULTS, **getattr(settings, 'INBOX', {})}
+
+
+def sort_key(entry):
+    """Порядок показа: закреплённые, затем по активности (по убыванию)"""
+    return entry['pinned'], entry['last_activity'], entry['chat_id']
+
+
+def _unread_since_read():
+    """Подзапрос: сообщения чужих авторов после last_read_at строки"""
+    return Message.objects.filter(
+        chat_id=OuterRef('chat_id'), created_at__gt=OuterRef('last_read_at'),
+    ).exclude(author_id=OuterRef('user_id')).values('chat_id').annotate(total=Count('*')).values('total')
+
+
+def _count_unread(entries):
+    """То же, что _unread_since_read, запросом к шарду чата каждой строки
+
+    С шардированием сообщения в другой базе, и подзапрос невозможен;
+    entries — [(chat_id, user_id, last_read_at), ...]. Возвращает
+    {(chat_id, user_id): число}.
+    """
+    return {
+        (chat_id, user_id): sharding.messages(chat_id).filter(created_at__gt=last_read_at)
+        .exclude(author_id=user_id).count()
+        for chat_id, user_id, last_read_at in entries
+    }
+
+
+def add_members(chat_ids, user_ids):
+    """Создаёт строки для новых участников; существующие не трогает"""
+    now = timezone.now()
+    limit = get_config()['FANOUT_LIMIT']
+    chats = list(Chat.objects.filter(pk__in=list(chat_ids)).values_list('pk', 'last_activity_at', 'member_count'))
+    entries = [
+        InboxEntry(
+            user_id=user_id, chat_id=chat_id, last_activity=last_activity, last_read_at=now,
+            is_large=member_count > limit,
+        )
+        for chat_id, last_activity, member_count in chats
+        for user_id in user_ids
+    ]
+    InboxEntry.objects.bulk_create(entries, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+def remove_members(chat_ids, user_ids=None):
+    """Удаляет строки вышедших участников; user_ids=None — всех участников чатов"""
+    entries = InboxEntry.objects.filter(chat_id__in=list(chat_ids))
+    if user_ids is not None:
+        entries = entries.filter(user_id__in=list(user_ids))
+    entries.delete()
+
+
+def sync_fanout_mode(chat_ids):
+    """Переключает строки чатов, пересёкших FANOUT_LIMIT, между режимами"""
+    limit = get_config()['FANOUT_LIMIT']
+    chat_ids = list(chat_ids)
+    large = Chat.objects.filter(pk__in=chat_ids, member_count__gt=limit).values('pk')
+    InboxEntry.objects.filter(chat_id__in=large, is_large=False).update(is_large=True)
+
+    # Группа снова небольшая: счётчики в строках устарели, восстанавливаем
+    # их так же, как считали при чтении
+    small = Chat.objects.filter(pk__in=chat_ids, member_count__lte=limit).values('pk')
+    entries = InboxEntry.objects.filter(chat_id__in=small, is_large=True)
+    last_activity = Subquery(Chat.objects.filter(pk=OuterRef('chat_id')).values('last_activity_at'))
+    if not sharding.enabled():
+        entries.update(is_large=False, last_activity=last_activity, unread=Coalesce(Subquery(_unread_since_read()), 0))
+        return
+    unread = _count_unread(entries.values_list('chat_id', 'user_id', 'last_read_at'))
+    for (chat_id, user_id), count in unread.items():
+        InboxEntry.objects.filter(chat_id=chat_id, user_id=user_id).update(
+            is_large=False, last_activity=last_activity, unread=count)
+
+
+def on_message(message):
+    """Поднимает чат в списках участников; вызывать в транзакции отправки"""
+    created_at = message.created_at
+    Chat.objects.filter(pk=message.chat_id).update(last_activity_at=created_at)
+    InboxEntry.objects.filter(chat_id=message.chat_id, is_large=False).exclude(user_id=message.author_id).update(
+        last_activity=created_at, unread=F('unread') + 1,
+    )
+    # Автор прочитал чат, раз пишет в него
+    InboxEntry.objects.filter(chat_id=message.chat_id, user_id=message.author_id).update(
+        last_activity=created_at, last_read_at=created_at, unread=0,
+    )
+
+
+def on_messages(messages):
+    """on_message() для пачки сообщений: два UPDATE на чат и один на автора
+
+    Итог тот же, что у on_message() по каждому сообщению по порядку:
+    автор прочитал чат на своём последнем сообщении пачки, и непрочитанные
+    у него — только более поздние сообщения других.
+    """
+    by_chat = {}
+    for message in messages:
+        by_chat.setdefault(message.chat_id, []).append(message)
+    for chat_id, chat_messages in by_chat.items():
+        last = chat_messages[-1].created_at
+        # {автор: (его последнее сообщение, сообщений других после него)}
+        authors = {}
+        for position, message in enumerate(chat_messages):
+            authors[message.author_id] = (message, len(chat_messages) - position - 1)
+        Chat.objects.filter(pk=chat_id).update(last_activity_at=last)
+        InboxEntry.objects.filter(chat_id=chat_id, is_large=False).exclude(user_id__in=authors).update(
+            last_activity=last, unread=F('unread') + len(chat_messages),
+        )
+        for author_id, (message, unread_after) in authors.items():
+            InboxEntry.objects.filter(chat_id=chat_id, user_id=author_id).update(
+                last_activity=Case(
+                    When(is_large=True, then=models.Value(message.created_at)), default=models.Value(last),
+                ),
+                last_read_at=message.created_at,
+                unread=Case(When(is_large=True, then=0), default=unread_after),
+            )
+
+
+def mark_read(user_id, chat):
+    """Отмечает чат прочитанным; число изменённых строк (0 или 1)
+
+    Открытие чата без новых сообщений не пишет в базу: строка с unread=0 и
+    last_read_at не раньше последней активности чата не попадает под UPDATE.
+    """
+    return InboxEntry.objects.filter(user_id=user_id, chat_id=chat.pk).exclude(
+        unread=0, last_read_at__gte=chat.last_activity_at,
+    ).update(unread=0, last_read_at=timezone.now())
+
+
+def encode_cursor(entry):
+    """Непрозрачный курсор страницы: позиция строки в порядке показа"""
+    key = [int(entry['pinned']), entry['last_activity'].isoformat(), entry['chat_id']]
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(pinned, last_activity, chat_id) из курсора; InvalidCursor, если он испорчен"""
+    try:
+        pinned, last_activity, chat_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        last_activity = parse_datetime(last_activity)
+        if last_activity is None or type(chat_id) is not int:
+            raise ValueError(cursor)
+    except (ValueError, TypeError, binascii.Error) as exc:
+        raise InvalidCursor('Неверный курсор страницы') from exc
+    return bool(pinned), last_activity, chat_id
+
+
+def side_entries(user_id, search=None):
+    """Закреплённые строки и строки больших групп пользователя
+
+    Их немного, поэтому они читаются целиком по частичному индексу и
+    вливаются в каждую страницу. Для больших групп активность и
+    непрочитанные берутся из чата.
+    """
+    rows = InboxEntry.objects.filter(Q(is_large=True) | Q(pinned=True), user_id=user_id)
+    if search is not None:
+        rows = rows.filter(chat__chat_name__icontains=search)
+    sharded = sharding.enabled()
+    rows = rows.annotate(
+        activity=Case(When(is_large=True, then=F('chat__last_activity_at')), default=F('last_activity')),
+        unread_now=Case(
+            When(is_large=True, then=F('unread') if sharded else Coalesce(Subquery(_unread_since_read()), 0)),
+            default=F('unread'),
+            output_field=models.PositiveIntegerField(),
+        ),
+    ).values_list('chat_id', 'activity', 'unread_now', 'muted', 'pinned', 'is_large', 'last_read_at')
+    entries = []
+    for *row, is_large, last_read_at in rows:
+        entry = dict(zip(ENTRY_FIELDS, row))
+        if sharded and is_large:
+            entry['unread'] = _count_unread([(entry['chat_id'], user_id, last_read_at)])[entry['chat_id'], user_id]
+        entries.append(entry)
+    return entries
+
+
+def chat_list(user_id, cursor=None, limit=None, search=None):
+    """Страница строк списка чатов в порядке показа и курсор следующей
+
+    Обычные строки читаются keyset-проходом по индексу (user,
+    -last_activity, -chat) от позиции курсора, поэтому стоимость страницы
+    не зависит от её номера. search — подстрока названия чата.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    rows = InboxEntry.objects.filter(user_id=user_id, is_large=False, pinned=False)
+    if search is not None:
+        rows = rows.filter(chat__chat_name__icontains=search)
+    if after is not None and not after[0]:
+        _, last_activity, chat_id = after
+        rows = rows.filter(last_activity__lte=last_activity).exclude(
+            last_activity=last_activity, chat_id__gte=chat_id)
+    rows = rows.order_by('-last_activity', '-chat_id').values_list(*ENTRY_FIELDS)
+    if limit is not None:
+        rows = rows[:limit + 1]
+    entries = [dict(zip(ENTRY_FIELDS, row)) for row in rows]
+
+    side = side_entries(user_id, search)
+    if after is not None:
+        side = [entry for entry in side if sort_key(entry) < after]
+    entries = sorted(entries + side, key=sort_key, reverse=True)
+
+    if limit is None or len(entries) <= limit:
+        return entries, None
+    return entries[:limit], encode_cursor(entries[limit - 1])
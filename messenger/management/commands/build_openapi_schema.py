@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from messenger_project import openapi
+
+
+class Command(BaseCommand):
+    help = 'Генерирует схему OpenAPI в OPENAPI_SCHEMA_DIR; запускать при сборке, как collectstatic'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None, help='Каталог для schema.yaml и schema.json')
+
+    def handle(self, *args, **options):
+        for path in openapi.build(options['dir']):
+            self.stdout.write('Записано: %s' % path)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from messenger import uploads
+
+
+class Command(BaseCommand):
+    help = 'Удаляет заброшенные загрузки вложений вместе с файлами частей'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours', type=int, default=None,
+            help='Удалить загрузки без новых частей дольше стольких часов (по умолчанию UPLOADS["EXPIRE_HOURS"])',
+        )
+
+    def handle(self, *args, **options):
+        deleted = uploads.cleanup(options['hours'])
+        self.stdout.write('Удалено загрузок: %d' % deleted)
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from messenger import changelog
+
+
+class Command(BaseCommand):
+    help = 'Удаляет старые записи журнала изменений; отставшие клиенты получат сигнал resync'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.CHANGELOG_RETENTION_DAYS,
+            help='Удалить записи старше стольких дней',
+        )
+        parser.add_argument('--batch-size', type=int, default=changelog.DELETE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        deleted = changelog.compact(before, batch_size=options['batch_size'])
+        self.stdout.write('Удалено записей: %d, очищено до seq %d' % (deleted, changelog.compacted_through()))
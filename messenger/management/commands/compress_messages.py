@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.functions import Length
+
+from messenger import sharding
+from messenger.fields import MARKER, compress
+from messenger.models import Message
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = 'Сжимает текст существующих длинных сообщений пачками (см. messenger/fields.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать, ничего не записывать')
+
+    def handle(self, *args, **options):
+        compressed = skipped = saved = 0
+        for db in sharding.message_databases():
+            result = self.compress_database(db, options)
+            compressed, skipped, saved = compressed + result[0], skipped + result[1], saved + result[2]
+
+        self.stdout.write('%s сообщений: %d, несжимаемых: %d, экономия: %.1f КиБ' % (
+            'Можно сжать' if options['dry_run'] else 'Сжато',
+            compressed, skipped, saved / 1024,
+        ))
+
+    def compress_database(self, db, options):
+        """Сжимает сообщения одной базы; (сжато, несжимаемых, сэкономлено байт)"""
+        field = Message._meta.get_field('content')
+        # Фильтры работают по значению в БД: несжатые строки не длиннее порога
+        candidates = Message.objects.using(db).annotate(size=Length('content')).filter(
+            size__gte=field.threshold,
+        ).exclude(content__startswith=MARKER).order_by('id')
+
+        last_id = 0
+        compressed = skipped = saved = 0
+        while True:
+            rows = list(candidates.filter(id__gt=last_id).values_list('id', 'content')[:options['batch_size']])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            batch = []
+            for message_id, content in rows:
+                packed = compress(content, field.threshold)
+                if packed is content:
+                    skipped += 1
+                    continue
+                saved += len(content.encode('utf-8')) - len(packed)
+                batch.append(Message(id=message_id, content=content))
+            compressed += len(batch)
+            if batch and not options['dry_run']:
+                # Короткая транзакция на пачку, чтобы не держать запись в SQLite
+                with transaction.atomic(using=db):
+                    Message.objects.using(db).bulk_update(batch, ['content'])
+        return compressed, skipped, saved
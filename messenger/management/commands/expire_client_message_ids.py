@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from messenger import services
+
+
+class Command(BaseCommand):
+    help = 'Очищает устаревшие client_message_id: повтор с таким ключом создаст новое сообщение'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours', type=int, default=settings.CLIENT_MESSAGE_ID_RETENTION_HOURS,
+            help='Очистить ключи сообщений старше стольких часов',
+        )
+        parser.add_argument('--batch-size', type=int, default=services.EXPIRE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        expired = services.expire_client_message_ids(options['hours'], batch_size=options['batch_size'])
+        self.stdout.write('Очищено ключей: %d' % expired)
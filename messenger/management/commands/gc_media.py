@@ -0,0 +1,28 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from messenger_project import storage
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает ссылки на файлы хранилища по хешу и удаляет файлы без ссылок'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace-hours', type=float, default=None,
+            help='Не трогать файлы, сохранённые позже стольких часов назад '
+                 '(по умолчанию CONTENT_STORAGE["GC_GRACE_HOURS"])',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет удалено')
+
+    def handle(self, *args, **options):
+        if not isinstance(default_storage, storage.ContentAddressedStorage):
+            self.stderr.write('Хранилище по умолчанию не ContentAddressedStorage, удалять нечего')
+            return
+        result = storage.collect_garbage(default_storage, options['grace_hours'], options['dry_run'])
+        prefix = 'Будет удалено' if options['dry_run'] else 'Удалено'
+        self.stdout.write(
+            'Пересчитано ссылок: %(recounted)d. ' % result
+            + '%s файлов без ссылок: %d, потерянных файлов: %d, освобождено байт: %d' % (
+                prefix, result['deleted'], result['orphans'], result['freed_bytes'])
+        )
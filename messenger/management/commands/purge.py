@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from messenger import purge
+from messenger.models import PurgeJob
+
+
+class Command(BaseCommand):
+    help = 'Удаляет чаты, пользователей и истёкшие сообщения пачками, с продолжением после сбоя'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chat', type=int, action='append', default=[], help='Удалить чат (можно несколько раз)')
+        parser.add_argument('--user', type=int, action='append', default=[], help='Удалить пользователя')
+        parser.add_argument('--expired', action='store_true',
+                            help='Удалить сообщения старше message_ttl_days их чатов (запуск по cron)')
+        parser.add_argument('--resume', action='store_true', help='Продолжить все незавершённые задания')
+        parser.add_argument('--background', action='store_true',
+                            help='Только поставить задания в очередь фоновых задач')
+
+    def handle(self, *args, **options):
+        requested = [(PurgeJob.KIND_CHAT, chat_id) for chat_id in options['chat']]
+        requested += [(PurgeJob.KIND_USER, user_id) for user_id in options['user']]
+        if options['expired']:
+            requested.append((PurgeJob.KIND_EXPIRED, None))
+        if not requested and not options['resume']:
+            raise CommandError('Укажите --chat, --user, --expired или --resume')
+
+        jobs = [purge.schedule(kind, target_id, background=options['background']) for kind, target_id in requested]
+        if options['resume']:
+            known = {job.pk for job in jobs}
+            jobs += [
+                purge.schedule(job.kind, job.target_id, background=options['background'])
+                for job in PurgeJob.objects.exclude(status=PurgeJob.STATUS_DONE).order_by('pk')
+                if job.pk not in known
+            ]
+        if options['background']:
+            self.stdout.write('Поставлено в очередь заданий: %d' % len(jobs))
+            return
+        for job in jobs:
+            purge.run(job)
+            self.stdout.write('Задание %d (%s %s): удалено строк %d' % (
+                job.pk, job.get_kind_display(), job.target_id or '', job.deleted))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from messenger import sharding
+
+
+class Command(BaseCommand):
+    help = 'Переносит сообщения чатов в шарды, которые им назначает кольцо MESSAGE_SHARDS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chat', type=int, help='Перенести только этот чат')
+        parser.add_argument('--to', help='Шард для --chat вместо выбранного кольцом')
+        parser.add_argument('--limit', type=int, default=None, help='Перенести не больше стольких чатов')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет перенесено')
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError('Шардирование выключено: MESSAGE_SHARDS["SHARDS"] пуст')
+        if options['to'] and options['chat'] is None:
+            raise CommandError('--to указывается вместе с --chat')
+
+        if options['chat'] is not None:
+            chat_id = options['chat']
+            moves = [(chat_id, sharding.db_for_chat(chat_id), options['to'] or sharding.ring().node_for(chat_id))]
+        else:
+            moves = sharding.misplaced(options['limit'])
+
+        total = 0
+        for chat_id, source, target in moves:
+            if options['dry_run']:
+                self.stdout.write('Чат %d: %s -> %s' % (chat_id, source, target))
+                continue
+            try:
+                moved = sharding.move_chat(chat_id, target)
+            except (sharding.ChatMoving, ValueError) as exc:
+                self.stderr.write('Чат %d: %s' % (chat_id, exc))
+                continue
+            total += moved
+            self.stdout.write('Чат %d: %s -> %s, сообщений: %d' % (chat_id, source, target, moved))
+        prefix = 'Будет перенесено' if options['dry_run'] else 'Перенесено'
+        self.stdout.write('%s чатов: %d, сообщений: %d' % (prefix, len(moves), total))
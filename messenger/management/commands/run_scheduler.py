@@ -0,0 +1,34 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from messenger import scheduled
+
+
+class Command(BaseCommand):
+    help = 'Отправляет запланированные сообщения в срок (messenger/scheduled.py); запускать в одном процессе'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Отправить наступившие сообщения и выйти')
+
+    def handle(self, *args, **options):
+        dispatcher = scheduled.Dispatcher()
+        self.stopping = threading.Event()
+        if not options['once']:
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        while not self.stopping.is_set():
+            # Спим до ближайшего срока или до проверки новых расписаний
+            timeout = dispatcher.tick()
+            if options['once']:
+                break
+            self.stopping.wait(timeout)
+        stats = dispatcher.stats()
+        self.stdout.write('Отправлено: %d, не отправлено: %d, отложено: %d' % (
+            stats['sent'], stats['failed'], stats['retried']))
+
+    def stop(self, signum, frame):
+        self.stderr.write('Останавливаем диспетчер')
+        self.stopping.set()
@@ -0,0 +1,82 @@
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from messenger import task_queue
+
+# Как часто воркер возвращает зависшие задачи и чистит выполненные, секунды
+MAINTENANCE_INTERVAL = 60
+
+
+class Command(BaseCommand):
+    help = 'Выполняет фоновые задачи из очереди (messenger/task_queue.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4,
+                            help='Размер пула потоков; 1 — выполнять задачи в основном потоке')
+        parser.add_argument('--poll', type=float, default=None,
+                            help='Пауза между опросами пустой очереди, секунды')
+        parser.add_argument('--once', action='store_true',
+                            help='Выполнить готовые задачи и выйти')
+        parser.add_argument('--name', default=None, help='Имя воркера в Task.locked_by')
+
+    def handle(self, *args, **options):
+        config = task_queue.get_config()
+        poll = options['poll'] if options['poll'] is not None else config['POLL_INTERVAL']
+        threads = max(options['threads'], 1)
+        worker_id = (options['name'] or '%s:%d' % (socket.gethostname(), os.getpid()))[:48]
+        self.stopping = threading.Event()
+        if not options['once']:
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+        pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='task') if threads > 1 else None
+        running = set()
+        results = []
+        next_maintenance = 0
+        try:
+            while not self.stopping.is_set():
+                if time.monotonic() >= next_maintenance:
+                    requeued = task_queue.requeue_stale()
+                    if requeued:
+                        self.stderr.write('Возвращено в очередь зависших задач: %d' % requeued)
+                    task_queue.purge_finished()
+                    next_maintenance = time.monotonic() + MAINTENANCE_INTERVAL
+
+                # Берём не больше задач, чем свободных потоков
+                free = threads - len(running)
+                tasks = task_queue.claim(worker_id, limit=free) if free else []
+                if pool is None:
+                    results.extend(task_queue.run(item) for item in tasks)
+                else:
+                    running.update(pool.submit(self.run_in_thread, item) for item in tasks)
+
+                if running:
+                    finished, running = wait(running, timeout=poll, return_when=FIRST_COMPLETED)
+                    results.extend(future.result() for future in finished)
+                elif not tasks:
+                    if options['once']:
+                        break
+                    self.stopping.wait(poll)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
+                results.extend(future.result() for future in running)
+        self.stdout.write('Выполнено задач: %d, с ошибкой: %d' % (results.count(True), results.count(False)))
+
+    def run_in_thread(self, item):
+        try:
+            return task_queue.run(item)
+        finally:
+            # У каждого потока своё подключение к БД
+            connections.close_all()
+
+    def stop(self, signum, frame):
+        self.stderr.write('Завершаем текущие задачи и останавливаемся')
+        self.stopping.set()
@@ -0,0 +1,75 @@
+import json
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from messenger_project.query_log import get_config
+
+
+class Command(BaseCommand):
+    help = 'Сводка медленных запросов по отпечаткам из журнала SLOW_QUERY_LOG'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', help='Путь к журналу (по умолчанию SLOW_QUERY_LOG["LOG_FILE"])')
+        parser.add_argument('--top', type=int, default=10, help='Сколько отпечатков показать')
+        parser.add_argument(
+            '--order', choices=['total', 'max', 'count', 'avg'], default='total',
+            help='Сортировка отчёта',
+        )
+
+    def handle(self, *args, **options):
+        log_file = options['file'] or get_config()['LOG_FILE']
+        if not log_file:
+            raise CommandError('Не задан файл журнала: укажите --file или SLOW_QUERY_LOG["LOG_FILE"]')
+
+        stats = {}
+        try:
+            with open(log_file, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        self.add_record(stats, json.loads(line))
+        except FileNotFoundError:
+            raise CommandError('Файл журнала не найден: %s' % log_file)
+
+        for item in stats.values():
+            item['avg'] = item['total'] / item['count']
+        report = sorted(stats.values(), key=lambda item: item[options['order']], reverse=True)
+
+        for position, item in enumerate(report[:options['top']], start=1):
+            self.stdout.write(
+                '%d. [%s] count=%d total=%.1fms avg=%.1fms max=%.1fms' % (
+                    position, item['fingerprint'], item['count'],
+                    item['total'], item['avg'], item['max'],
+                )
+            )
+            self.stdout.write('   %s' % item['normalized'])
+            for label, counter in (('views', item['views']), ('sources', item['sources'])):
+                top = ', '.join('%s (%d)' % pair for pair in counter.most_common(3))
+                self.stdout.write('   %s: %s' % (label, top or '-'))
+            if item['plan']:
+                for step in item['plan'].splitlines():
+                    self.stdout.write('     | %s' % step)
+
+    @staticmethod
+    def add_record(stats, record):
+        item = stats.setdefault(record['fingerprint'], {
+            'fingerprint': record['fingerprint'],
+            'normalized': record['normalized'],
+            'count': 0,
+            'total': 0.0,
+            'max': 0.0,
+            'views': Counter(),
+            'sources': Counter(),
+            'plan': None,
+        })
+        duration = record['duration_ms']
+        item['count'] += 1
+        item['total'] += duration
+        if duration >= item['max']:
+            item['max'] = duration
+            # План самого медленного выполнения показательнее остальных
+            item['plan'] = record.get('plan') or item['plan']
+        if record.get('view'):
+            item['views'][record['view']] += 1
+        if record.get('source'):
+            item['sources'][record['source']] += 1
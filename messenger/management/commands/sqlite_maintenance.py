@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from messenger_project.sqlite_backend import maintenance
+
+
+class Command(BaseCommand):
+    help = 'Обновляет статистику планировщика SQLite и переносит журнал WAL в файл базы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument(
+            '--checkpoint', default='TRUNCATE', choices=maintenance.CHECKPOINT_MODES,
+            help='Режим PRAGMA wal_checkpoint',
+        )
+        parser.add_argument(
+            '--optimize', action='store_true',
+            help='PRAGMA optimize вместо полного ANALYZE: только таблицы с устаревшей статистикой',
+        )
+        parser.add_argument('--skip-analyze', action='store_true')
+        parser.add_argument('--skip-checkpoint', action='store_true')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        if connections[using].vendor != 'sqlite':
+            raise CommandError('База %s не SQLite' % using)
+        if not options['skip_analyze']:
+            maintenance.analyze(using, full=not options['optimize'])
+            self.stdout.write('Статистика обновлена (%s)' % ('PRAGMA optimize' if options['optimize'] else 'ANALYZE'))
+        if options['skip_checkpoint']:
+            return
+        mode = maintenance.journal_mode(using)
+        if mode != 'wal':
+            self.stdout.write('Журнал не в режиме WAL (%s), контрольная точка не нужна' % mode)
+            return
+        busy, log_pages, moved = maintenance.checkpoint(using, options['checkpoint'])
+        self.stdout.write('Контрольная точка %s: страниц в журнале %d, перенесено %d%s' % (
+            options['checkpoint'], log_pages, moved, ', база занята читателями' if busy else ''))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from messenger import task_queue
+
+
+class Command(BaseCommand):
+    help = 'Метрики очереди фоновых задач: число по статусам, время выполнения и задержка'
+
+    def handle(self, *args, **options):
+        stats = task_queue.stats()
+        if not stats:
+            self.stdout.write('Очередь пуста')
+            return
+        self.stdout.write('%-30s %8s %8s %8s %8s %10s %10s %10s' % (
+            'задача', 'pending', 'running', 'done', 'failed', 'avg, мс', 'max, мс', 'лаг, с'))
+        for name, item in sorted(stats.items()):
+            self.stdout.write('%-30s %8d %8d %8d %8d %10s %10s %10.1f' % (
+                name, item['pending'], item['running'], item['done'], item['failed'],
+                '%.1f' % item['avg_ms'] if item['avg_ms'] is not None else '-',
+                '%.1f' % item['max_ms'] if item['max_ms'] is not None else '-',
+                item['lag_seconds'],
+            ))
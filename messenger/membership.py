@@ -0,0 +1,79 @@
+"""Массовое изменение состава группы
+
+Добавить или убрать тысячи участников по номерам телефонов и id за один
+запрос. Пользователи находятся пачками по IN_CHUNK_SIZE, и в том же
+запросе (EXISTS по таблице участников) определяется, кто уже в чате:
+разница считается в SQL, а не загрузкой участников в Python. Новые
+строки участников пишутся одним bulk_create, ушедшие удаляются одним
+DELETE, в журнал изменений идёт одна запись KIND_MEMBERS со списком id.
+
+bulk_create и удаление мимо менеджера участников не посылают
+m2m_changed, поэтому member_count, строки списков чатов и режим
+разветвления обновляются здесь так же, как в signals.update_membership.
+"""
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from users.fast_serializers import chunked
+from users.models import CustomUser
+from . import changelog, inbox
+from .models import ChangeLogEntry, Chat
+from .signals import refresh_member_counts
+
+# Столько номеров и id можно передать в одном запросе
+MAX_CHANGE = 5000
+
+
+def resolve(chat, phone_numbers=(), user_ids=()):
+    """Находит пользователей и их участие в чате
+
+    Возвращает (members, others, missing): id участников, id остальных
+    найденных и {'phone_numbers': [...], 'user_ids': [...]} ненайденных.
+    """
+    through = Chat.participants.through
+    is_member = Exists(through.objects.filter(chat_id=chat.pk, customuser_id=OuterRef('pk')))
+    members, others = set(), set()
+    missing = {}
+    for key, field, values in (('phone_numbers', 'phone_number', phone_numbers), ('user_ids', 'id', user_ids)):
+        values = list(dict.fromkeys(values))
+        found = set()
+        for chunk in chunked(values):
+            rows = CustomUser.objects.filter(**{field + '__in': chunk}).annotate(
+                is_member=is_member).values_list('id', field, 'is_member')
+            for user_id, value, member in rows:
+                found.add(value)
+                (members if member else others).add(user_id)
+        missing[key] = [value for value in values if value not in found]
+    return sorted(members), sorted(others - members), missing
+
+
+def add(chat, user_ids, actor_id):
+    """Добавляет в чат пользователей user_ids, которых в нём ещё нет"""
+    if not user_ids:
+        return
+    through = Chat.participants.through
+    with transaction.atomic():
+        through.objects.bulk_create(
+            [through(chat_id=chat.pk, customuser_id=user_id) for user_id in user_ids],
+            batch_size=inbox.BATCH_SIZE,
+            # Параллельный запрос мог успеть добавить кого-то из них
+            ignore_conflicts=True,
+        )
+        refresh_member_counts([chat.pk])
+        # Строки списков после пересчёта: is_large зависит от нового числа участников
+        inbox.add_members([chat.pk], user_ids)
+        inbox.sync_fanout_mode([chat.pk])
+        changelog.record(ChangeLogEntry.KIND_MEMBERS, chat_id=chat.pk, user_id=actor_id, added=list(user_ids))
+
+
+def remove(chat, user_ids, actor_id):
+    """Убирает из чата участников user_ids"""
+    if not user_ids:
+        return
+    through = Chat.participants.through
+    with transaction.atomic():
+        through.objects.filter(chat_id=chat.pk, customuser_id__in=list(user_ids))._raw_delete(through.objects.db)
+        inbox.remove_members([chat.pk], user_ids)
+        refresh_member_counts([chat.pk])
+        inbox.sync_fanout_mode([chat.pk])
+        changelog.record(ChangeLogEntry.KIND_MEMBERS, chat_id=chat.pk, user_id=actor_id, removed=list(user_ids))
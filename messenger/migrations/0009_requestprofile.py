@@ -0,0 +1,40 @@
+# Generated by Django 4.2.21 on 2026-10-19 03:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('messenger', '0008_alter_chat_chat_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('request_id', models.CharField(max_length=32, unique=True, verbose_name='ID запроса')),
+                ('method', models.CharField(max_length=10, verbose_name='Метод')),
+                ('path', models.CharField(max_length=255, verbose_name='Путь')),
+                ('view_name', models.CharField(blank=True, max_length=100, verbose_name='View')),
+                ('status_code', models.PositiveSmallIntegerField(null=True, verbose_name='Код ответа')),
+                ('mode', models.CharField(choices=[('sample', 'Сэмплирование'), ('cprofile', 'cProfile')], max_length=10, verbose_name='Режим')),
+                ('duration_ms', models.FloatField(verbose_name='Длительность, мс')),
+                ('sample_count', models.PositiveIntegerField(default=0, verbose_name='Сэмплов')),
+                ('collapsed_stacks', models.TextField(blank=True, help_text='Формат collapsed stacks для flamegraph', verbose_name='Свёрнутые стеки')),
+                ('stats', models.TextField(blank=True, verbose_name='Статистика cProfile')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='request_profiles', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Профиль запроса',
+                'verbose_name_plural': 'Профили запросов',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['view_name', '-created_at'], name='messenger_r_view_na_a01b58_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.21 on 2026-10-19 03:53
+
+from django.conf import settings
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('messenger', '0009_requestprofile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLogCompaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('compacted_through', models.BigIntegerField(verbose_name='Удалено до seq включительно')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата')),
+            ],
+            options={
+                'verbose_name': 'Очистка журнала изменений',
+                'verbose_name_plural': 'Очистки журнала изменений',
+                'ordering': ['-compacted_through'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ChangeLogEntry',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('message', 'Новое сообщение'), ('like', 'Лайк'), ('chat_rename', 'Переименование чата'), ('join', 'Вступление в чат'), ('profile', 'Изменение профиля')], max_length=20, verbose_name='Тип')),
+                ('payload', models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='Данные')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата')),
+                ('chat', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='messenger.chat', verbose_name='Чат')),
+                ('user', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='changes', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Изменение',
+                'verbose_name_plural': 'Журнал изменений',
+                'ordering': ['seq'],
+                'indexes': [models.Index(fields=['chat', 'seq'], name='messenger_c_chat_id_cd2069_idx'), models.Index(fields=['user', 'seq'], name='messenger_c_user_id_efa12c_idx')],
+            },
+        ),
+    ]
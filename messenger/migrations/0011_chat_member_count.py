@@ -0,0 +1,29 @@
+# Generated by Django 4.2.21 on 2026-10-19 03:54
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_member_count(apps, schema_editor):
+    Chat = apps.get_model('messenger', 'Chat')
+    through = Chat.participants.through
+    counts = through.objects.filter(chat_id=OuterRef('pk')).values('chat_id').annotate(
+        total=Count('*')).values('total')
+    Chat.objects.update(member_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0010_changelogcompaction_changelogentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0, help_text='Поддерживается сигналом m2m_changed, см. messenger/signals.py', verbose_name='Число участников'),
+        ),
+        migrations.RunPython(fill_member_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 4.2.21 on 2026-10-19 04:04
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+BATCH_SIZE = 1000
+
+
+def fill_inbox(apps, schema_editor):
+    Chat = apps.get_model('messenger', 'Chat')
+    Message = apps.get_model('messenger', 'Message')
+    InboxEntry = apps.get_model('messenger', 'InboxEntry')
+    through = Chat.participants.through
+
+    last_message = Message.objects.filter(chat_id=OuterRef('pk')).values('chat_id').annotate(
+        last=Max('created_at')).values('last')
+    Chat.objects.update(last_activity_at=Coalesce(Subquery(last_message), 'created_at'))
+
+    fanout_limit = getattr(settings, 'INBOX', {}).get('FANOUT_LIMIT', 500)
+    rows = through.objects.order_by('pk').values_list(
+        'customuser_id', 'chat_id', 'chat__last_activity_at', 'chat__member_count').iterator(chunk_size=BATCH_SIZE)
+    batch = []
+    for user_id, chat_id, last_activity, member_count in rows:
+        batch.append(InboxEntry(
+            user_id=user_id, chat_id=chat_id, last_activity=last_activity, last_read_at=last_activity,
+            is_large=member_count > fanout_limit,
+        ))
+        if len(batch) >= BATCH_SIZE:
+            InboxEntry.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    InboxEntry.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('messenger', '0012_task'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='Время последнего сообщения, см. messenger/inbox.py', verbose_name='Последняя активность'),
+        ),
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_activity', models.DateTimeField(verbose_name='Последняя активность')),
+                ('unread', models.PositiveIntegerField(default=0, verbose_name='Непрочитано')),
+                ('last_read_at', models.DateTimeField(blank=True, null=True, verbose_name='Прочитано до')),
+                ('muted', models.BooleanField(default=False, verbose_name='Без уведомлений')),
+                ('pinned', models.BooleanField(default=False, verbose_name='Закреплён')),
+                ('is_large', models.BooleanField(default=False, help_text='Активность и непрочитанные берутся из чата при чтении', verbose_name='Большая группа')),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='messenger.chat', verbose_name='Чат')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Строка списка чатов',
+                'verbose_name_plural': 'Списки чатов',
+                'indexes': [models.Index(fields=['user', '-pinned', '-last_activity', '-chat'], name='messenger_i_user_id_379572_idx'), models.Index(condition=models.Q(('is_large', True)), fields=['user'], name='inbox_large_entries')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='inboxentry',
+            constraint=models.UniqueConstraint(fields=('user', 'chat'), name='unique_inbox_entry'),
+        ),
+        migrations.RunPython(fill_inbox, migrations.RunPython.noop),
+    ]
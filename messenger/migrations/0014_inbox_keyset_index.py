@@ -0,0 +1,29 @@
+# Generated by Django 4.2.21 on 2026-10-19 04:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0013_inbox'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='inboxentry',
+            name='messenger_i_user_id_379572_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='inboxentry',
+            name='inbox_large_entries',
+        ),
+        migrations.AddIndex(
+            model_name='inboxentry',
+            index=models.Index(fields=['user', '-last_activity', '-chat'], name='messenger_i_user_id_792f79_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inboxentry',
+            index=models.Index(condition=models.Q(('is_large', True), ('pinned', True), _connector='OR'), fields=['user'], name='inbox_side_entries'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.21 on 2026-10-19 04:13
+
+import django.core.validators
+from django.db import migrations
+import messenger.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0014_inbox_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='content',
+            field=messenger.fields.CompressedTextField(validators=[django.core.validators.MinLengthValidator(1, 'Сообщение не может быть пустым')], verbose_name='Текст сообщения'),
+        ),
+    ]
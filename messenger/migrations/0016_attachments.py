@@ -0,0 +1,57 @@
+# Generated by Django 4.2.21 on 2026-10-19 04:16
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('messenger', '0015_compressed_message_content'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Attachment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(max_length=255, upload_to='attachments/%Y/%m/', verbose_name='Файл')),
+                ('filename', models.CharField(max_length=255, verbose_name='Имя файла')),
+                ('content_type', models.CharField(blank=True, max_length=100, verbose_name='Тип содержимого')),
+                ('size', models.PositiveBigIntegerField(verbose_name='Размер, байт')),
+                ('sha256', models.CharField(max_length=64, verbose_name='SHA-256')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата загрузки')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='messenger.message', verbose_name='Сообщение')),
+            ],
+            options={
+                'verbose_name': 'Вложение',
+                'verbose_name_plural': 'Вложения',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255, verbose_name='Имя файла')),
+                ('content_type', models.CharField(blank=True, max_length=100, verbose_name='Тип содержимого')),
+                ('size', models.PositiveBigIntegerField(verbose_name='Размер, байт')),
+                ('sha256', models.CharField(blank=True, help_text='Если задан, finalize сверяет с ним загруженный файл', max_length=64, verbose_name='Ожидаемый SHA-256')),
+                ('received', models.PositiveBigIntegerField(default=0, verbose_name='Получено, байт')),
+                ('status', models.CharField(choices=[('uploading', 'Загружается'), ('complete', 'Завершена')], default='uploading', max_length=10, verbose_name='Статус')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата начала')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Последняя часть')),
+                ('attachment', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload_session', to='messenger.attachment', verbose_name='Вложение')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Загрузка вложения',
+                'verbose_name_plural': 'Загрузки вложений',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', 'updated_at'], name='messenger_u_status_473d7b_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.21 on 2026-10-19 04:21
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0016_attachments'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='Имя в хранилище')),
+                ('size', models.PositiveBigIntegerField(verbose_name='Размер, байт')),
+                ('refcount', models.PositiveIntegerField(default=0, verbose_name='Ссылок')),
+                ('referenced_at', models.DateTimeField(default=django.utils.timezone.now, help_text='gc_media не удаляет файлы, сохранённые позже срока ожидания', verbose_name='Последнее сохранение')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+            ],
+            options={
+                'verbose_name': 'Файл хранилища',
+                'verbose_name_plural': 'Файлы хранилища',
+                'ordering': ['-referenced_at'],
+                'indexes': [models.Index(fields=['refcount', 'referenced_at'], name='messenger_s_refcoun_36acfe_idx')],
+            },
+        ),
+    ]
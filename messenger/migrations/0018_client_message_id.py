@@ -0,0 +1,26 @@
+# Generated by Django 4.2.21 on 2026-10-19 04:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0017_stored_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='client_message_id',
+            field=models.CharField(blank=True, help_text='Ключ повторной отправки; очищается через CLIENT_MESSAGE_ID_RETENTION_HOURS', max_length=64, null=True, verbose_name='ID сообщения на клиенте'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('client_message_id__isnull', False)), fields=['created_at'], name='message_client_id_created'),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(condition=models.Q(('client_message_id__isnull', False)), fields=('author', 'chat', 'client_message_id'), name='unique_client_message_id'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.21 on 2026-10-19 04:43
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('messenger', '0018_client_message_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdSequence',
+            fields=[
+                ('name', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='Таблица')),
+                ('next_value', models.BigIntegerField(verbose_name='Следующий свободный id')),
+            ],
+            options={
+                'verbose_name': 'Последовательность id',
+                'verbose_name_plural': 'Последовательности id',
+            },
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='author',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='sent_messages', to=settings.AUTH_USER_MODEL, verbose_name='Автор'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='chat',
+            field=models.ForeignKey(db_constraint=False, help_text='Чат, к которому относится сообщение', on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='messenger.chat', verbose_name='Чат'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='likes',
+            field=models.ManyToManyField(db_constraint=False, related_name='liked_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='attachment',
+            field=models.OneToOneField(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload_session', to='messenger.attachment', verbose_name='Вложение'),
+        ),
+        migrations.CreateModel(
+            name='ChatShard',
+            fields=[
+                ('chat', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='placement', serialize=False, to='messenger.chat', verbose_name='Чат')),
+                ('shard', models.CharField(max_length=64, verbose_name='База')),
+                ('moving_to', models.CharField(blank=True, help_text='Пока идёт перенос, новые сообщения и лайки в чат не пишутся', max_length=64, verbose_name='Переносится в')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата изменения')),
+            ],
+            options={
+                'verbose_name': 'Размещение чата',
+                'verbose_name_plural': 'Размещение чатов',
+                'indexes': [models.Index(fields=['shard'], name='messenger_c_shard_b2d757_idx')],
+            },
+        ),
+    ]
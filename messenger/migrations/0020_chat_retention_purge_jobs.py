@@ -0,0 +1,47 @@
+# Generated by Django 4.2.21 on 2026-10-19 05:00
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0019_message_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PurgeJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('chat', 'Чат'), ('user', 'Пользователь'), ('expired', 'Истёкшие сообщения')], max_length=10, verbose_name='Что удаляем')),
+                ('target_id', models.BigIntegerField(blank=True, null=True, verbose_name='ID чата или пользователя')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает'), ('running', 'Выполняется'), ('done', 'Завершено')], default='pending', max_length=10, verbose_name='Статус')),
+                ('stage', models.CharField(blank=True, max_length=64, verbose_name='Этап')),
+                ('cursor', models.BigIntegerField(default=0, help_text='Наибольший обработанный id на этапе: продолжение начинается после него', verbose_name='Курсор')),
+                ('deleted', models.PositiveBigIntegerField(default=0, verbose_name='Удалено строк')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Последняя пачка')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата завершения')),
+            ],
+            options={
+                'verbose_name': 'Задание очистки',
+                'verbose_name_plural': 'Задания очистки',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='message_ttl_days',
+            field=models.PositiveIntegerField(blank=True, help_text='Исчезающие сообщения: более старые удаляет python manage.py purge --expired', null=True, validators=[django.core.validators.MinValueValidator(1)], verbose_name='Хранить сообщения, дней'),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(condition=models.Q(('message_ttl_days__isnull', False)), fields=['id'], name='chat_retention'),
+        ),
+        migrations.AddIndex(
+            model_name='purgejob',
+            index=models.Index(fields=['status', 'kind'], name='messenger_p_status_a04883_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.21 on 2026-10-19 05:08
+
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('messenger', '0021_changelog_members_kind'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.TextField(validators=[django.core.validators.MinLengthValidator(1)], verbose_name='Текст сообщения')),
+                ('send_at', models.DateTimeField(verbose_name='Отправить в')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает'), ('sent', 'Отправлено'), ('cancelled', 'Отменено'), ('failed', 'Не отправлено')], default='pending', max_length=10, verbose_name='Статус')),
+                ('message_id', models.BigIntegerField(blank=True, null=True, verbose_name='ID отправленного сообщения')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')),
+                ('last_error', models.CharField(blank=True, max_length=255, verbose_name='Последняя ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата отправки')),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scheduled_messages', to=settings.AUTH_USER_MODEL, verbose_name='Автор')),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scheduled_messages', to='messenger.chat', verbose_name='Чат')),
+            ],
+            options={
+                'verbose_name': 'Запланированное сообщение',
+                'verbose_name_plural': 'Запланированные сообщения',
+                'ordering': ['send_at', 'id'],
+                'indexes': [models.Index(condition=models.Q(('status', 'pending')), fields=['send_at', 'id'], name='scheduled_due'), models.Index(fields=['author', 'status', 'send_at'], name='messenger_s_author__740f5c_idx')],
+            },
+        ),
+    ]
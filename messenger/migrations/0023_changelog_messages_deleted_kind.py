@@ -0,0 +1,18 @@
+# Generated by Django 4.2.21 on 2026-10-19 06:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0022_scheduled_messages'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='changelogentry',
+            name='kind',
+            field=models.CharField(choices=[('message', 'Новое сообщение'), ('like', 'Лайк'), ('chat_rename', 'Переименование чата'), ('join', 'Вступление в чат'), ('profile', 'Изменение профиля'), ('members', 'Изменение состава группы'), ('messages_deleted', 'Удаление сообщений')], max_length=20, verbose_name='Тип'),
+        ),
+    ]
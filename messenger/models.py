@@ -1,6 +1,11 @@
+import uuid
+
 from django.db import models
-from django.core.validators import MinLengthValidator
+from django.utils import timezone
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.validators import MinLengthValidator, MinValueValidator
 from users.models import CustomUser
+from .fields import CompressedTextField
 
 
 class Chat(models.Model):
@@ -21,6 +26,11 @@ class Chat(models.Model):
         default=False,
         verbose_name='Группа'
     )
+    member_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Число участников',
+        help_text='Поддерживается сигналом m2m_changed, см. messenger/signals.py'
+    )
     created_at = models.DateTimeField(
         auto_now_add=True,
         verbose_name='Дата создания'
@@ -29,6 +39,18 @@ class Chat(models.Model):
         auto_now=True,
         verbose_name='Дата последнего обновления'
     )
+    last_activity_at = models.DateTimeField(
+        default=timezone.now,
+        verbose_name='Последняя активность',
+        help_text='Время последнего сообщения, см. messenger/inbox.py'
+    )
+    message_ttl_days = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(1)],
+        verbose_name='Хранить сообщения, дней',
+        help_text='Исчезающие сообщения: более старые удаляет python manage.py purge --expired'
+    )
 
     class Meta:
         verbose_name = 'Чат'
@@ -36,30 +58,37 @@ class Chat(models.Model):
         ordering = ['-updated_at']
         indexes = [
             models.Index(fields=['-updated_at']),
+            # Чаты с исчезающими сообщениями для purge --expired
+            models.Index(fields=['id'], condition=models.Q(message_ttl_days__isnull=False), name='chat_retention'),
         ]
 
 
 
 class Message(models.Model):
     """Модель сообщения в чате"""
+    # Без ограничений внешнего ключа: сообщения и лайки могут лежать в
+    # базе-шарде, где нет таблиц чатов и пользователей (messenger/sharding.py)
     chat = models.ForeignKey(
         Chat,
         on_delete=models.CASCADE,
         related_name='messages',
+        db_constraint=False,
         verbose_name='Чат',
         help_text='Чат, к которому относится сообщение'
     )
     likes = models.ManyToManyField(
         CustomUser,
-        related_name='liked_messages'
+        related_name='liked_messages',
+        db_constraint=False,
     )
     author = models.ForeignKey(
         CustomUser,
         on_delete=models.CASCADE,
         related_name='sent_messages',
+        db_constraint=False,
         verbose_name='Автор'
     )
-    content = models.TextField(
+    content = CompressedTextField(
         verbose_name='Текст сообщения',
         validators=[MinLengthValidator(
             1,
@@ -69,11 +98,474 @@ class Message(models.Model):
         auto_now_add=True,
         verbose_name='Дата отправки'
     )
+    client_message_id = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        verbose_name='ID сообщения на клиенте',
+        help_text='Ключ повторной отправки; очищается через CLIENT_MESSAGE_ID_RETENTION_HOURS'
+    )
 
     class Meta:
         verbose_name = 'Сообщение'
         verbose_name_plural = 'Сообщения'
         ordering = ['created_at']
+        constraints = [
+            # Повтор отправки находит исходное сообщение по этому индексу
+            models.UniqueConstraint(
+                fields=['author', 'chat', 'client_message_id'],
+                condition=models.Q(client_message_id__isnull=False),
+                name='unique_client_message_id',
+            ),
+        ]
         indexes = [
             models.Index(fields=['chat', 'created_at']),
+            # Для очистки устаревших ключей; строк в нём немного
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(client_message_id__isnull=False),
+                name='message_client_id_created',
+            ),
+        ]
+
+
+class RequestProfile(models.Model):
+    """Профиль отдельного запроса, снятый по требованию сотрудника"""
+    MODE_CHOICES = [
+        ('sample', 'Сэмплирование'),
+        ('cprofile', 'cProfile'),
+    ]
+
+    request_id = models.CharField(
+        max_length=32,
+        unique=True,
+        verbose_name='ID запроса'
+    )
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='request_profiles',
+        verbose_name='Пользователь'
+    )
+    method = models.CharField(max_length=10, verbose_name='Метод')
+    path = models.CharField(max_length=255, verbose_name='Путь')
+    view_name = models.CharField(max_length=100, blank=True, verbose_name='View')
+    status_code = models.PositiveSmallIntegerField(null=True, verbose_name='Код ответа')
+    mode = models.CharField(max_length=10, choices=MODE_CHOICES, verbose_name='Режим')
+    duration_ms = models.FloatField(verbose_name='Длительность, мс')
+    sample_count = models.PositiveIntegerField(default=0, verbose_name='Сэмплов')
+    collapsed_stacks = models.TextField(
+        blank=True,
+        verbose_name='Свёрнутые стеки',
+        help_text='Формат collapsed stacks для flamegraph'
+    )
+    stats = models.TextField(blank=True, verbose_name='Статистика cProfile')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата')
+
+    class Meta:
+        verbose_name = 'Профиль запроса'
+        verbose_name_plural = 'Профили запросов'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['view_name', '-created_at']),
         ]
+
+    def __str__(self):
+        return '%s %s (%s)' % (self.method, self.path, self.request_id)
+
+
+class ChangeLogEntry(models.Model):
+    """Запись журнала изменений для дельта-синхронизации клиентов"""
+    KIND_MESSAGE = 'message'
+    KIND_LIKE = 'like'
+    KIND_CHAT_RENAME = 'chat_rename'
+    KIND_JOIN = 'join'
+    KIND_PROFILE = 'profile'
+    KIND_MEMBERS = 'members'
+    KIND_MESSAGES_DELETED = 'messages_deleted'
+    KIND_CHOICES = [
+        (KIND_MESSAGE, 'Новое сообщение'),
+        (KIND_LIKE, 'Лайк'),
+        (KIND_CHAT_RENAME, 'Переименование чата'),
+        (KIND_JOIN, 'Вступление в чат'),
+        (KIND_PROFILE, 'Изменение профиля'),
+        (KIND_MEMBERS, 'Изменение состава группы'),
+        (KIND_MESSAGES_DELETED, 'Удаление сообщений'),
+    ]
+
+    # Глобальная монотонная последовательность: AUTOINCREMENT не переиспользует номера
+    seq = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, verbose_name='Тип')
+    chat = models.ForeignKey(
+        Chat,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        db_index=False,  # покрывается составными индексами ниже
+        related_name='changes',
+        verbose_name='Чат'
+    )
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        db_index=False,  # покрывается составными индексами ниже
+        related_name='changes',
+        verbose_name='Пользователь'
+    )
+    payload = models.JSONField(default=dict, encoder=DjangoJSONEncoder, verbose_name='Данные')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата')
+
+    class Meta:
+        verbose_name = 'Изменение'
+        verbose_name_plural = 'Журнал изменений'
+        ordering = ['seq']
+        indexes = [
+            models.Index(fields=['chat', 'seq']),
+            models.Index(fields=['user', 'seq']),
+        ]
+
+
+class ChangeLogCompaction(models.Model):
+    """Отметка об очистке журнала: записи до compacted_through удалены"""
+    compacted_through = models.BigIntegerField(verbose_name='Удалено до seq включительно')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата')
+
+    class Meta:
+        verbose_name = 'Очистка журнала изменений'
+        verbose_name_plural = 'Очистки журнала изменений'
+        ordering = ['-compacted_through']
+
+
+class Task(models.Model):
+    """Фоновая задача в очереди на базе БД, см. messenger/task_queue.py"""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'В очереди'),
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_DONE, 'Выполнена'),
+        (STATUS_FAILED, 'Ошибка'),
+    ]
+
+    name = models.CharField(max_length=100, verbose_name='Задача')
+    payload = models.JSONField(default=dict, encoder=DjangoJSONEncoder, verbose_name='Аргументы')
+    priority = models.SmallIntegerField(default=0, verbose_name='Приоритет', help_text='Чем больше, тем раньше')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name='Статус')
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')
+    max_attempts = models.PositiveSmallIntegerField(default=5, verbose_name='Максимум попыток')
+    run_at = models.DateTimeField(default=timezone.now, verbose_name='Запустить не раньше')
+    locked_by = models.CharField(max_length=64, blank=True, verbose_name='Воркер')
+    locked_at = models.DateTimeField(null=True, blank=True, verbose_name='Взята в работу')
+    last_error = models.TextField(blank=True, verbose_name='Последняя ошибка')
+    duration_ms = models.FloatField(null=True, blank=True, verbose_name='Длительность, мс')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='Дата завершения')
+
+    class Meta:
+        verbose_name = 'Фоновая задача'
+        verbose_name_plural = 'Фоновые задачи'
+        ordering = ['-priority', 'run_at']
+        indexes = [
+            models.Index(fields=['status', '-priority', 'run_at']),
+            models.Index(fields=['locked_by']),
+        ]
+
+    def __str__(self):
+        return '%s #%s (%s)' % (self.name, self.id, self.status)
+
+
+class InboxEntry(models.Model):
+    """Строка списка чатов пользователя (fan-out on write, см. messenger/inbox.py)"""
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='inbox_entries',
+        verbose_name='Пользователь',
+        # Выборки по пользователю покрывает индекс списка ниже
+        db_index=False
+    )
+    chat = models.ForeignKey(
+        Chat,
+        on_delete=models.CASCADE,
+        related_name='inbox_entries',
+        verbose_name='Чат'
+    )
+    last_activity = models.DateTimeField(verbose_name='Последняя активность')
+    unread = models.PositiveIntegerField(default=0, verbose_name='Непрочитано')
+    last_read_at = models.DateTimeField(null=True, blank=True, verbose_name='Прочитано до')
+    muted = models.BooleanField(default=False, verbose_name='Без уведомлений')
+    pinned = models.BooleanField(default=False, verbose_name='Закреплён')
+    is_large = models.BooleanField(
+        default=False,
+        verbose_name='Большая группа',
+        help_text='Активность и непрочитанные берутся из чата при чтении'
+    )
+
+    class Meta:
+        verbose_name = 'Строка списка чатов'
+        verbose_name_plural = 'Списки чатов'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'chat'], name='unique_inbox_entry'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-last_activity', '-chat']),
+            # Строки больших групп и закреплённые читаются целиком на каждой странице
+            models.Index(
+                fields=['user'],
+                condition=models.Q(is_large=True) | models.Q(pinned=True),
+                name='inbox_side_entries',
+            ),
+        ]
+
+    def __str__(self):
+        return '%s: %s' % (self.user_id, self.chat_id)
+
+
+
+class Attachment(models.Model):
+    """Файл, прикреплённый к сообщению"""
+    message = models.ForeignKey(
+        Message,
+        on_delete=models.CASCADE,
+        related_name='attachments',
+        verbose_name='Сообщение'
+    )
+    file = models.FileField(upload_to='attachments/%Y/%m/', max_length=255, verbose_name='Файл')
+    filename = models.CharField(max_length=255, verbose_name='Имя файла')
+    content_type = models.CharField(max_length=100, blank=True, verbose_name='Тип содержимого')
+    size = models.PositiveBigIntegerField(verbose_name='Размер, байт')
+    sha256 = models.CharField(max_length=64, verbose_name='SHA-256')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата загрузки')
+
+    class Meta:
+        verbose_name = 'Вложение'
+        verbose_name_plural = 'Вложения'
+        ordering = ['id']
+
+    def __str__(self):
+        return self.filename
+
+
+class UploadSession(models.Model):
+    """Незавершённая загрузка вложения по частям, см. messenger/uploads.py"""
+    STATUS_UPLOADING = 'uploading'
+    STATUS_COMPLETE = 'complete'
+    STATUS_CHOICES = [
+        (STATUS_UPLOADING, 'Загружается'),
+        (STATUS_COMPLETE, 'Завершена'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='upload_sessions',
+        verbose_name='Пользователь'
+    )
+    filename = models.CharField(max_length=255, verbose_name='Имя файла')
+    content_type = models.CharField(max_length=100, blank=True, verbose_name='Тип содержимого')
+    size = models.PositiveBigIntegerField(verbose_name='Размер, байт')
+    sha256 = models.CharField(
+        max_length=64,
+        blank=True,
+        verbose_name='Ожидаемый SHA-256',
+        help_text='Если задан, finalize сверяет с ним загруженный файл'
+    )
+    received = models.PositiveBigIntegerField(default=0, verbose_name='Получено, байт')
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=STATUS_UPLOADING, verbose_name='Статус'
+    )
+    attachment = models.OneToOneField(
+        Attachment,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        db_constraint=False,  # вложение может быть в базе-шарде
+        related_name='upload_session',
+        verbose_name='Вложение'
+    )
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата начала')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Последняя часть')
+
+    class Meta:
+        verbose_name = 'Загрузка вложения'
+        verbose_name_plural = 'Загрузки вложений'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'updated_at']),
+        ]
+
+    def __str__(self):
+        return '%s (%d из %d)' % (self.filename, self.received, self.size)
+
+
+class StoredBlob(models.Model):
+    """Файл хранилища по хешу содержимого и число ссылок на него, см. messenger_project/storage.py"""
+    name = models.CharField(max_length=255, unique=True, verbose_name='Имя в хранилище')
+    size = models.PositiveBigIntegerField(verbose_name='Размер, байт')
+    refcount = models.PositiveIntegerField(default=0, verbose_name='Ссылок')
+    referenced_at = models.DateTimeField(
+        default=timezone.now,
+        verbose_name='Последнее сохранение',
+        help_text='gc_media не удаляет файлы, сохранённые позже срока ожидания'
+    )
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+
+    class Meta:
+        verbose_name = 'Файл хранилища'
+        verbose_name_plural = 'Файлы хранилища'
+        ordering = ['-referenced_at']
+        indexes = [
+            models.Index(fields=['refcount', 'referenced_at']),
+        ]
+
+    def __str__(self):
+        return '%s (%d)' % (self.name, self.refcount)
+
+
+class ChatShard(models.Model):
+    """База, в которой лежат сообщения чата, см. messenger/sharding.py"""
+    chat = models.OneToOneField(
+        Chat,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='placement',
+        verbose_name='Чат'
+    )
+    shard = models.CharField(max_length=64, verbose_name='База')
+    moving_to = models.CharField(
+        max_length=64,
+        blank=True,
+        verbose_name='Переносится в',
+        help_text='Пока идёт перенос, новые сообщения и лайки в чат не пишутся'
+    )
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата изменения')
+
+    class Meta:
+        verbose_name = 'Размещение чата'
+        verbose_name_plural = 'Размещение чатов'
+        indexes = [
+            models.Index(fields=['shard']),
+        ]
+
+    def __str__(self):
+        return '%s: %s' % (self.chat_id, self.shard)
+
+
+class IdSequence(models.Model):
+    """Общая последовательность id для таблиц, разнесённых по нескольким базам"""
+    name = models.CharField(max_length=64, primary_key=True, verbose_name='Таблица')
+    next_value = models.BigIntegerField(verbose_name='Следующий свободный id')
+
+    class Meta:
+        verbose_name = 'Последовательность id'
+        verbose_name_plural = 'Последовательности id'
+
+    def __str__(self):
+        return '%s: %d' % (self.name, self.next_value)
+
+
+class PurgeJob(models.Model):
+    """Удаление чата, пользователя или истёкших сообщений пачками, см. messenger/purge.py"""
+    KIND_CHAT = 'chat'
+    KIND_USER = 'user'
+    KIND_EXPIRED = 'expired'
+    KIND_CHOICES = [
+        (KIND_CHAT, 'Чат'),
+        (KIND_USER, 'Пользователь'),
+        (KIND_EXPIRED, 'Истёкшие сообщения'),
+    ]
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Ожидает'),
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_DONE, 'Завершено'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, verbose_name='Что удаляем')
+    # Не внешний ключ: строка задания переживает удаляемый объект
+    target_id = models.BigIntegerField(null=True, blank=True, verbose_name='ID чата или пользователя')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name='Статус')
+    stage = models.CharField(max_length=64, blank=True, verbose_name='Этап')
+    cursor = models.BigIntegerField(
+        default=0,
+        verbose_name='Курсор',
+        help_text='Наибольший обработанный id на этапе: продолжение начинается после него'
+    )
+    deleted = models.PositiveBigIntegerField(default=0, verbose_name='Удалено строк')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Последняя пачка')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='Дата завершения')
+
+    class Meta:
+        verbose_name = 'Задание очистки'
+        verbose_name_plural = 'Задания очистки'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'kind']),
+        ]
+
+    def __str__(self):
+        return '%s %s (%s)' % (self.kind, self.target_id or '', self.status)
+
+
+class ScheduledMessage(models.Model):
+    """Сообщение, которое будет отправлено в назначенное время, см. messenger/scheduled.py"""
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_CANCELLED = 'cancelled'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Ожидает'),
+        (STATUS_SENT, 'Отправлено'),
+        (STATUS_CANCELLED, 'Отменено'),
+        (STATUS_FAILED, 'Не отправлено'),
+    ]
+
+    chat = models.ForeignKey(
+        Chat,
+        on_delete=models.CASCADE,
+        related_name='scheduled_messages',
+        verbose_name='Чат'
+    )
+    author = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='scheduled_messages',
+        verbose_name='Автор'
+    )
+    content = models.TextField(validators=[MinLengthValidator(1)], verbose_name='Текст сообщения')
+    send_at = models.DateTimeField(verbose_name='Отправить в')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name='Статус')
+    # Не внешний ключ: сообщение может лежать в шарде
+    message_id = models.BigIntegerField(null=True, blank=True, verbose_name='ID отправленного сообщения')
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')
+    last_error = models.CharField(max_length=255, blank=True, verbose_name='Последняя ошибка')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name='Дата отправки')
+
+    class Meta:
+        verbose_name = 'Запланированное сообщение'
+        verbose_name_plural = 'Запланированные сообщения'
+        ordering = ['send_at', 'id']
+        indexes = [
+            # Диспетчер читает только ожидающие по времени: отправленные в индекс не попадают
+            models.Index(fields=['send_at', 'id'], condition=models.Q(status='pending'), name='scheduled_due'),
+            models.Index(fields=['author', 'status', 'send_at']),
+        ]
+
+    @property
+    def client_message_id(self):
+        """Ключ повторной отправки: после перезапуска диспетчера сообщение не задвоится"""
+        return 'scheduled:%d' % self.pk
+
+    def __str__(self):
+        return '%s → чат %s в %s (%s)' % (self.author_id, self.chat_id, self.send_at, self.status)
@@ -0,0 +1,293 @@
+"""Удаление больших объёмов пачками: чаты, пользователи, исчезающие сообщения
+
+chat.delete() и user.delete() собирают каскадом все сообщения и лайки в
+память и держат блокировку записи, пока не удалят всё. Здесь строки
+удаляются пачками по CHUNK_SIZE: id пачки выбираются по индексу,
+удаляются диапазоном первичного ключа без каскада (QuerySet._raw_delete),
+каждая пачка — своя короткая транзакция, а между пачками пауза PAUSE_MS,
+чтобы отправка сообщений успевала взять блокировку.
+
+PurgeJob запоминает этап и курсор (наибольший удалённый id на этапе):
+прерванное удаление продолжается с того же места командой
+python manage.py purge --resume или фоновой задачей
+messenger.run_purge_job, которая работает не дольше TASK_SECONDS и ставит
+продолжение в очередь. Удаление идемпотентно, повтор пачки безопасен.
+
+Этапы:
+- чат: запланированные сообщения, строки списков чатов и участники (чат
+  сразу пропадает у пользователей), сообщения с лайками и вложениями в
+  базе чата, журнал изменений, затем размещение и сам чат;
+- пользователь: его лайки и сообщения во всех базах, запланированные
+  сообщения, списки чатов, журнал, участие в чатах с пересчётом member_count, затем сам
+  пользователь обычным delete() — оставшиеся связи невелики;
+- истёкшие сообщения: по чатам с message_ttl_days сообщения и записи
+  журнала о них старше срока, от старых к новым.
+
+Журнал изменений не получает дыр, после которых клиенту нужна полная
+пересинхронизация: об удалённых сообщениях пишется запись
+KIND_MESSAGES_DELETED, и клиенты удаляют их у себя, а из журнала
+удаляются только записи с содержимым удалённого — тексты сообщений,
+лайки и профиль удалённого пользователя. Его остальные записи
+(переименования, вступления, состав групп) остаются без user_id, а из
+каждого его чата он уходит записью KIND_MEMBERS.
+
+Файлы вложений освобождает python manage.py gc_media, когда на них не
+остаётся ссылок.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils import timezone
+
+from users.models import CustomUser
+from . import changelog, inbox, sharding, task_queue
+from .models import (
+    Attachment, ChangeLogEntry, Chat, ChatShard, InboxEntry, Message, PurgeJob, ScheduledMessage, UploadSession,
+)
+from .signals import refresh_member_counts
+
+DEFAULTS = {
+    'CHUNK_SIZE': 1000,
+    'PAUSE_MS': 50,
+    'TASK_SECONDS': 60,
+}
+
+TASK_NAME = 'messenger.run_purge_job'
+
+
+def get_config():
+    """Настройки очистки с подставленными значениями по умолчанию"""
+    return {**DEFAULTS, **getattr(settings, 'PURGE', {})}
+
+
+def schedule(kind, target_id=None, background=True):
+    """Задание очистки; незавершённое задание с теми же параметрами не дублируется
+
+    С background задание ставится в очередь фоновых задач.
+    """
+    with transaction.atomic():
+        job = PurgeJob.objects.filter(kind=kind, target_id=target_id).exclude(status=PurgeJob.STATUS_DONE).first()
+        if job is None:
+            job = PurgeJob.objects.create(kind=kind, target_id=target_id)
+        if background:
+            task_queue.enqueue(TASK_NAME, {'job_id': job.pk}, priority=-1)
+    return job
+
+
+def _next_ids(queryset, db, cursor):
+    """id следующей пачки queryset после cursor по возрастанию"""
+    return list(
+        queryset.using(db).filter(pk__gt=cursor).order_by('pk').values_list('pk', flat=True)[:get_config()['CHUNK_SIZE']]
+    )
+
+
+def _range_step(queryset, db=DEFAULT_DB_ALIAS):
+    """Шаг этапа: следующая пачка queryset удаляется диапазоном pk"""
+    def step(job):
+        ids = _next_ids(queryset, db, job.cursor)
+        if not ids:
+            return None
+        with transaction.atomic(using=db):
+            count = queryset.filter(pk__gte=ids[0], pk__lte=ids[-1])._raw_delete(db)
+        job.cursor = ids[-1]
+        return count
+    return step
+
+
+def _delete_messages(db, ids, rows, announce=False):
+    """Удаляет сообщения rows (их id — ids) с лайками и вложениями; число строк
+
+    С announce в журнал пишется их удаление — до самого удаления и своей
+    транзакцией: журнал лежит в default, а сообщения могут быть в шарде.
+    Прерванная пачка не останется неизвестной клиентам, а повтор запишет
+    удаление ещё раз, это безопасно.
+    """
+    if announce:
+        with transaction.atomic():
+            changelog.record_deleted(rows.using(db).values_list('pk', 'chat_id'))
+    attachment_ids = list(Attachment.objects.using(db).filter(message_id__in=ids).values_list('pk', flat=True))
+    with transaction.atomic(using=db):
+        count = Attachment.objects.filter(pk__in=attachment_ids)._raw_delete(db) if attachment_ids else 0
+        count += sharding.likes(db).filter(message_id__in=ids)._raw_delete(db)
+        count += rows._raw_delete(db)
+    if attachment_ids:
+        # Загрузки лежат в default, а каскад SET_NULL мы обошли
+        UploadSession.objects.filter(attachment_id__in=attachment_ids).update(attachment=None)
+    return count
+
+
+def _messages_step(messages, db, announce=False):
+    """Шаг этапа: следующая пачка сообщений вместе с лайками и вложениями"""
+    def step(job):
+        ids = _next_ids(messages, db, job.cursor)
+        if not ids:
+            return None
+        count = _delete_messages(db, ids, messages.filter(pk__gte=ids[0], pk__lte=ids[-1]), announce)
+        job.cursor = ids[-1]
+        return count
+    return step
+
+
+def _once(action):
+    """Шаг этапа из одного действия"""
+    def step(job):
+        if job.cursor:
+            return None
+        count = action()
+        job.cursor = 1
+        return count
+    return step
+
+
+def _memberships_step(user_id):
+    """Участие пользователя в чатах; member_count чатов пересчитывается после каждой пачки"""
+    through = Chat.participants.through
+    memberships = through.objects.filter(customuser_id=user_id)
+    delete = _range_step(memberships)
+
+    def step(job):
+        chat_ids = list(memberships.filter(pk__gt=job.cursor).order_by('pk').values_list('chat_id', flat=True)
+                        [:get_config()['CHUNK_SIZE']])
+        with transaction.atomic():
+            count = delete(job)
+            # Клиенты остальных участников убирают пользователя из чата
+            changelog.record_many([
+                ChangeLogEntry(kind=ChangeLogEntry.KIND_MEMBERS, chat_id=chat_id, payload={'removed': [user_id]})
+                for chat_id in chat_ids
+            ])
+        if chat_ids:
+            refresh_member_counts(chat_ids)
+            inbox.sync_fanout_mode(chat_ids)
+        return count
+    return step
+
+
+# Записи журнала с содержимым удаляемого пользователя; остальные его
+# записи остаются без user_id
+PERSONAL_CHANGES = (ChangeLogEntry.KIND_MESSAGE, ChangeLogEntry.KIND_LIKE, ChangeLogEntry.KIND_PROFILE)
+
+
+def _user_changes_step(user_id):
+    """Записи журнала пользователя: содержимое удаляется, авторство снимается"""
+    changes = ChangeLogEntry.objects.filter(user_id=user_id)
+
+    def step(job):
+        ids = _next_ids(changes, DEFAULT_DB_ALIAS, job.cursor)
+        if not ids:
+            return None
+        batch = changes.filter(seq__gte=ids[0], seq__lte=ids[-1])
+        with transaction.atomic():
+            count = batch.filter(kind__in=PERSONAL_CHANGES)._raw_delete(DEFAULT_DB_ALIAS)
+            count += batch.update(user_id=None)
+        job.cursor = ids[-1]
+        return count
+    return step
+
+
+def _expired_step(job):
+    """Пачка истёкших сообщений или записей журнала о них после курсора (id чата)"""
+    chunk_size = get_config()['CHUNK_SIZE']
+    chats = Chat.objects.filter(message_ttl_days__isnull=False).order_by('pk')
+    for chat_id, days in chats.filter(pk__gt=job.cursor).values_list('pk', 'message_ttl_days').iterator():
+        cutoff = timezone.now() - timedelta(days=days)
+        db = sharding.db_for_chat(chat_id)
+        ids = list(Message.objects.using(db).filter(chat_id=chat_id, created_at__lt=cutoff)
+                   .order_by('created_at').values_list('pk', flat=True)[:chunk_size])
+        if ids:
+            return _delete_messages(db, ids, Message.objects.filter(pk__in=ids), announce=True)
+        # В журнале остались тексты удалённых сообщений: запись о сообщении
+        # не старше его самого, так что всё это — записи об удалённых
+        changes = ChangeLogEntry.objects.filter(
+            chat_id=chat_id, kind=ChangeLogEntry.KIND_MESSAGE, created_at__lt=cutoff)
+        seqs = list(changes.order_by('seq').values_list('seq', flat=True)[:chunk_size])
+        if seqs:
+            with transaction.atomic():
+                return changes.filter(seq__gte=seqs[0], seq__lte=seqs[-1])._raw_delete(DEFAULT_DB_ALIAS)
+        job.cursor = chat_id
+    return None
+
+
+def _chat_db(chat_id):
+    """База сообщений чата; для уже удалённого чата размещение не создаётся"""
+    if not Chat.objects.filter(pk=chat_id).exists():
+        return DEFAULT_DB_ALIAS
+    return sharding.db_for_chat(chat_id)
+
+
+def _finish_chat(chat_id):
+    def action():
+        # Сообщения, отправленные, пока шли предыдущие этапы
+        sharding.delete_messages(_chat_db(chat_id), chat_id=chat_id)
+        with transaction.atomic():
+            ChatShard.objects.filter(chat_id=chat_id)._raw_delete(DEFAULT_DB_ALIAS)
+            return Chat.objects.filter(pk=chat_id)._raw_delete(DEFAULT_DB_ALIAS)
+    return action
+
+
+def _finish_user(user_id):
+    def action():
+        return CustomUser.objects.filter(pk=user_id).delete()[0]
+    return action
+
+
+def stages(job):
+    """[(этап, шаг)] задания по порядку; шаг удаляет пачку и возвращает
+    число строк или None, когда этап закончен"""
+    target = job.target_id
+    if job.kind == PurgeJob.KIND_CHAT:
+        db = _chat_db(target)
+        return [
+            # Первыми, чтобы диспетчер не отправлял в удаляемый чат
+            ('scheduled', _range_step(ScheduledMessage.objects.filter(chat_id=target))),
+            ('inbox', _range_step(InboxEntry.objects.filter(chat_id=target))),
+            ('members', _range_step(Chat.participants.through.objects.filter(chat_id=target))),
+            ('messages', _messages_step(Message.objects.filter(chat_id=target), db)),
+            ('changes', _range_step(ChangeLogEntry.objects.filter(chat_id=target))),
+            ('chat', _once(_finish_chat(target))),
+        ]
+    if job.kind == PurgeJob.KIND_USER:
+        databases = sharding.message_databases()
+        return [
+            *[('likes:%s' % db, _range_step(Message.likes.through.objects.filter(customuser_id=target), db))
+              for db in databases],
+            *[('messages:%s' % db, _messages_step(Message.objects.filter(author_id=target), db, announce=True))
+              for db in databases],
+            ('scheduled', _range_step(ScheduledMessage.objects.filter(author_id=target))),
+            ('inbox', _range_step(InboxEntry.objects.filter(user_id=target))),
+            ('changes', _user_changes_step(target)),
+            ('members', _memberships_step(target)),
+            ('user', _once(_finish_user(target))),
+        ]
+    return [('expired', _expired_step)]
+
+
+def run(job, seconds=None):
+    """Выполняет задание с сохранённого этапа; False, если остановлено через seconds секунд"""
+    if job.status == PurgeJob.STATUS_DONE:
+        return True
+    deadline = time.monotonic() + seconds if seconds is not None else None
+    pause = get_config()['PAUSE_MS'] / 1000
+    plan = stages(job)
+    names = [name for name, _ in plan]
+    # Этап, которого нет в плане (например, изменился список шардов), — заново
+    start = names.index(job.stage) if job.stage in names else 0
+    job.status = PurgeJob.STATUS_RUNNING
+    for name, step in plan[start:]:
+        if job.stage != name:
+            job.stage, job.cursor = name, 0
+        job.save(update_fields=['status', 'stage', 'cursor', 'updated_at'])
+        while True:
+            count = step(job)
+            if count is None:
+                break
+            job.deleted += count
+            job.save(update_fields=['cursor', 'deleted', 'updated_at'])
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(pause)
+    job.status = PurgeJob.STATUS_DONE
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'finished_at', 'updated_at'])
+    return True
@@ -0,0 +1,218 @@
+"""Запланированные сообщения и диспетчер их отправки
+
+POST /api/v1/messages/scheduled/ сохраняет ScheduledMessage со сроком
+send_at; ожидающие расписания лежат в частичном индексе scheduled_due по
+(send_at, id). Диспетчер (python manage.py run_scheduler) не опрашивает
+таблицу каждую секунду: он держит в куче (heapq) сроки ближайшего окна
+LOOKAHEAD_SECONDS, но не больше PRELOAD штук, и спит до ближайшего
+срока. Окно дочитывается по индексу с места, где закончилось прошлое
+(keyset по (send_at, id)), поэтому сотни тысяч расписаний не загружаются
+в память разом.
+
+Раз в REFRESH_SECONDS диспетчер подхватывает расписания, созданные после
+загрузки окна (id больше последнего виденного — короткий проход по
+первичному ключу), и страховочно забирает ожидающие, срок которых прошёл
+дольше двух интервалов назад, но которых нет в куче.
+
+Наступившие расписания отправляются пачками по BATCH_SIZE через
+services.send_batch — тот же путь, что у POST /api/v1/messages/, только
+пачкой. Ключ повторной отправки у расписания свой (scheduled:<id>):
+если диспетчер упал после отправки, но до отметки о ней, после
+перезапуска send_batch найдёт уже отправленное сообщение и не создаст
+второе. Перенос чата между шардами откладывает отправку на
+RETRY_SECONDS, другие ошибки — тоже, пока не кончатся MAX_ATTEMPTS.
+Если автор к сроку уже не участник чата, сообщение не отправляется.
+
+Диспетчер должен работать в одном процессе: второй не задвоит
+сообщения, но будет делать ту же работу.
+"""
+import heapq
+import logging
+import sys
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from . import services, sharding
+from .models import Chat, ScheduledMessage
+
+logger = logging.getLogger('messenger.scheduled')
+
+DEFAULTS = {
+    'BATCH_SIZE': 500,
+    'LOOKAHEAD_SECONDS': 3600,
+    'PRELOAD': 10000,
+    'REFRESH_SECONDS': 5.0,
+    'RETRY_SECONDS': 5,
+    'MAX_ATTEMPTS': 5,
+    'MAX_DELAY_DAYS': 365,
+    'MAX_PENDING_PER_USER': 1000,
+}
+
+# Столько символов ошибки сохраняем в last_error
+MAX_ERROR_LENGTH = 255
+
+
+def get_config():
+    """Настройки запланированных сообщений с подставленными значениями по умолчанию"""
+    return {**DEFAULTS, **getattr(settings, 'SCHEDULED_MESSAGES', {})}
+
+
+def pending():
+    return ScheduledMessage.objects.filter(status=ScheduledMessage.STATUS_PENDING)
+
+
+def cancel(author, pk):
+    """Отменяет ожидающее расписание автора; False, если его нет или оно уже отправлено"""
+    return bool(pending().filter(pk=pk, author=author).update(status=ScheduledMessage.STATUS_CANCELLED))
+
+
+def deliver(ids, now=None):
+    """Отправляет ожидающие расписания ids одной пачкой
+
+    Возвращает (отправлено, не отправлено, отложено) и отложенные
+    расписания — их срок перенесён на RETRY_SECONDS.
+    """
+    config = get_config()
+    now = now or timezone.now()
+    schedules = list(pending().filter(pk__in=ids).select_related('chat', 'author').order_by('send_at', 'id'))
+    if not schedules:
+        return (0, 0, 0), []
+    # Одна выборка участия на пачку: лишние пары отсекает проверка ниже
+    members = set(Chat.participants.through.objects.filter(
+        chat_id__in={item.chat_id for item in schedules},
+        customuser_id__in={item.author_id for item in schedules},
+    ).values_list('chat_id', 'customuser_id'))
+    allowed, failed, retry = [], [], []
+    for item in schedules:
+        if (item.chat_id, item.author_id) in members:
+            allowed.append(item)
+        else:
+            item.status, item.last_error = ScheduledMessage.STATUS_FAILED, 'Автор больше не участник чата'
+            failed.append(item)
+
+    results = services.send_batch([
+        (item.chat, item.author, item.content, item.client_message_id) for item in allowed
+    ])
+    sent = []
+    for item, result in zip(allowed, results):
+        item.attempts += 1
+        if not isinstance(result, Exception):
+            item.status, item.message_id, item.sent_at = ScheduledMessage.STATUS_SENT, result.pk, now
+            sent.append(item)
+            continue
+        item.last_error = str(result)[:MAX_ERROR_LENGTH]
+        if isinstance(result, sharding.ChatMoving) or item.attempts < config['MAX_ATTEMPTS']:
+            item.send_at = now + timedelta(seconds=config['RETRY_SECONDS'])
+            retry.append(item)
+        else:
+            logger.error('Запланированное сообщение #%s не отправлено: %s', item.pk, item.last_error)
+            item.status = ScheduledMessage.STATUS_FAILED
+            failed.append(item)
+
+    # Отправленное отмечаем в любом случае, а неудачи — только если
+    # расписание не отменили, пока шла отправка
+    ScheduledMessage.objects.bulk_update(sent, ['status', 'message_id', 'sent_at', 'attempts'])
+    pending().bulk_update(failed + retry, ['status', 'send_at', 'attempts', 'last_error'])
+    return (len(sent), len(failed), len(retry)), retry
+
+
+class Dispatcher:
+    """Куча ближайших сроков отправки (send_at, id)
+
+    В куче все ожидающие расписания с ключом не больше _horizon, кроме уже
+    отправленных: окно дочитывается с _horizon по индексу scheduled_due.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or get_config()
+        self._heap = []
+        self._queued = set()
+        self._horizon = None
+        self._last_id = None
+        self._refresh_at = None
+        self.counters = {'sent': 0, 'failed': 0, 'retried': 0}
+
+    def _push(self, send_at, pk):
+        if pk in self._queued or self._horizon is None or (send_at, pk) > self._horizon:
+            return
+        heapq.heappush(self._heap, (send_at, pk))
+        self._queued.add(pk)
+
+    def _fill(self, now):
+        """Дочитывает окно, когда куча опустела наполовину или окно кончается"""
+        preload = self.config['PRELOAD']
+        lookahead = timedelta(seconds=self.config['LOOKAHEAD_SECONDS'])
+        if self._horizon is not None and (len(self._heap) >= preload // 2
+                                          or self._horizon[0] >= now + lookahead / 2):
+            return
+        if self._last_id is None:
+            # Созданное после этого момента подхватит _refresh
+            self._last_id = ScheduledMessage.objects.aggregate(last=Max('id'))['last'] or 0
+        end = now + lookahead
+        rows = pending().filter(send_at__lte=end)
+        if self._horizon is not None:
+            send_at, pk = self._horizon
+            rows = rows.filter(Q(send_at__gt=send_at) | Q(send_at=send_at, id__gt=pk))
+        limit = preload - len(self._heap)
+        rows = list(rows.order_by('send_at', 'id').values_list('send_at', 'id')[:limit])
+        # Окно не поместилось — горизонт на последнем загруженном, иначе на конце окна
+        self._horizon = rows[-1] if len(rows) == limit else (end, sys.maxsize)
+        for send_at, pk in rows:
+            self._push(send_at, pk)
+
+    def _refresh(self, now):
+        """Новые расписания внутри окна и страховка от пропущенных"""
+        for pk, send_at in pending().filter(id__gt=self._last_id).order_by('id').values_list('id', 'send_at'):
+            self._push(send_at, pk)
+            self._last_id = pk
+        overdue = now - timedelta(seconds=2 * self.config['REFRESH_SECONDS'])
+        # Обычно пусто: наступившее из кучи отправляется в том же проходе, а
+        # то, что дальше горизонта, дочитает _fill
+        send_at, pk = self._horizon
+        missed = pending().filter(Q(send_at__lt=send_at) | Q(send_at=send_at, id__lte=pk), send_at__lte=overdue)
+        missed = missed.order_by('send_at', 'id')
+        for send_at, pk in missed.values_list('send_at', 'id')[:self.config['BATCH_SIZE']]:
+            if pk not in self._queued:
+                logger.warning('Запланированное сообщение #%s подхвачено с опозданием', pk)
+                heapq.heappush(self._heap, (send_at, pk))
+                self._queued.add(pk)
+
+    def dispatch_due(self, now):
+        """Отправляет наступившие расписания пачками; их число"""
+        total = 0
+        while self._heap and self._heap[0][0] <= now:
+            ids = []
+            while self._heap and self._heap[0][0] <= now and len(ids) < self.config['BATCH_SIZE']:
+                _, pk = heapq.heappop(self._heap)
+                self._queued.discard(pk)
+                ids.append(pk)
+            (sent, failed, retried), retry = deliver(ids, now)
+            for item in retry:
+                self._push(item.send_at, item.pk)
+            self.counters['sent'] += sent
+            self.counters['failed'] += failed
+            self.counters['retried'] += retried
+            total += len(ids)
+        return total
+
+    def tick(self, now=None):
+        """Один проход диспетчера; сколько секунд можно спать до следующего"""
+        clock = timezone.now if now is None else (lambda: now)
+        now = clock()
+        self._fill(now)
+        if self._refresh_at is None or now >= self._refresh_at:
+            self._refresh(now)
+            self._refresh_at = now + timedelta(seconds=self.config['REFRESH_SECONDS'])
+        self.dispatch_due(now)
+        wake = self._refresh_at
+        if self._heap:
+            wake = min(wake, self._heap[0][0])
+        # Отправка могла занять время: считаем от текущего момента
+        return max((wake - clock()).total_seconds(), 0)
+
+    def stats(self):
+        """Отправлено, не отправлено, отложено и сколько сроков в куче"""
+        return {**self.counters, 'queued': len(self._heap), 'horizon': self._horizon and self._horizon[0]}
@@ -1,9 +1,35 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Max
 from users.models import CustomUser
 from rest_framework import serializers
-from .models import Message, Chat
+from . import changelog, membership, scheduled, sharding, uploads
+from .models import Attachment, ChangeLogEntry, InboxEntry, Message, Chat, ScheduledMessage, UploadSession
 from users.serializers import UserSerializer
+from .fast_serializers import liker_ids_for, serialize_messages, serialize_messages_normalized, wants_normalized
+from .services import send_message
+from django.utils import timezone
 from django.utils.timesince import timesince
 
+# Сколько участников показывать в ответе о чате
+PARTICIPANTS_PREVIEW_SIZE = 10
+
+
+class AttachmentSerializer(serializers.ModelSerializer):
+    """Вложение сообщения"""
+    url = serializers.FileField(source='file', read_only=True)
+
+    class Meta:
+        model = Attachment
+        fields = [
+            'id',
+            'url',
+            'filename',
+            'content_type',
+            'size',
+        ]
+
 
 class MessageSerializer(serializers.ModelSerializer):
     """Сериализатор для отображения сообщений"""
@@ -11,6 +37,7 @@ class MessageSerializer(serializers.ModelSerializer):
     chat_id = serializers.IntegerField(read_only=True)
     liked = serializers.SerializerMethodField()
     liked_by = serializers.SerializerMethodField()
+    attachments = AttachmentSerializer(many=True, read_only=True)
 
     class Meta:
         model = Message
@@ -21,19 +48,23 @@ class MessageSerializer(serializers.ModelSerializer):
             'content',
             'created_at',
             'liked',
-            'liked_by'
+            'liked_by',
+            'attachments',
         ]
 
     def get_liked(self, obj):
         request = self.context.get('request')
         if not request or not hasattr(request, 'user'):
             return False
-        return obj.likes.filter(id=request.user.id).exists()
+        # Через таблицу лайков в базе сообщения: пользователи могут быть в другой
+        return sharding.likes(obj._state.db).filter(message_id=obj.pk, customuser_id=request.user.id).exists()
 
     def get_liked_by(self, obj):
+        liker_ids = list(
+            sharding.likes(obj._state.db).filter(message_id=obj.pk).values_list('customuser_id', flat=True))
         return [
             user.first_name or user.phone_number
-            for user in obj.likes.all()
+            for user in CustomUser.objects.filter(id__in=liker_ids)
         ]
 
 
@@ -41,6 +72,11 @@ class MessageCreateSerializer(serializers.ModelSerializer):
     """Сериализует данные для создания новых сообщений"""
     chat_id = serializers.IntegerField(write_only=True)
     content = serializers.CharField()
+    client_message_id = serializers.CharField(
+        max_length=64,
+        required=False,
+        help_text='Ключ повторной отправки: повтор с тем же ключом вернёт исходное сообщение'
+    )
 
     class Meta:
         model = Message
@@ -48,7 +84,10 @@ class MessageCreateSerializer(serializers.ModelSerializer):
             'id',
             'content',
             'chat_id',
+            'client_message_id',
         ]
+        # Уникальность ключа проверяет send_message: повтор — не ошибка
+        validators = []
 
     def validate_chat_id(self, value):
         if not Chat.objects.filter(id=value).exists():
@@ -59,10 +98,8 @@ class MessageCreateSerializer(serializers.ModelSerializer):
         chat_id = validated_data.pop('chat_id')
         chat = Chat.objects.get(id=chat_id)
         author = self.context['request'].user
-        return Message.objects.create(
-            chat=chat,
-            author=author,
-            content=validated_data['content']
+        return send_message(
+            chat, author, validated_data['content'], client_message_id=validated_data.get('client_message_id'),
         )
 
 
@@ -106,18 +143,25 @@ class ChatListSerializer(serializers.ModelSerializer):
         return None
 
     def get_last_message(self, obj):
-        last_message = Message.objects.filter(chat=obj).order_by('-created_at').first()
+        last_message = sharding.messages(obj.pk).order_by('-created_at').first()
         if last_message:
             return last_message.content
         return ''
 
     def get_last_time(self, obj):
-        last_message = Message.objects.filter(chat=obj).order_by('-created_at').first()
+        last_message = sharding.messages(obj.pk).order_by('-created_at').first()
         if last_message:
             return timesince(last_message.created_at)
         return None
 
 
+def participants_preview(chat):
+    """Номера первых участников чата; полный список — в /participants/"""
+    return list(
+        chat.participants.order_by('id').values_list('phone_number', flat=True)[:PARTICIPANTS_PREVIEW_SIZE]
+    )
+
+
 class ChatDetailSerializer(serializers.ModelSerializer):
     """Полная информация о чате"""
     chat_name = serializers.SerializerMethodField()
@@ -132,21 +176,69 @@ class ChatDetailSerializer(serializers.ModelSerializer):
             'messages',
             'is_group',
             'participants',
+            'member_count',
+            'message_ttl_days',
         ]
 
     def get_chat_name(self, chat):
-        if chat.chat_name:
+        if chat.chat_name or self.context.get('shared'):
             return chat.chat_name
         user = self.context['request'].user
         other = chat.participants.exclude(id=user.id).first()
         return other.phone_number if other else "Неизвестный"
 
     def get_messages(self, chat):
-        messages = chat.messages.order_by('created_at')
-        return MessageSerializer(messages, many=True, context=self.context).data
+        # Тот же формат, что MessageSerializer, но через values_list
+        messages = sharding.messages(chat.pk).order_by('created_at')
+        request = self.context.get('request')
+        if wants_normalized(request):
+            messages, self._side_loaded_users = serialize_messages_normalized(messages, request)
+            return messages
+        return serialize_messages(messages, request)
+
+    def to_representation(self, chat):
+        data = super().to_representation(chat)
+        if wants_normalized(self.context.get('request')):
+            # Авторы и лайкнувшие один раз на весь ответ
+            data['users'] = self._side_loaded_users
+        return data
 
     def get_participants(self, chat):
-        return [user.phone_number for user in chat.participants.all()]
+        return participants_preview(chat)
+
+
+def chat_detail_version(chat):
+    """Версия ответа о чате: меняется с каждой записью журнала чата
+    (сообщение, лайк, переименование, вступление) и с составом участников"""
+    last_seq = chat.changes.aggregate(last=Max('seq'))['last']
+    return last_seq, chat.member_count, chat.updated_at
+
+
+def shared_chat_detail(chat, request):
+    """Ответ о чате, одинаковый для всех участников: (данные, {id сообщения: id лайкнувших})
+
+    Название личного чата и liked зависят от пользователя, их подставляет
+    personal_chat_detail.
+    """
+    data = ChatDetailSerializer(chat, context={'request': request, 'shared': True}).data
+    if wants_normalized(request):
+        likers = {message['id']: message['liked_by'] for message in data['messages']}
+    else:
+        likers = liker_ids_for([message['id'] for message in data['messages']], sharding.db_for_chat(chat.pk))
+    return data, {message_id: frozenset(user_ids) for message_id, user_ids in likers.items()}
+
+
+def personal_chat_detail(shared, chat, request):
+    """Ответ о чате для пользователя запроса; общие данные не изменяются"""
+    data, likers = shared
+    user_id = request.user.id
+    result = dict(data)
+    if not chat.chat_name:
+        result['chat_name'] = ChatDetailSerializer(context={'request': request}).get_chat_name(chat)
+    result['messages'] = [
+        {**message, 'liked': user_id in likers.get(message['id'], ())} for message in data['messages']
+    ]
+    return result
 
 
 class ChatCreateSerializer(serializers.ModelSerializer):
@@ -233,16 +325,138 @@ class ChatCreateSerializer(serializers.ModelSerializer):
                 if participant_ids == user_ids:
                     return chat
 
-        chat = Chat.objects.create(
-            is_group=is_group,
-            chat_name=chat_name,
-        )
-        chat.participants.set(users)
+        with transaction.atomic():
+            chat = Chat.objects.create(
+                is_group=is_group,
+                chat_name=chat_name,
+            )
+            chat.participants.set(users)
+            changelog.record_many([
+                ChangeLogEntry(kind=ChangeLogEntry.KIND_JOIN, chat_id=chat.id, user_id=user.id)
+                for user in users
+            ])
         return chat
 
 
 class ChatUpdateSerializer(serializers.ModelSerializer):
-    """Обновление названия чата"""
+    """Обновление названия чата и срока хранения сообщений"""
     class Meta:
         model = Chat
-        fields = ['chat_name']
+        fields = ['chat_name', 'message_ttl_days']
+
+    def update(self, instance, validated_data):
+        old_name = instance.chat_name
+        with transaction.atomic():
+            chat = super().update(instance, validated_data)
+            if chat.chat_name != old_name:
+                changelog.record(
+                    ChangeLogEntry.KIND_CHAT_RENAME,
+                    chat_id=chat.id,
+                    user_id=self.context['request'].user.id,
+                    chat_name=chat.chat_name,
+                )
+        return chat
+
+
+class InboxSettingsSerializer(serializers.ModelSerializer):
+    """Настройки чата в списке пользователя"""
+    class Meta:
+        model = InboxEntry
+        fields = ['muted', 'pinned']
+
+
+class UploadStartSerializer(serializers.ModelSerializer):
+    """Начало загрузки вложения по частям"""
+    chunk_size = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = [
+            'id',
+            'filename',
+            'content_type',
+            'size',
+            'sha256',
+            'received',
+            'chunk_size',
+        ]
+        read_only_fields = ['id', 'received']
+
+    def get_chunk_size(self, session) -> int:
+        return uploads.get_config()['MAX_CHUNK_SIZE']
+
+    def validate_size(self, value):
+        max_size = uploads.get_config()['MAX_SIZE']
+        if value < 1:
+            raise serializers.ValidationError('Файл не может быть пустым.')
+        if value > max_size:
+            raise serializers.ValidationError('Файл больше %d байт.' % max_size)
+        return value
+
+    def validate_sha256(self, value):
+        value = value.lower()
+        if value and (len(value) != 64 or any(char not in '0123456789abcdef' for char in value)):
+            raise serializers.ValidationError('Ожидается SHA-256 в шестнадцатеричном виде.')
+        return value
+
+    def create(self, validated_data):
+        return uploads.start(self.context['request'].user, **validated_data)
+
+
+class UploadFinalizeSerializer(serializers.Serializer):
+    """Завершение загрузки: сообщение с вложением в чат"""
+    chat_id = serializers.IntegerField()
+    content = serializers.CharField(required=False, allow_blank=True, default='')
+
+    def validate_chat_id(self, value):
+        user = self.context['request'].user
+        if not Chat.objects.filter(id=value, participants=user).exists():
+            raise serializers.ValidationError('Чат с таким ID не найден')
+        return value
+
+
+class MembershipChangeSerializer(serializers.Serializer):
+    """Кого добавить в группу или убрать из неё: номера телефонов и/или id"""
+    phone_numbers = serializers.ListField(child=serializers.CharField(), required=False, default=list)
+    user_ids = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+
+    def validate(self, attrs):
+        total = len(attrs['phone_numbers']) + len(attrs['user_ids'])
+        if not total:
+            raise serializers.ValidationError('Укажите phone_numbers или user_ids.')
+        if total > membership.MAX_CHANGE:
+            raise serializers.ValidationError('Не больше %d номеров и id за один запрос.' % membership.MAX_CHANGE)
+        return attrs
+
+
+class ScheduledMessageSerializer(serializers.ModelSerializer):
+    """Запланированное сообщение: создаётся автором, отправляется диспетчером в send_at"""
+    chat_id = serializers.IntegerField()
+
+    class Meta:
+        model = ScheduledMessage
+        fields = ['id', 'chat_id', 'content', 'send_at', 'status', 'message_id', 'created_at']
+        read_only_fields = ['status', 'message_id', 'created_at']
+
+    def validate_chat_id(self, value):
+        user = self.context['request'].user
+        if not Chat.objects.filter(id=value, participants=user).exists():
+            raise serializers.ValidationError('Чат с таким ID не найден')
+        return value
+
+    def validate_send_at(self, value):
+        now = timezone.now()
+        if value <= now:
+            raise serializers.ValidationError('Время отправки должно быть в будущем.')
+        if value > now + timedelta(days=scheduled.get_config()['MAX_DELAY_DAYS']):
+            raise serializers.ValidationError('Слишком далёкое время отправки.')
+        return value
+
+    def validate(self, attrs):
+        user = self.context['request'].user
+        if scheduled.pending().filter(author=user).count() >= scheduled.get_config()['MAX_PENDING_PER_USER']:
+            raise serializers.ValidationError('Слишком много запланированных сообщений.')
+        return attrs
+
+    def create(self, validated_data):
+        return ScheduledMessage.objects.create(author=self.context['request'].user, **validated_data)
@@ -0,0 +1,179 @@
+"""Отправка сообщений: один путь для всех способов создать сообщение
+
+Сообщение, запись журнала изменений, строки списков чатов участников и
+фоновая задача пишутся в одной транзакции. Так отправляет и POST
+/api/v1/messages/, и завершение загрузки вложения (messenger/uploads.py).
+
+Клиент может передать свой client_message_id: повтор отправки с тем же
+ключом в тот же чат находит исходное сообщение по уникальному индексу
+(author, chat, client_message_id) и не создаёт второе. Ключи старше
+CLIENT_MESSAGE_ID_RETENTION_HOURS очищает expire_client_message_ids().
+
+С GROUP_COMMIT['ENABLED'] сообщения без вложений пишет поток-писатель
+пачками (messenger/group_commit.py, send_batch()).
+
+С шардированием (messenger/sharding.py) сообщение пишется в шард своего
+чата, а журнал, списки чатов и задача — в default. Транзакция шарда
+вложена в транзакцию default и фиксируется первой: если default потом не
+зафиксируется, в истории останется сообщение, о котором не узнал
+журнал, но журнал никогда не сошлётся на несуществующее сообщение.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import changelog, group_commit, inbox, sharding
+from .models import Message
+from .tasks import message_created
+
+logger = logging.getLogger('messenger.services')
+
+EXPIRE_BATCH_SIZE = 5000
+
+
+def find_sent(chat, author, client_message_id):
+    """Сообщение, уже отправленное с этим ключом, или None"""
+    return sharding.messages(chat.pk).filter(author=author, client_message_id=client_message_id).first()
+
+
+def send_message(chat, author, content, attach=None, client_message_id=None):
+    """Создаёт сообщение со всеми побочными записями и возвращает его
+
+    attach(message) вызывается в той же транзакции до записи в журнал и
+    возвращает созданные вложения: они попадают в запись журнала. С
+    client_message_id повтор возвращает исходное сообщение.
+    """
+    if client_message_id:
+        message = find_sent(chat, author, client_message_id)
+        if message is not None:
+            return message
+    # Во внешней транзакции вызывающего писатель её не увидит
+    if attach is None and group_commit.enabled() and not transaction.get_connection().in_atomic_block:
+        return _writer.call((chat, author, content, client_message_id))
+    return _send_now(chat, author, content, attach, client_message_id)
+
+
+def _send_now(chat, author, content, attach=None, client_message_id=None):
+    db = sharding.db_for_write(chat.pk)
+    [message_id] = sharding.allocate_ids(Message, 1)
+    try:
+        with transaction.atomic():
+            with transaction.atomic(using=db):
+                message = Message.objects.using(db).create(
+                    id=message_id, chat=chat, author=author, content=content,
+                    client_message_id=client_message_id or None,
+                )
+                attachments = attach(message) if attach is not None else ()
+                sharding.ensure_writable(chat.pk, db)
+            changelog.record_message(message, attachments)
+            inbox.on_message(message)
+            # Фоновая работа, которую отправитель не должен ждать; задача
+            # видна воркеру только после фиксации транзакции
+            message_created.enqueue(message_id=message.id, chat_id=message.chat_id)
+    except IntegrityError:
+        # Параллельный повтор успел вставить сообщение между проверкой и вставкой
+        message = find_sent(chat, author, client_message_id) if client_message_id else None
+        if message is None:
+            raise
+    return message
+
+
+def send_batch(items):
+    """Пишет сообщения (chat, author, content, client_message_id) пачкой
+
+    Сообщения одного шарда пишутся одной транзакцией. Возвращает
+    результаты в порядке items: сообщение или исключение этого элемента.
+    Повторы с уже использованным client_message_id, в том числе внутри
+    пачки, получают исходное сообщение. Если транзакция шарда не прошла
+    (например, конфликт с параллельной вставкой), его сообщения пишутся по
+    одному.
+    """
+    results = [None] * len(items)
+    # {база: [индекс элемента, ...]}
+    fresh = {}
+    # {(чат, автор, ключ): индекс первого такого элемента пачки}
+    first_with_key = {}
+    repeats = []
+    for index, (chat, author, content, client_message_id) in enumerate(items):
+        try:
+            db = sharding.db_for_write(chat.pk)
+        except sharding.ChatMoving as exc:
+            results[index] = exc
+            continue
+        if client_message_id:
+            key = (chat.pk, author.pk, client_message_id)
+            if key in first_with_key:
+                repeats.append((index, first_with_key[key]))
+                continue
+            first_with_key[key] = index
+            results[index] = find_sent(chat, author, client_message_id)
+            if results[index] is not None:
+                continue
+        fresh.setdefault(db, []).append(index)
+
+    ids = iter(sharding.allocate_ids(Message, sum(len(indexes) for indexes in fresh.values())))
+    for db, indexes in fresh.items():
+        group = [(items[index], next(ids)) for index in indexes]
+        try:
+            written = _write_group(db, group)
+        except Exception:
+            logger.exception('Пачка из %d сообщений в %s не записалась, пишем по одному', len(group), db)
+            written = []
+            for item, _ in group:
+                try:
+                    written.append(_send_one(item))
+                except Exception as exc:
+                    written.append(exc)
+        for index, result in zip(indexes, written):
+            results[index] = result
+    for index, original in repeats:
+        results[index] = results[original]
+    return results
+
+
+def _write_group(db, group):
+    """Сообщения одного шарда [(элемент, id), ...] одной транзакцией"""
+    with transaction.atomic():
+        with transaction.atomic(using=db):
+            messages = Message.objects.using(db).bulk_create([
+                Message(id=message_id, chat=chat, author=author, content=content,
+                        client_message_id=client_message_id or None)
+                for (chat, author, content, client_message_id), message_id in group
+            ])
+            for chat_id in {message.chat_id for message in messages}:
+                sharding.ensure_writable(chat_id, db)
+        changelog.record_many([changelog.message_entry(message) for message in messages])
+        inbox.on_messages(messages)
+        message_created.enqueue_many([{'message_id': message.id, 'chat_id': message.chat_id} for message in messages])
+    return messages
+
+
+def _send_one(item):
+    chat, author, content, client_message_id = item
+    return _send_now(chat, author, content, client_message_id=client_message_id)
+
+
+_writer = group_commit.GroupCommitWriter(send_batch, _send_one, name='message-writer')
+
+
+def writer_stats():
+    """Статистика потока-писателя сообщений этого процесса"""
+    return _writer.stats()
+
+
+def expire_client_message_ids(hours=None, batch_size=EXPIRE_BATCH_SIZE):
+    """Очищает ключи повторной отправки старше hours часов; возвращает их число"""
+    hours = hours if hours is not None else settings.CLIENT_MESSAGE_ID_RETENTION_HOURS
+    cutoff = timezone.now() - timedelta(hours=hours)
+    total = 0
+    for db in sharding.message_databases():
+        expired = Message.objects.using(db).filter(client_message_id__isnull=False, created_at__lt=cutoff)
+        while True:
+            ids = list(expired.order_by().values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            total += Message.objects.using(db).filter(id__in=ids).update(client_message_id=None)
+    return total
@@ -0,0 +1,384 @@
+"""Сообщения в нескольких базах: шард выбирается по chat_id
+
+MESSAGE_SHARDS['SHARDS'] — псевдонимы баз из DATABASES, по которым
+раскладываются сообщения, их лайки и вложения. Пустой список (по
+умолчанию) — всё лежит в default, как без шардирования. Остальные
+таблицы (чаты, пользователи, журнал изменений, списки чатов) всегда в
+default.
+
+Шард чата выбирается согласованным хешированием chat_id по кольцу с
+VIRTUAL_NODES точками на шард и запоминается в ChatShard: добавление
+шарда не переносит чаты само, их переносит python manage.py
+rebalance_message_shards. Чат, созданный до включения шардирования,
+остаётся в default, пока его не перенесут.
+
+id сообщений и вложений выдаёт общая последовательность IdSequence в
+default блоками по ID_BLOCK_SIZE на процесс (allocate_ids): id уникальны
+во всех шардах, а перенос чата их не меняет.
+
+Django не выполняет запросы между базами, поэтому всё, что касается
+сообщений одного чата, читается и пишется через messages(chat_id) /
+.using(db_for_chat(chat_id)), а лайки и пользователи, вложения и
+сообщения соединяются в Python, а не JOIN. MessageShardRouter направляет
+по шардам запросы с подсказкой instance (связанные менеджеры, save()
+вложения), а все остальные модели — в default.
+
+Перенос чата онлайн (move_chat): ChatShard помечается moving_to, и
+отправка в чат получает ChatMoving; отправка, начатая до пометки,
+проверяет размещение перед фиксацией (ensure_writable), а перенос ждёт
+MOVE_GRACE_SECONDS, пока такие транзакции закончатся. Затем сообщения,
+лайки и вложения копируются пачками с теми же id, размещение
+переключается, и копии в старом шарде удаляются.
+"""
+import bisect
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import F, Max, OuterRef, Subquery
+
+from .models import Attachment, ChatShard, IdSequence, Message
+
+DEFAULTS = {
+    'SHARDS': [],
+    'VIRTUAL_NODES': 64,
+    'ID_BLOCK_SIZE': 100,
+    'MOVE_BATCH_SIZE': 1000,
+    'MOVE_GRACE_SECONDS': 2.0,
+}
+
+# Модели приложения messenger, строки которых лежат в шарде своего чата
+SHARDED_MODELS = {'message', 'message_likes', 'attachment'}
+
+_rings = {}
+# {модель: [следующий id, конец блока]} — id, выданные этому процессу
+_blocks = {}
+_ids_lock = threading.Lock()
+
+
+class ChatMoving(Exception):
+    """Чат переносится в другой шард, запись временно невозможна"""
+
+
+def get_config():
+    """Настройки шардирования с подставленными значениями по умолчанию"""
+    return {**DEFAULTS, **getattr(settings, 'MESSAGE_SHARDS', {})}
+
+
+def enabled():
+    return bool(get_config()['SHARDS'])
+
+
+def message_databases():
+    """Базы, в которых могут лежать сообщения: default и все шарды"""
+    return list(dict.fromkeys([DEFAULT_DB_ALIAS, *get_config()['SHARDS']]))
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'messenger' and model._meta.model_name in SHARDED_MODELS
+
+
+def _point(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Кольцо согласованного хеширования: при добавлении шарда на него
+    переезжает около 1/N ключей, остальные остаются на месте"""
+
+    def __init__(self, nodes, virtual_nodes=64):
+        points = sorted(
+            (_point('%s#%d' % (node, index)), node)
+            for node in nodes
+            for index in range(virtual_nodes)
+        )
+        self.points = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self.points, _point(str(key))) % len(self.points)
+        return self.nodes[index]
+
+
+def ring():
+    config = get_config()
+    key = (tuple(config['SHARDS']), config['VIRTUAL_NODES'])
+    if key not in _rings:
+        _rings[key] = HashRing(*key)
+    return _rings[key]
+
+
+def _placement(chat_id):
+    """(шард, moving_to) чата; при первом обращении размещение запоминается"""
+    row = ChatShard.objects.using(DEFAULT_DB_ALIAS).filter(chat_id=chat_id).values_list(
+        'shard', 'moving_to').first()
+    if row is not None:
+        return row
+    # Сообщения чата, созданного до шардирования, остаются в default
+    if Message.objects.using(DEFAULT_DB_ALIAS).filter(chat_id=chat_id).exists():
+        shard = DEFAULT_DB_ALIAS
+    else:
+        shard = ring().node_for(chat_id)
+    try:
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            ChatShard.objects.using(DEFAULT_DB_ALIAS).create(chat_id=chat_id, shard=shard)
+    except IntegrityError:
+        # Размещение успел записать параллельный запрос
+        return _placement(chat_id)
+    return shard, ''
+
+
+def db_for_chat(chat_id):
+    """Псевдоним базы с сообщениями чата"""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    return _placement(chat_id)[0]
+
+
+def db_for_write(chat_id):
+    """База для новых сообщений и лайков чата; ChatMoving, если чат переносится"""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    shard, moving_to = _placement(chat_id)
+    if moving_to:
+        raise ChatMoving('Чат переносится, повторите позже')
+    return shard
+
+
+def ensure_writable(chat_id, db):
+    """Перед фиксацией записи в db: чат всё ещё там и не переносится"""
+    if not enabled():
+        return
+    if _placement(chat_id) != (db, ''):
+        raise ChatMoving('Чат переносится, повторите позже')
+
+
+def dbs_for_chats(chat_ids):
+    """{база: [chat_id, ...]} для нескольких чатов одним запросом к размещению"""
+    known = dict(ChatShard.objects.using(DEFAULT_DB_ALIAS).filter(chat_id__in=list(chat_ids))
+                 .values_list('chat_id', 'shard'))
+    grouped = {}
+    for chat_id in chat_ids:
+        shard = known.get(chat_id) or _placement(chat_id)[0]
+        grouped.setdefault(shard, []).append(chat_id)
+    return grouped
+
+
+def last_messages(chat_ids):
+    """{chat_id: (текст, дата)} последнего сообщения чатов, по запросу на шард"""
+    result = {}
+    for db, ids in dbs_for_chats(chat_ids).items():
+        latest = Message.objects.filter(chat_id=OuterRef('chat_id')).order_by('-created_at').values('pk')[:1]
+        rows = Message.objects.using(db).filter(chat_id__in=ids, pk=Subquery(latest)).values_list(
+            'chat_id', 'content', 'created_at')
+        result.update((chat_id, (content, created_at)) for chat_id, content, created_at in rows)
+    return result
+
+
+def messages(chat_id):
+    """Сообщения чата из его шарда"""
+    return Message.objects.using(db_for_chat(chat_id)).filter(chat_id=chat_id)
+
+
+def likes(db):
+    """Строки лайков сообщений базы db"""
+    return Message.likes.through.objects.using(db)
+
+
+def find_message_db(message_id):
+    """База, в которой лежит сообщение с этим id, или None"""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    for db in message_databases():
+        if Message.objects.using(db).filter(pk=message_id).exists():
+            return db
+    return None
+
+
+def get_message(message_id):
+    """Сообщение по id из любого шарда; Message.DoesNotExist, если его нет"""
+    db = find_message_db(message_id) or DEFAULT_DB_ALIAS
+    return Message.objects.using(db).get(pk=message_id)
+
+
+def allocate_ids(model, count):
+    """count новых id для Message или Attachment из общей последовательности
+
+    Без шардирования — None: id назначит автоинкремент базы.
+    """
+    if not enabled():
+        return [None] * count
+    name = model._meta.label_lower
+    ids = []
+    with _ids_lock:
+        block = _blocks.setdefault(name, [0, 0])
+        while len(ids) < count:
+            if block[0] >= block[1]:
+                size = max(get_config()['ID_BLOCK_SIZE'], count - len(ids))
+                block[1] = _reserve(name, size, model)
+                block[0] = block[1] - size
+            ids.append(block[0])
+            block[0] += 1
+    return ids
+
+
+def _reserve(name, size, model):
+    """Сдвигает последовательность на size; возвращает конец выданного диапазона"""
+    if transaction.get_connection(DEFAULT_DB_ALIAS).in_atomic_block:
+        # Откат внешней транзакции вернул бы блок, уже выданный процессу
+        raise RuntimeError('id выделяются вне транзакции в default')
+    sequences = IdSequence.objects.using(DEFAULT_DB_ALIAS)
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        if not sequences.filter(name=name).update(next_value=F('next_value') + size):
+            # Первая выдача: продолжаем после наибольшего id во всех базах
+            start = 1 + max(
+                model.objects.using(db).aggregate(last=Max('pk'))['last'] or 0
+                for db in message_databases()
+            )
+            try:
+                with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                    sequences.create(name=name, next_value=start + size)
+            except IntegrityError:
+                sequences.filter(name=name).update(next_value=F('next_value') + size)
+        return sequences.get(name=name).next_value
+
+
+def reset():
+    """Забывает выданные процессу блоки id (для тестов и после смены настроек)"""
+    with _ids_lock:
+        _blocks.clear()
+
+
+class MessageShardRouter:
+    """Сообщения, лайки и вложения — в шард их чата, всё остальное — в default"""
+
+    def _db_for(self, model, hints):
+        if not enabled():
+            return None
+        if not is_sharded(model):
+            # Без этого запросы к чатам и пользователям от объекта из шарда ушли бы в шард
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if instance._state.db:
+            return instance._state.db
+        if isinstance(instance, Message):
+            return db_for_chat(instance.chat_id)
+        if isinstance(instance, Attachment):
+            message = instance._state.fields_cache.get('message')
+            if message is not None and message._state.db:
+                return message._state.db
+            return find_message_db(instance.message_id)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._db_for(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Связи между базами держатся на id без ограничений внешнего ключа
+        return True if enabled() else None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS or db not in get_config()['SHARDS']:
+            return None
+        return app_label == 'messenger' and model_name in SHARDED_MODELS
+
+
+def _copy(model, source, target, queryset):
+    """Копирует строки queryset из source в target пачками с теми же id"""
+    batch_size = get_config()['MOVE_BATCH_SIZE']
+    last_pk = 0
+    copied = 0
+    while True:
+        rows = list(queryset.using(source).filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not rows:
+            return copied
+        # Повторный запуск после сбоя не задвоит уже скопированное
+        existing = set(model.objects.using(target).filter(pk__in=[row.pk for row in rows])
+                       .values_list('pk', flat=True))
+        model.objects.using(target).bulk_create([row for row in rows if row.pk not in existing])
+        copied += len(rows) - len(existing)
+        last_pk = rows[-1].pk
+
+
+def _copy_likes(source, target, message_ids):
+    """Копирует лайки: id строк связи свои в каждой базе, их не переносим"""
+    through = Message.likes.through
+    batch_size = get_config()['MOVE_BATCH_SIZE']
+    last_pk = 0
+    while True:
+        rows = list(through.objects.using(source).filter(message_id__in=message_ids, pk__gt=last_pk)
+                    .order_by('pk').values_list('pk', 'message_id', 'customuser_id')[:batch_size])
+        if not rows:
+            return
+        through.objects.using(target).bulk_create(
+            [through(message_id=message_id, customuser_id=user_id) for _, message_id, user_id in rows],
+            ignore_conflicts=True,
+        )
+        last_pk = rows[-1][0]
+
+
+def _delete(model, db, queryset):
+    """Удаляет строки пачками без каскада: связанные строки удаляются отдельно,
+    а каскад на UploadSession искал бы её таблицу в шарде"""
+    batch_size = get_config()['MOVE_BATCH_SIZE']
+    while True:
+        ids = list(queryset.using(db).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return
+        model.objects.filter(pk__in=ids)._raw_delete(db)
+
+
+def delete_messages(db, **lookups):
+    """Удаляет из db сообщения по lookups вместе с их лайками и вложениями"""
+    message_ids = Message.objects.filter(**lookups).values('pk')
+    _delete(Attachment, db, Attachment.objects.filter(message_id__in=message_ids))
+    _delete(Message.likes.through, db, Message.likes.through.objects.filter(message_id__in=message_ids))
+    _delete(Message, db, Message.objects.filter(**lookups))
+
+
+def move_chat(chat_id, target):
+    """Переносит сообщения, лайки и вложения чата в шард target; число сообщений"""
+    if target not in message_databases():
+        raise ValueError('База %s не указана в MESSAGE_SHARDS' % target)
+    source = db_for_chat(chat_id)
+    if source == target:
+        return 0
+    placements = ChatShard.objects.using(DEFAULT_DB_ALIAS)
+    if not placements.filter(chat_id=chat_id, shard=source, moving_to='').update(moving_to=target):
+        raise ChatMoving('Чат %s уже переносится' % chat_id)
+    try:
+        # Отправки, которые успели прочитать старое размещение, проверят его
+        # перед фиксацией; ждём, пока они закончатся
+        time.sleep(get_config()['MOVE_GRACE_SECONDS'])
+        message_ids = Message.objects.filter(chat_id=chat_id).values('pk')
+        moved = _copy(Message, source, target, Message.objects.filter(chat_id=chat_id))
+        _copy_likes(source, target, message_ids)
+        _copy(Attachment, source, target, Attachment.objects.filter(message_id__in=message_ids))
+        placements.filter(chat_id=chat_id).update(shard=target, moving_to='')
+    except BaseException:
+        placements.filter(chat_id=chat_id).update(moving_to='')
+        raise
+    # Копии в старом шарде больше никто не читает
+    delete_messages(source, chat_id=chat_id)
+    return moved
+
+
+def misplaced(limit=None):
+    """(chat_id, шард, шард по кольцу) чатов, которые лежат не там, где велит кольцо"""
+    placements = ChatShard.objects.using(DEFAULT_DB_ALIAS).filter(moving_to='').order_by('chat_id')
+    current_ring = ring()
+    result = []
+    for chat_id, shard in placements.values_list('chat_id', 'shard').iterator():
+        target = current_ring.node_for(chat_id)
+        if target != shard:
+            result.append((chat_id, shard, target))
+            if limit is not None and len(result) >= limit:
+                break
+    return result
@@ -0,0 +1,67 @@
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, pre_delete
+from django.dispatch import receiver
+
+from users.models import CustomUser
+from . import inbox, sharding
+from .models import Chat
+
+
+def refresh_member_counts(chat_ids):
+    """Пересчитывает Chat.member_count по таблице участников одним UPDATE"""
+    through = Chat.participants.through
+    counts = through.objects.filter(chat_id=OuterRef('pk')).values('chat_id').annotate(
+        total=Count('*')).values('total')
+    Chat.objects.filter(pk__in=list(chat_ids)).update(member_count=Coalesce(Subquery(counts), 0))
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def update_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    """Держит member_count и списки чатов (InboxEntry) в актуальном состоянии
+    при любом изменении участников"""
+    if reverse and action == 'pre_clear':
+        # user.chats.clear(): после очистки уже не узнать, из каких чатов вышел пользователь
+        instance._cleared_chat_ids = list(
+            sender.objects.filter(customuser_id=instance.pk).values_list('chat_id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        chat_ids, user_ids = [instance.pk], pk_set
+    elif action == 'post_clear':
+        chat_ids, user_ids = getattr(instance, '_cleared_chat_ids', []), [instance.pk]
+    else:
+        chat_ids, user_ids = pk_set, [instance.pk]
+    if not chat_ids:
+        return
+
+    refresh_member_counts(chat_ids)
+    if action == 'post_add':
+        inbox.add_members(chat_ids, user_ids)
+    else:
+        # При chat.participants.clear() pk_set пуст — удаляем строки всех участников
+        inbox.remove_members(chat_ids, user_ids)
+    inbox.sync_fanout_mode(chat_ids)
+
+
+@receiver(pre_delete, sender=Chat)
+def delete_sharded_messages(sender, instance, **kwargs):
+    """Каскад Django удаляет сообщения только в default, остальное — здесь"""
+    if not sharding.enabled():
+        return
+    shard = sharding.db_for_chat(instance.pk)
+    if shard != sharding.DEFAULT_DB_ALIAS:
+        sharding.delete_messages(shard, chat_id=instance.pk)
+
+
+@receiver(pre_delete, sender=CustomUser)
+def delete_sharded_user_rows(sender, instance, **kwargs):
+    """Сообщения и лайки удаляемого пользователя в шардах"""
+    if not sharding.enabled():
+        return
+    for db in sharding.message_databases():
+        if db != sharding.DEFAULT_DB_ALIAS:
+            sharding.delete_messages(db, author_id=instance.pk)
+            sharding.likes(db).filter(customuser_id=instance.pk).delete()
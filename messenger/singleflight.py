@@ -0,0 +1,165 @@
+"""Склейка одинаковых чтений: одно вычисление на всех, кто ждёт его сейчас
+
+Когда в большой группе появляется сообщение, сотни участников почти
+одновременно запрашивают GET /api/v1/chats/<pk>/ и каждый заново делает
+одни и те же запросы и сериализацию. SingleFlight.do(key, compute) для
+ключа, который уже вычисляется в этом процессе, не вызывает compute, а
+ждёт результат первого запроса (ведущего) и возвращает его же; ошибку
+ведущего получают все ожидающие. Это не кеш: после того как вычисление
+закончилось, следующий запрос с тем же ключом считает заново.
+
+Ключ должен включать версию данных: запрос, пришедший после изменения,
+не должен получить результат, начатый до него. Результат общий для всех
+ожидающих, его нельзя изменять на месте.
+
+Таблица вычислений одна на процесс и общая для потоков (WSGI, а в ASGI
+синхронные view Django выполняет в потоке на запрос) и корутин
+(do_async): ожидание из потока и из цикла asyncio склеивается с одним и
+тем же вычислением. Ожидающий ждёт не дольше TIMEOUT секунд и после
+этого вычисляет сам.
+
+stats() — вызовы, вычисления, склеенные вызовы и ожидания по таймауту по
+таблицам; раз в REPORT_INTERVAL секунд, если были вызовы, сводка за
+интервал пишется в лог messenger.singleflight (WARNING, если были
+таймауты или ошибки).
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+
+DEFAULTS = {
+    'ENABLED': True,
+    'TIMEOUT': 10.0,
+    'REPORT_INTERVAL': 60,
+}
+
+logger = logging.getLogger('messenger.singleflight')
+
+# {имя: SingleFlight} — для общей статистики
+_registry = {}
+
+
+def get_config():
+    """Настройки склейки чтений с подставленными значениями по умолчанию"""
+    return {**DEFAULTS, **getattr(settings, 'SINGLE_FLIGHT', {})}
+
+
+def enabled():
+    return get_config()['ENABLED']
+
+
+class SingleFlight:
+    """Таблица вычислений, которые выполняются прямо сейчас, по ключу"""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = {'calls': 0, 'leaders': 0, 'shared': 0, 'timeouts': 0, 'errors': 0}
+        self._reported_at = time.monotonic()
+        self._reported = dict(self._counters)
+        _registry[name] = self
+
+    def _join(self, key):
+        """(Future, ведущий ли вызывающий)"""
+        with self._lock:
+            self._counters['calls'] += 1
+            future = self._calls.get(key)
+            if future is not None:
+                self._counters['shared'] += 1
+                return future, False
+            future = self._calls[key] = Future()
+            self._counters['leaders'] += 1
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._calls.pop(key, None)
+            if error is not None:
+                self._counters['errors'] += 1
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        self.report()
+
+    def _timed_out(self):
+        with self._lock:
+            self._counters['timeouts'] += 1
+
+    def do(self, key, compute):
+        """Результат compute() — своего или уже идущего вычисления с этим ключом"""
+        future, leader = self._join(key)
+        if not leader:
+            try:
+                return future.result(timeout=get_config()['TIMEOUT'])
+            except FutureTimeoutError:
+                self._timed_out()
+                return compute()
+        try:
+            result = compute()
+        except BaseException as exc:
+            self._finish(key, future, error=exc)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def do_async(self, key, compute):
+        """То же для корутин: compute — функция, возвращающая awaitable"""
+        future, leader = self._join(key)
+        if not leader:
+            try:
+                # shield: отмена ожидания не должна отменять общее вычисление
+                return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), get_config()['TIMEOUT'])
+            except asyncio.TimeoutError:
+                self._timed_out()
+                return await compute()
+        try:
+            result = await compute()
+        except BaseException as exc:
+            # И при отмене корутины ключ освобождается, а ожидающие не висят
+            self._finish(key, future, error=exc)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    def stats(self):
+        """Вызовы, вычисления, склеенные вызовы и их доля, ожидания по таймауту"""
+        with self._lock:
+            result = dict(self._counters)
+            result['in_flight'] = len(self._calls)
+        result['shared_ratio'] = result['shared'] / result['calls'] if result['calls'] else 0
+        return result
+
+    def report(self):
+        """Сводка за интервал в лог не чаще раза в REPORT_INTERVAL секунд"""
+        interval = get_config()['REPORT_INTERVAL']
+        now = time.monotonic()
+        with self._lock:
+            if now - self._reported_at < interval:
+                return
+            delta = {key: value - self._reported[key] for key, value in self._counters.items()}
+            self._reported_at, self._reported = now, dict(self._counters)
+            in_flight = len(self._calls)
+        if not delta['calls']:
+            return
+        level = logging.WARNING if delta['timeouts'] or delta['errors'] else logging.INFO
+        logger.log(
+            level, '%s за %d с: вызовов %d, вычислений %d, склеено %d (%.0f%%), таймаутов %d, ошибок %d, '
+            'выполняется %d', self.name, interval, delta['calls'], delta['leaders'], delta['shared'],
+            100 * delta['shared'] / delta['calls'], delta['timeouts'], delta['errors'], in_flight,
+        )
+
+    def reset_stats(self):
+        with self._lock:
+            self._counters = dict.fromkeys(self._counters, 0)
+            self._reported = dict(self._counters)
+
+
+def stats():
+    """{имя: статистика} всех таблиц процесса"""
+    return {name: flight.stats() for name, flight in _registry.items()}
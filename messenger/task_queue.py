@@ -0,0 +1,234 @@
+"""Лёгкая очередь фоновых задач на базе таблицы Task
+
+Задача — обычная функция, зарегистрированная декоратором @task под
+именем; аргументы хранятся в Task.payload и должны сериализоваться в
+JSON. enqueue() внутри transaction.atomic() пишет задачу в ту же
+транзакцию, что и само изменение: воркер увидит её только после
+фиксации, а при откате задача исчезнет вместе с изменением.
+
+Воркер (python manage.py run_task_worker) забирает задачи пачками:
+на PostgreSQL/MySQL через SELECT ... FOR UPDATE SKIP LOCKED, на SQLite
+одним условным UPDATE с уникальной меткой захвата. Упавшая задача
+возвращается в очередь с экспоненциальной задержкой, пока не исчерпает
+max_attempts. Задачи зарегистрированы в модулях <app>/tasks.py.
+"""
+import logging
+import random
+import traceback
+import uuid
+from datetime import timedelta
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Avg, Count, F, Max, Min
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger('messenger.tasks')
+
+DEFAULTS = {
+    'POLL_INTERVAL': 1.0,
+    'MAX_ATTEMPTS': 5,
+    'BACKOFF_BASE': 2.0,
+    'BACKOFF_MAX': 600,
+    'LEASE_SECONDS': 300,
+    'KEEP_DONE_HOURS': 24,
+}
+
+# Столько символов трассировки сохраняем в last_error
+MAX_ERROR_LENGTH = 4000
+
+_registry = {}
+
+
+class UnknownTask(LookupError):
+    """Задача с таким именем не зарегистрирована"""
+
+
+def get_config():
+    """Настройки очереди с подставленными значениями по умолчанию"""
+    return {**DEFAULTS, **getattr(settings, 'TASK_QUEUE', {})}
+
+
+def task(name, priority=0, max_attempts=None):
+    """Регистрирует функцию как фоновую задачу под именем name
+
+    У функции появляется метод enqueue(**payload) с приоритетом и числом
+    попыток по умолчанию из декоратора.
+    """
+    def decorator(func):
+        _registry[name] = func
+
+        def enqueue_task(delay=None, **payload):
+            return enqueue(name, payload, priority=priority, delay=delay, max_attempts=max_attempts)
+
+        def enqueue_many(payloads):
+            return enqueue_batch(name, payloads, priority=priority, max_attempts=max_attempts)
+
+        func.task_name = name
+        func.enqueue = enqueue_task
+        func.enqueue_many = enqueue_many
+        return func
+    return decorator
+
+
+def get_task(name):
+    try:
+        return _registry[name]
+    except KeyError:
+        raise UnknownTask('Задача %s не зарегистрирована' % name) from None
+
+
+def enqueue(name, payload=None, priority=0, delay=None, max_attempts=None):
+    """Ставит задачу в очередь; delay — timedelta или секунды"""
+    get_task(name)
+    if delay is not None and not isinstance(delay, timedelta):
+        delay = timedelta(seconds=delay)
+    return Task.objects.create(
+        name=name,
+        payload=payload or {},
+        priority=priority,
+        max_attempts=max_attempts or get_config()['MAX_ATTEMPTS'],
+        run_at=timezone.now() + delay if delay else timezone.now(),
+    )
+
+
+def enqueue_batch(name, payloads, priority=0, max_attempts=None):
+    """Ставит в очередь задачи name с каждым payload из payloads одним INSERT"""
+    get_task(name)
+    now = timezone.now()
+    max_attempts = max_attempts or get_config()['MAX_ATTEMPTS']
+    return Task.objects.bulk_create([
+        Task(name=name, payload=payload, priority=priority, max_attempts=max_attempts, run_at=now)
+        for payload in payloads
+    ])
+
+
+def backoff(attempts):
+    """Задержка перед следующей попыткой: base ** attempts с разбросом ±10%"""
+    config = get_config()
+    delay = min(config['BACKOFF_BASE'] ** attempts, config['BACKOFF_MAX'])
+    return timedelta(seconds=delay * random.uniform(0.9, 1.1))
+
+
+def _ready_tasks(now):
+    return Task.objects.filter(status=Task.STATUS_PENDING, run_at__lte=now).order_by('-priority', 'run_at', 'id')
+
+
+def claim(worker_id, limit=1):
+    """Забирает до limit готовых задач в работу и возвращает их
+
+    В locked_by пишется уникальная метка захвата: по ней воркер находит
+    свои задачи и не затирает результат задачи, которую после истечения
+    аренды уже перехватил кто-то другой.
+    """
+    now = timezone.now()
+    token = '%s:%s' % (worker_id, uuid.uuid4().hex[:12])
+    claimed = {
+        'status': Task.STATUS_RUNNING,
+        'locked_by': token,
+        'locked_at': now,
+        'attempts': F('attempts') + 1,
+    }
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(_ready_tasks(now).select_for_update(skip_locked=True).values_list('id', flat=True)[:limit])
+            Task.objects.filter(id__in=ids).update(**claimed)
+    else:
+        # Без SKIP LOCKED (SQLite): условный UPDATE с повторной проверкой
+        # статуса, конкурирующий воркер не захватит те же строки
+        Task.objects.filter(
+            id__in=list(_ready_tasks(now).values_list('id', flat=True)[:limit]),
+            status=Task.STATUS_PENDING,
+        ).update(**claimed)
+    return list(Task.objects.filter(locked_by=token).order_by('-priority', 'run_at', 'id'))
+
+
+def run(item):
+    """Выполняет захваченную задачу и записывает результат"""
+    started = perf_counter()
+    try:
+        get_task(item.name)(**item.payload)
+    except Exception:
+        duration = (perf_counter() - started) * 1000
+        error = traceback.format_exc()[-MAX_ERROR_LENGTH:]
+        if item.attempts >= item.max_attempts:
+            logger.error('Задача %s #%s упала окончательно после %d попыток', item.name, item.id, item.attempts)
+            _finish(item, Task.STATUS_FAILED, duration, last_error=error)
+        else:
+            logger.warning('Задача %s #%s упала, попытка %d из %d', item.name, item.id, item.attempts,
+                           item.max_attempts)
+            _finish(item, Task.STATUS_PENDING, duration, last_error=error,
+                    run_at=timezone.now() + backoff(item.attempts), finished_at=None)
+        return False
+    _finish(item, Task.STATUS_DONE, (perf_counter() - started) * 1000)
+    return True
+
+
+def _finish(item, status, duration, **fields):
+    values = {
+        'status': status,
+        'duration_ms': duration,
+        'locked_by': '',
+        'locked_at': None,
+        'finished_at': timezone.now(),
+        **fields,
+    }
+    # Обновляем только если задачу не перехватили после истечения аренды
+    Task.objects.filter(id=item.id, locked_by=item.locked_by).update(**values)
+    for name, value in values.items():
+        setattr(item, name, value)
+
+
+def run_pending(worker_id='inline', limit=100):
+    """Выполняет готовые задачи в текущем потоке; возвращает их число"""
+    tasks = claim(worker_id, limit)
+    for item in tasks:
+        run(item)
+    return len(tasks)
+
+
+def requeue_stale(lease_seconds=None):
+    """Возвращает в очередь задачи, воркер которых пропал дольше аренды"""
+    lease = lease_seconds if lease_seconds is not None else get_config()['LEASE_SECONDS']
+    return Task.objects.filter(
+        status=Task.STATUS_RUNNING,
+        locked_at__lt=timezone.now() - timedelta(seconds=lease),
+    ).update(status=Task.STATUS_PENDING, locked_by='', locked_at=None)
+
+
+def purge_finished(hours=None):
+    """Удаляет выполненные задачи старше hours часов"""
+    hours = hours if hours is not None else get_config()['KEEP_DONE_HOURS']
+    deleted, _ = Task.objects.filter(
+        status=Task.STATUS_DONE,
+        finished_at__lt=timezone.now() - timedelta(hours=hours),
+    ).delete()
+    return deleted
+
+
+def stats():
+    """Метрики очереди: {имя задачи: {статус: число, ...}, ...}
+
+    Для каждой задачи ещё среднее и максимальное время выполнения и
+    задержка самой старой готовой к запуску задачи в секундах.
+    """
+    now = timezone.now()
+    result = {}
+    rows = Task.objects.values('name', 'status').annotate(
+        count=Count('id'), avg_ms=Avg('duration_ms'), max_ms=Max('duration_ms'),
+    ).order_by('name', 'status')
+    for row in rows:
+        item = result.setdefault(row['name'], {
+            'pending': 0, 'running': 0, 'done': 0, 'failed': 0, 'avg_ms': None, 'max_ms': None, 'lag_seconds': 0,
+        })
+        item[row['status']] = row['count']
+        if row['status'] == Task.STATUS_DONE:
+            item['avg_ms'] = row['avg_ms']
+            item['max_ms'] = row['max_ms']
+    lags = _ready_tasks(now).order_by().values('name').annotate(oldest=Min('run_at')).values_list('name', 'oldest')
+    for name, oldest in lags:
+        result[name]['lag_seconds'] = (now - oldest).total_seconds()
+    return result
@@ -0,0 +1,30 @@
+"""Фоновые задачи чатов, см. messenger/task_queue.py"""
+from . import purge, sharding
+from .models import Chat, Message, PurgeJob
+from .task_queue import task
+
+
+@task('messenger.message_created')
+def message_created(message_id, chat_id=None):
+    """Побочная работа после отправки сообщения: активность чата"""
+    # Задачи, поставленные до шардирования, не знают чат: ищем по всем базам
+    db = sharding.db_for_chat(chat_id) if chat_id is not None else sharding.find_message_db(message_id)
+    if db is None:
+        return
+    created_at = Message.objects.using(db).filter(id=message_id).values_list('created_at', 'chat_id').first()
+    if created_at is None:
+        return
+    created_at, chat_id = created_at
+    # Условие по дате делает задачу идемпотентной и не откатывает время
+    # назад, если задачи выполнились не по порядку
+    Chat.objects.filter(id=chat_id, updated_at__lt=created_at).update(updated_at=created_at)
+
+
+@task(purge.TASK_NAME, priority=-1)
+def run_purge_job(job_id):
+    """Порция задания очистки не дольше TASK_SECONDS; продолжение ставится в очередь"""
+    job = PurgeJob.objects.filter(pk=job_id).exclude(status=PurgeJob.STATUS_DONE).first()
+    if job is None:
+        return
+    if not purge.run(job, seconds=purge.get_config()['TASK_SECONDS']):
+        run_purge_job.enqueue(job_id=job_id)
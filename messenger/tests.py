@@ -1,8 +1,54 @@
+import asyncio
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from io import StringIO
+from unittest import mock
+
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase, APITransactionTestCase
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.utils import ConnectionHandler
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from messenger.models import Chat, Message
+from django.utils import timezone
+from messenger import changelog, inbox, purge, scheduled, services, sharding, task_queue, uploads, views
+from messenger.admin_scaling import EstimatedCountPaginator
+from messenger.fields import MARKER
+from messenger.group_commit import GroupCommitTimeout, GroupCommitWriter
+from messenger.singleflight import SingleFlight
+from messenger.models import (
+    Attachment, ChangeLogCompaction, ChangeLogEntry, Chat, ChatShard, InboxEntry, Message, PurgeJob, RequestProfile,
+    ScheduledMessage, StoredBlob, Task, UploadSession,
+)
+from messenger.fast_serializers import serialize_chats, serialize_messages
+from messenger.serializers import ChatListSerializer, MessageSerializer, personal_chat_detail, shared_chat_detail
+from messenger_project.profiling import SamplingProfiler
+from messenger_project.msgpack_codec import UnpackError, packb, unpackb
+from messenger_project.renderers import FastJSONRenderer
+from messenger_project import admission, openapi, settings_production, storage, throttling
+from messenger_project.query_log import SlowQueryLogMiddleware, fingerprint
+from users.fast_serializers import serialize_users
 from users.models import CustomUser
+from users.serializers import UserSerializer
 
 
 class ChatCreateTests(APITestCase):
@@ -98,9 +144,9 @@ class ChatListAPITests(APITestCase):
         response = self.client.get(url)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
 
-        returned_chat_id = response.data[0]['id']
+        returned_chat_id = response.data['results'][0]['id']
         self.assertEqual(returned_chat_id, self.chat1.id)
 
 
@@ -169,6 +215,31 @@ class MessageCreateAPITests(APITestCase):
         self.assertEqual(response.status_code, 400)
         self.assertIn('content', response.data)
 
+    def test_retry_with_client_message_id_returns_original(self):
+        data = {'chat_id': self.chat.id, 'content': 'Один раз', 'client_message_id': 'c-1'}
+        first = self.client.post(self.url, data)
+        self.assertEqual(first.status_code, 201)
+        retry = self.client.post(self.url, data)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(ChangeLogEntry.objects.filter(kind=ChangeLogEntry.KIND_MESSAGE).count(), 1)
+        self.assertEqual(InboxEntry.objects.get(user=self.user2, chat=self.chat).unread, 1)
+
+        # Ключ уникален для автора и чата: собеседник может прислать такой же
+        self.client.force_authenticate(user=self.user2)
+        self.assertEqual(self.client.post(self.url, data).status_code, 201)
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_expired_client_message_id_is_forgotten(self):
+        data = {'chat_id': self.chat.id, 'content': 'Старое', 'client_message_id': 'c-1'}
+        self.client.post(self.url, data)
+        Message.objects.update(created_at=timezone.now() - datetime.timedelta(days=3))
+        out = StringIO()
+        call_command('expire_client_message_ids', stdout=out)
+        self.assertIn('Очищено ключей: 1', out.getvalue())
+        self.assertIsNone(Message.objects.get().client_message_id)
+
 
 class MessageLikeTest(APITestCase):
     def setUp(self):
@@ -220,12 +291,1858 @@ class ChatSearchAPITest(APITestCase):
         response = self.client.get(url, {'q': 'fam'})
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['chat_name'], 'FAMILY')
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['chat_name'], 'FAMILY')
 
     def test_search_chat_user_not_included(self):
         url = reverse('chat-search')
         response = self.client.get(url, {'q': 'Classmates'})
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 0)
+        self.assertEqual(len(response.data['results']), 0)
+
+
+class SlowQueryLogTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.chat = Chat.objects.create(chat_name='Group', is_group=True)
+        self.chat.participants.add(self.user)
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.log_dir.cleanup)
+        self.log_file = os.path.join(self.log_dir.name, 'slow.log')
+
+    def test_fingerprint_normalizes_literals_and_in_lists(self):
+        first, digest1 = fingerprint('SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = \'a\'')
+        second, digest2 = fingerprint('SELECT *  FROM t WHERE id IN (%s) AND name = \'bb\'')
+        self.assertEqual(first, second)
+        self.assertEqual(digest1, digest2)
+        self.assertIn('IN (...)', first)
+
+    def test_middleware_logs_query_with_plan_and_source(self):
+        config = {'ENABLED': True, 'THRESHOLD_MS': 0, 'LOG_FILE': self.log_file}
+        request = RequestFactory().get('/api/v1/chats/')
+        request.user = self.user
+
+        def get_response(request):
+            serializer = ChatListSerializer(self.chat, context={'request': request})
+            return serializer.data
+
+        with self.settings(SLOW_QUERY_LOG=config), self.assertLogs('messenger.slow_queries'):
+            SlowQueryLogMiddleware(get_response)(request)
+
+        with open(self.log_file, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        sources = {record['source'] for record in records}
+        self.assertIn('ChatListSerializer.get_last_time', sources)
+        self.assertTrue(all(record['plan'] for record in records))
+
+        out = StringIO()
+        call_command('slow_query_report', file=self.log_file, top=3, stdout=out)
+        self.assertIn('ChatListSerializer.get_last_time', out.getvalue())
+
+    def test_middleware_disabled_by_default(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            SlowQueryLogMiddleware(lambda request: None)
+
+
+class RequestProfilerTests(APITestCase):
+    def setUp(self):
+        self.staff = CustomUser.objects.create_user(phone_number='+12345678', password='testpass', is_staff=True)
+        self.user = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        self.chat = Chat.objects.create(chat_name='Group', is_group=True)
+        self.chat.participants.set([self.staff, self.user])
+        self.url = reverse('chat-detail-update', kwargs={'pk': self.chat.id})
+
+    def authenticate(self, user):
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+    def test_staff_request_is_profiled(self):
+        self.authenticate(self.staff)
+        response = self.client.get(self.url, HTTP_X_PROFILE='sample')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        profile = RequestProfile.objects.get(request_id=response['X-Profile-Id'])
+        self.assertEqual(profile.view_name, 'ChatRetrieveUpdateAPIView')
+        self.assertEqual(profile.user, self.staff)
+        self.assertEqual(profile.status_code, 200)
+
+    def test_cprofile_mode_by_query_param(self):
+        self.authenticate(self.staff)
+        response = self.client.get(self.url, {'_profile': 'cprofile'})
+        profile = RequestProfile.objects.get(request_id=response['X-Profile-Id'])
+        self.assertEqual(profile.mode, 'cprofile')
+        self.assertIn('function calls', profile.stats)
+
+    def test_non_staff_request_is_not_profiled(self):
+        self.authenticate(self.user)
+        response = self.client.get(self.url, HTTP_X_PROFILE='sample')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_sampler_collapses_stacks(self):
+        profiler = SamplingProfiler(0.001)
+        profiler.start()
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+        profiler.stop()
+        self.assertGreater(profiler.sample_count, 0)
+        stack, count = profiler.collapsed().splitlines()[0].rsplit(' ', 1)
+        self.assertIn('test_sampler_collapses_stacks', stack)
+        self.assertGreater(int(count), 0)
+
+
+class FastSerializationTests(TestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(
+            phone_number='+12345678', password='testpass', first_name='Timur',
+            date_of_birth=datetime.date(1999, 5, 1),
+        )
+        self.user2 = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        self.user3 = CustomUser.objects.create_user(phone_number='+11122222', password='testpass')
+        self.user2.avatar.name = 'avatars/user2.png'
+        self.user2.save()
+
+        self.group = Chat.objects.create(chat_name='Group', is_group=True)
+        self.group.participants.set([self.user1, self.user2, self.user3])
+        self.private = Chat.objects.create(is_group=False)
+        self.private.participants.set([self.user1, self.user2])
+        self.empty = Chat.objects.create(is_group=False)
+        self.empty.participants.set([self.user1])
+
+        first = Message.objects.create(chat=self.group, author=self.user1, content='Привет')
+        second = Message.objects.create(chat=self.group, author=self.user2, content='  строка')
+        Message.objects.create(chat=self.private, author=self.user2, content='Hi')
+        second.likes.add(self.user3)
+        second.likes.add(self.user1)
+        first.likes.add(self.user2)
+
+        self.request = RequestFactory().get('/api/v1/chats/')
+        self.request.user = self.user1
+
+    def test_messages_match_model_serializer_bytes(self):
+        messages = self.group.messages.order_by('created_at')
+        expected = JSONRenderer().render(
+            MessageSerializer(messages, many=True, context={'request': self.request}).data)
+        actual = FastJSONRenderer().render(serialize_messages(messages, self.request))
+        self.assertEqual(actual, expected)
+
+    def test_chats_match_model_serializer_bytes(self):
+        chats = Chat.objects.filter(participants=self.user1).order_by('-created_at')
+        expected = JSONRenderer().render(
+            ChatListSerializer(chats, many=True, context={'request': self.request}).data)
+        actual = FastJSONRenderer().render(serialize_chats(chats, self.request))
+        self.assertEqual(actual, expected)
+
+    def test_users_match_model_serializer_bytes(self):
+        users = CustomUser.objects.order_by('id')
+        expected = JSONRenderer().render(UserSerializer(users, many=True, context={'request': self.request}).data)
+        actual = FastJSONRenderer().render(serialize_users(users, self.request))
+        self.assertEqual(actual, expected)
+
+
+class NormalizedMessagesAPITests(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(phone_number='+12345678', password='testpass', first_name='A')
+        self.user2 = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        self.user3 = CustomUser.objects.create_user(phone_number='+11122222', password='testpass')
+        self.chat = Chat.objects.create(chat_name='Group', is_group=True)
+        self.chat.participants.set([self.user1, self.user2])
+        self.messages = [
+            Message.objects.create(chat=self.chat, author=[self.user1, self.user2][i % 2], content='m%d' % i)
+            for i in range(5)
+        ]
+        self.messages[0].likes.add(self.user2, self.user3)
+        self.client.force_authenticate(user=self.user1)
+
+    def test_chat_detail_side_loads_users_once(self):
+        url = reverse('chat-detail-update', kwargs={'pk': self.chat.id})
+        response = self.client.get(url, {'normalized': 'true'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        users = response.data['users']
+        self.assertEqual(set(users), {str(self.user1.id), str(self.user2.id), str(self.user3.id)})
+        self.assertEqual(users[str(self.user1.id)]['phone_number'], '+12345678')
+        first = response.data['messages'][0]
+        self.assertEqual(first['author_id'], self.user1.id)
+        self.assertNotIn('author', first)
+        self.assertEqual(first['liked_by'], [self.user2.id, self.user3.id])
+
+    def test_chat_detail_default_format_is_nested(self):
+        url = reverse('chat-detail-update', kwargs={'pk': self.chat.id})
+        response = self.client.get(url)
+        self.assertNotIn('users', response.data)
+        self.assertEqual(response.data['messages'][0]['author']['id'], self.user1.id)
+
+    def test_history_pages_backwards(self):
+        url = reverse('chat-messages', kwargs={'pk': self.chat.id})
+        response = self.client.get(url, {'limit': 2})
+        self.assertEqual([m['content'] for m in response.data['messages']], ['m3', 'm4'])
+        self.assertEqual(response.data['next_before'], self.messages[3].id)
+
+        response = self.client.get(url, {'limit': 2, 'before': response.data['next_before'], 'normalized': '1'})
+        self.assertEqual([m['content'] for m in response.data['messages']], ['m1', 'm2'])
+        self.assertEqual(set(response.data['users']), {str(self.user1.id), str(self.user2.id)})
+
+        response = self.client.get(url, {'limit': 2, 'before': response.data['next_before']})
+        self.assertEqual([m['content'] for m in response.data['messages']], ['m0'])
+        self.assertIsNone(response.data['next_before'])
+
+    def test_history_forbidden_for_non_participant(self):
+        self.client.force_authenticate(user=self.user3)
+        response = self.client.get(reverse('chat-messages', kwargs={'pk': self.chat.id}))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class MessagePackAPITests(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(phone_number='+12345678', password='testpass', first_name='A')
+        self.user2 = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        self.chat = Chat.objects.create(chat_name='Group', is_group=True)
+        self.chat.participants.set([self.user1, self.user2])
+        message = Message.objects.create(chat=self.chat, author=self.user2, content='Привет ' * 10)
+        message.likes.add(self.user1)
+        self.client.force_authenticate(user=self.user1)
+
+    def test_codec_round_trip(self):
+        values = [
+            None, True, False, 0, 127, 128, 255, 65536, 2 ** 40, -1, -32, -33, -200, -2 ** 40,
+            1.5, '', 'x' * 31, 'я' * 200, 'z' * 70000, b'\x00\x01', list(range(20)),
+            {str(i): i for i in range(20)}, {'nested': [{'a': [1, {'b': None}]}]},
+        ]
+        for value in values:
+            self.assertEqual(unpackb(packb(value)), value)
+
+    def test_codec_rejects_truncated_data(self):
+        with self.assertRaises(UnpackError):
+            unpackb(packb({'key': 'value'})[:-2])
+
+    def test_chat_detail_matches_json_shape(self):
+        url = reverse('chat-detail-update', kwargs={'pk': self.chat.id})
+        json_response = self.client.get(url, HTTP_ACCEPT='application/json')
+        msgpack_response = self.client.get(url, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(msgpack_response['Content-Type'], 'application/msgpack')
+        self.assertEqual(unpackb(msgpack_response.content), json.loads(json_response.content))
+
+    def test_send_message_with_msgpack_body(self):
+        body = packb({'chat_id': self.chat.id, 'content': 'бинарное сообщение'})
+        response = self.client.post(
+            reverse('message-send'), data=body, content_type='application/msgpack',
+            HTTP_ACCEPT='application/msgpack',
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(unpackb(response.content)['content'], 'бинарное сообщение')
+
+
+class SyncAPITests(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.user2 = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        self.user3 = CustomUser.objects.create_user(phone_number='+11122222', password='testpass')
+        self.chat = Chat.objects.create(chat_name='Group', is_group=True)
+        self.chat.participants.set([self.user1, self.user2])
+        self.other_chat = Chat.objects.create(chat_name='Other', is_group=True)
+        self.other_chat.participants.set([self.user3])
+        self.url = reverse('sync')
+
+    def test_changes_are_returned_in_order(self):
+        start = self.client_sync(self.user1, 0).data['seq']
+
+        self.client.force_authenticate(user=self.user2)
+        message_id = self.client.post(reverse('message-send'), {'chat_id': self.chat.id, 'content': 'hi'}).data['id']
+        self.client.post(reverse('message-like', kwargs={'message_id': message_id}))
+        self.client.patch(reverse('chat-detail-update', kwargs={'pk': self.chat.id}), {'chat_name': 'Renamed'})
+        self.client.patch(reverse('user-profile'), {'first_name': 'Asema'})
+        self.client.force_authenticate(user=self.user3)
+        self.client.post(reverse('message-send'), {'chat_id': self.other_chat.id, 'content': 'secret'})
+
+        response = self.client_sync(self.user1, start)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        changes = response.data['changes']
+        self.assertEqual(
+            [change['kind'] for change in changes],
+            ['message', 'like', 'chat_rename', 'profile'],
+        )
+        self.assertEqual(changes[0]['payload']['content'], 'hi')
+        self.assertTrue(changes[1]['payload']['liked'])
+        self.assertEqual(changes[2]['payload']['chat_name'], 'Renamed')
+        self.assertEqual(changes[3]['payload']['first_name'], 'Asema')
+        self.assertEqual(response.data['seq'], changes[-1]['seq'])
+        self.assertFalse(response.data['has_more'])
+
+    def test_limit_sets_has_more(self):
+        for i in range(3):
+            Message.objects.create(chat=self.chat, author=self.user2, content=str(i))
+            changelog.record(ChangeLogEntry.KIND_MESSAGE, chat_id=self.chat.id, user_id=self.user2.id)
+        response = self.client_sync(self.user1, 0, limit=2)
+        self.assertEqual(len(response.data['changes']), 2)
+        self.assertTrue(response.data['has_more'])
+
+    def test_change_committed_during_sync_is_not_skipped(self):
+        latest_seq = changelog.latest_seq
+
+        def commit_after_bound():
+            # Запись в чат пользователя фиксируется сразу после того, как прочитан конец журнала
+            bound = latest_seq()
+            changelog.record(ChangeLogEntry.KIND_CHAT_RENAME, chat_id=self.chat.id, user_id=self.user2.id,
+                             chat_name='Late')
+            return bound
+
+        with mock.patch.object(changelog, 'latest_seq', side_effect=commit_after_bound):
+            response = self.client_sync(self.user1, 0)
+        self.assertEqual(response.data['changes'], [])
+        response = self.client_sync(self.user1, response.data['seq'])
+        self.assertEqual([change['payload']['chat_name'] for change in response.data['changes']], ['Late'])
+
+    def test_compacted_cursor_requires_resync(self):
+        changelog.record(ChangeLogEntry.KIND_JOIN, chat_id=self.chat.id, user_id=self.user1.id)
+        out = StringIO()
+        call_command('compact_changelog', days=-1, stdout=out)
+        self.assertFalse(ChangeLogEntry.objects.exists())
+
+        response = self.client_sync(self.user1, 0)
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        self.assertTrue(response.data['resync'])
+
+    def client_sync(self, user, since, **params):
+        self.client.force_authenticate(user=user)
+        return self.client.get(self.url, {'since': since, **params})
+
+
+class ChatParticipantsAPITests(APITestCase):
+    def setUp(self):
+        self.members = [
+            CustomUser.objects.create_user(phone_number='+7700%04d' % i, password='testpass', first_name='User%d' % i)
+            for i in range(15)
+        ]
+        self.outsider = CustomUser.objects.create_user(phone_number='+11122222', password='testpass')
+        self.chat = Chat.objects.create(chat_name='Big group', is_group=True)
+        self.chat.participants.set(self.members)
+        self.client.force_authenticate(user=self.members[0])
+
+    def test_member_count_follows_membership_changes(self):
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.member_count, 15)
+        self.chat.participants.add(self.outsider)
+        self.chat.participants.add(self.outsider)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.member_count, 16)
+        self.outsider.chats.remove(self.chat)
+        self.members[1].chats.clear()
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.member_count, 14)
+
+    def test_detail_has_count_and_preview(self):
+        response = self.client.get(reverse('chat-detail-update', kwargs={'pk': self.chat.id}))
+        self.assertEqual(response.data['member_count'], 15)
+        self.assertEqual(response.data['participants'], [user.phone_number for user in self.members[:10]])
+
+    def test_participants_keyset_pages(self):
+        url = reverse('chat-participants', kwargs={'pk': self.chat.id})
+        seen = []
+        after = 0
+        while after is not None:
+            response = self.client.get(url, {'after': after, 'limit': 4})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(user['id'] for user in response.data['results'])
+            after = response.data['next_after']
+        self.assertEqual(seen, [user.id for user in self.members])
+
+    def test_participants_prefix_search(self):
+        url = reverse('chat-participants', kwargs={'pk': self.chat.id})
+        response = self.client.get(url, {'search': '+7700001'})
+        self.assertEqual(
+            [user['phone_number'] for user in response.data['results']],
+            ['+77000010', '+77000011', '+77000012', '+77000013', '+77000014'],
+        )
+        response = self.client.get(url, {'search': 'user3'})
+        self.assertEqual([user['first_name'] for user in response.data['results']], ['User3'])
+
+    def test_participants_are_hidden_from_non_members(self):
+        self.client.force_authenticate(user=self.outsider)
+        url = reverse('chat-participants', kwargs={'pk': self.chat.id})
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.client.get(url, {'search': '+7700'}).status_code, status.HTTP_403_FORBIDDEN)
+
+
+_flaky_calls = []
+
+
+@task_queue.task('tests.flaky', max_attempts=2)
+def flaky_task(fail=False, label=''):
+    _flaky_calls.append(label)
+    if fail:
+        raise RuntimeError('fail')
+
+
+class TaskQueueTests(APITestCase):
+    def setUp(self):
+        _flaky_calls.clear()
+        self.user = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.chat = Chat.objects.create(chat_name='Group', is_group=True)
+        self.chat.participants.set([self.user])
+
+    def test_tasks_run_by_priority(self):
+        task_queue.enqueue('tests.flaky', {'label': 'low'}, priority=-1)
+        task_queue.enqueue('tests.flaky', {'label': 'high'}, priority=5)
+        task_queue.enqueue('tests.flaky', {'label': 'later'}, delay=60)
+
+        self.assertEqual(task_queue.run_pending(), 2)
+        self.assertEqual(_flaky_calls, ['high', 'low'])
+        self.assertEqual(Task.objects.filter(status=Task.STATUS_DONE).count(), 2)
+        self.assertEqual(Task.objects.get(payload__label='later').status, Task.STATUS_PENDING)
+
+    def test_failed_task_is_retried_with_backoff(self):
+        item = flaky_task.enqueue(fail=True)
+        with self.assertLogs('messenger.tasks', level='WARNING'):
+            task_queue.run_pending()
+        item.refresh_from_db()
+        self.assertEqual(item.status, Task.STATUS_PENDING)
+        self.assertEqual(item.attempts, 1)
+        self.assertGreater(item.run_at, timezone.now())
+        self.assertIn('RuntimeError', item.last_error)
+
+        Task.objects.filter(id=item.id).update(run_at=timezone.now())
+        with self.assertLogs('messenger.tasks', level='ERROR'):
+            task_queue.run_pending()
+        item.refresh_from_db()
+        self.assertEqual(item.status, Task.STATUS_FAILED)
+        self.assertEqual(item.attempts, 2)
+
+    def test_claimed_task_is_not_claimed_twice(self):
+        flaky_task.enqueue()
+        self.assertEqual(len(task_queue.claim('first', limit=10)), 1)
+        self.assertEqual(task_queue.claim('second', limit=10), [])
+
+        # Воркер пропал: после истечения аренды задача возвращается в очередь
+        self.assertEqual(task_queue.requeue_stale(lease_seconds=-1), 1)
+        self.assertEqual(len(task_queue.claim('second', limit=10)), 1)
+
+    def test_message_send_enqueues_follow_up(self):
+        Chat.objects.filter(id=self.chat.id).update(updated_at=timezone.now() - datetime.timedelta(days=1))
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(reverse('message-send'), {'chat_id': self.chat.id, 'content': 'hi'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(Task.objects.filter(name='messenger.message_created',
+                                            payload__message_id=response.data['id']).exists())
+
+        out = StringIO()
+        call_command('run_task_worker', once=True, threads=1, stdout=out)
+        self.assertIn('Выполнено задач: 1', out.getvalue())
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.updated_at, Message.objects.get(id=response.data['id']).created_at)
+
+        stats = task_queue.stats()
+        self.assertEqual(stats['messenger.message_created']['done'], 1)
+
+
+class InboxTests(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.user2 = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        self.user3 = CustomUser.objects.create_user(phone_number='+11122222', password='testpass')
+        self.first = Chat.objects.create(chat_name='First', is_group=True)
+        self.first.participants.set([self.user1, self.user2])
+        self.second = Chat.objects.create(chat_name='Second', is_group=True)
+        self.second.participants.set([self.user1, self.user2, self.user3])
+        self.url = reverse('chat-list-create')
+
+    def send(self, user, chat, content='hi'):
+        self.client.force_authenticate(user=user)
+        response = self.client.post(reverse('message-send'), {'chat_id': chat.id, 'content': content})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def chat_list(self, user):
+        self.client.force_authenticate(user=user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(chat['chat_name'], chat['unread']) for chat in response.data['results']]
+
+    def test_entries_follow_membership(self):
+        self.assertEqual(InboxEntry.objects.filter(chat=self.second).count(), 3)
+        self.second.participants.remove(self.user3)
+        self.assertFalse(InboxEntry.objects.filter(user=self.user3).exists())
+        self.user1.chats.clear()
+        self.assertFalse(InboxEntry.objects.filter(user=self.user1).exists())
+
+    def test_message_moves_chat_up_and_counts_unread(self):
+        self.send(self.user2, self.first)
+        self.send(self.user2, self.first)
+        self.send(self.user3, self.second)
+        self.assertEqual(self.chat_list(self.user1), [('Second', 1), ('First', 2)])
+        self.assertEqual(self.chat_list(self.user2), [('Second', 1), ('First', 0)])
+
+        self.client.force_authenticate(user=self.user1)
+        self.client.get(reverse('chat-detail-update', kwargs={'pk': self.first.id}))
+        self.assertEqual(self.chat_list(self.user1), [('Second', 1), ('First', 0)])
+
+    def test_repeated_reads_do_not_write(self):
+        self.send(self.user2, self.first)
+        self.client.force_authenticate(user=self.user1)
+        url = reverse('chat-detail-update', kwargs={'pk': self.first.id})
+        self.client.get(url)
+        read_at = InboxEntry.objects.get(user=self.user1, chat=self.first).last_read_at
+        self.client.get(url)
+        self.first.refresh_from_db()
+        self.assertEqual(inbox.mark_read(self.user1.id, self.first), 0)
+        self.assertEqual(InboxEntry.objects.get(user=self.user1, chat=self.first).last_read_at, read_at)
+
+        self.send(self.user2, self.first)
+        self.assertEqual(self.chat_list(self.user1), [('First', 1), ('Second', 0)])
+        self.client.force_authenticate(user=self.user1)
+        self.client.get(url)
+        self.assertEqual(self.chat_list(self.user1), [('First', 0), ('Second', 0)])
+
+    def test_pinned_chat_comes_first(self):
+        self.send(self.user2, self.second)
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.patch(reverse('chat-settings', kwargs={'pk': self.first.id}), {'pinned': True})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.chat_list(self.user1), [('First', 0), ('Second', 1)])
+
+        self.client.force_authenticate(user=self.user3)
+        response = self.client.patch(reverse('chat-settings', kwargs={'pk': self.first.id}), {'muted': True})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_large_group_is_read_on_fan_out(self):
+        with self.settings(INBOX={'FANOUT_LIMIT': 2}):
+            self.second.participants.remove(self.user3)
+            self.second.participants.add(self.user3)
+            self.assertTrue(InboxEntry.objects.get(chat=self.second, user=self.user1).is_large)
+
+            self.send(self.user2, self.first)
+            self.send(self.user3, self.second)
+            self.send(self.user3, self.second)
+            self.assertEqual(self.chat_list(self.user1), [('Second', 2), ('First', 1)])
+            self.assertEqual(InboxEntry.objects.get(chat=self.second, user=self.user1).unread, 0)
+
+            # Группа уменьшилась: строки снова обновляются при отправке
+            self.second.participants.remove(self.user2)
+            entry = InboxEntry.objects.get(chat=self.second, user=self.user1)
+            self.assertFalse(entry.is_large)
+            self.assertEqual(entry.unread, 2)
+            self.assertEqual(self.chat_list(self.user1), [('Second', 2), ('First', 1)])
+
+
+class ChatListPaginationTests(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.other = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        start = timezone.now() - datetime.timedelta(days=1)
+        self.chats = []
+        for i in range(7):
+            chat = Chat.objects.create(chat_name='Chat %d' % i, is_group=True, last_activity_at=start)
+            chat.participants.set([self.user, self.other])
+            self.chats.append(chat)
+        # Чаты с одинаковой активностью идут по убыванию id
+        for i, chat in enumerate(self.chats[:5]):
+            InboxEntry.objects.filter(chat=chat).update(last_activity=start + datetime.timedelta(minutes=i // 2))
+        self.client.force_authenticate(user=self.user)
+
+    def pages(self, url, **params):
+        names, cursor = [], None
+        while True:
+            response = self.client.get(url, {**params, **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), params['limit'])
+            names.append([chat['chat_name'] for chat in response.data['results']])
+            cursor = response.data['next']
+            if cursor is None:
+                return names
+
+    def test_cursor_walks_all_chats_in_activity_order(self):
+        InboxEntry.objects.filter(user=self.user, chat=self.chats[0]).update(pinned=True)
+        with self.settings(INBOX={'FANOUT_LIMIT': 1}):
+            # Большая группа: активность берётся из чата при чтении
+            self.chats[6].participants.add(CustomUser.objects.create_user(phone_number='+11122222'))
+        Chat.objects.filter(id=self.chats[6].id).update(last_activity_at=timezone.now())
+
+        with self.settings(INBOX={'FANOUT_LIMIT': 1}):
+            pages = self.pages(reverse('chat-list-create'), limit=3)
+        self.assertEqual(pages, [
+            ['Chat 0', 'Chat 6', 'Chat 4'],
+            ['Chat 3', 'Chat 2', 'Chat 5'],
+            ['Chat 1'],
+        ])
+
+    def test_search_is_paginated(self):
+        Chat.objects.filter(id=self.chats[1].id).update(chat_name='Other')
+        pages = self.pages(reverse('chat-search'), q='chat', limit=4)
+        self.assertEqual([len(page) for page in pages], [4, 2])
+        self.assertNotIn('Other', sum(pages, []))
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse('chat-list-create'), {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ThrottlingTests(APITestCase):
+    def setUp(self):
+        throttling.reset()
+        self.user1 = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.user2 = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        self.chat = Chat.objects.create(is_group=False)
+        self.chat.participants.set([self.user1, self.user2])
+        self.message = Message.objects.create(chat=self.chat, author=self.user1, content='like me')
+
+    def test_sliding_window_counts_previous_window(self):
+        store = throttling.MemoryStore(max_keys=10)
+        for _ in range(3):
+            self.assertIsNone(store.hit('key', 3, 60, 1000.0))
+        wait = store.hit('key', 3, 60, 1000.0)
+        self.assertAlmostEqual(wait, 60 - 1000 % 60 + 60 * (1 - 2 / 3))
+
+        # В начале следующего окна предыдущее ещё учитывается почти целиком
+        self.assertIsNotNone(store.hit('key', 3, 60, 1021.0))
+        self.assertIsNone(store.hit('key', 3, 60, 1060.0))
+
+    def test_memory_store_is_bounded(self):
+        store = throttling.MemoryStore(max_keys=2)
+        for key in ['a', 'b', 'a', 'c']:
+            store.hit(key, 10, 60, 0.0)
+        self.assertEqual(list(store.counters), ['a', 'c'])
+
+    def test_like_is_throttled_per_user_with_retry_after(self):
+        rates = {**settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'], 'message_like': '2/min'}
+        url = reverse('message-like', kwargs={'message_id': self.message.id})
+        for store in ['memory', 'cache']:
+            throttling.reset()
+            cache.clear()
+            with self.settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': rates},
+                               THROTTLING={'STORE': store}):
+                self.client.force_authenticate(user=self.user2)
+                for _ in range(2):
+                    self.assertEqual(self.client.post(url).status_code, status.HTTP_200_OK)
+                response = self.client.post(url)
+                self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS, store)
+                self.assertGreater(int(response['Retry-After']), 0)
+
+                # Лимит у каждого пользователя свой
+                self.client.force_authenticate(user=self.user1)
+                self.assertEqual(self.client.post(url).status_code, status.HTTP_200_OK)
+
+
+class CompressedContentTests(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.chat = Chat.objects.create(chat_name='Logs', is_group=True)
+        self.chat.participants.set([self.user])
+        self.long_text = '\n'.join('ERROR Traceback: строка журнала номер %d' % i for i in range(200))
+
+    def raw_content(self, message_id):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT content FROM messenger_message WHERE id = %s', [message_id])
+            return cursor.fetchone()[0]
+
+    def test_long_content_is_stored_compressed_and_read_transparently(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(reverse('message-send'), {'chat_id': self.chat.id, 'content': self.long_text})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        message_id = response.data['id']
+
+        raw = self.raw_content(message_id)
+        self.assertTrue(raw.startswith(MARKER))
+        self.assertLess(len(raw), len(self.long_text.encode('utf-8')) / 4)
+
+        self.assertEqual(Message.objects.get(id=message_id).content, self.long_text)
+        self.assertEqual(serialize_messages(Message.objects.filter(id=message_id))[0]['content'], self.long_text)
+        self.assertEqual(serialize_chats(Chat.objects.filter(id=self.chat.id), None)[0]['last_message'],
+                         self.long_text)
+        entry = ChangeLogEntry.objects.get(kind=ChangeLogEntry.KIND_MESSAGE, chat=self.chat)
+        self.assertEqual(entry.payload['content'], self.long_text)
+
+    def test_short_and_marker_content(self):
+        short = Message.objects.create(chat=self.chat, author=self.user, content='hi')
+        self.assertEqual(self.raw_content(short.id), 'hi')
+        # Текст с маркером в начале сжимается всегда, чтобы его не спутать со сжатым
+        tricky = Message.objects.create(chat=self.chat, author=self.user, content=MARKER + 'abc')
+        self.assertEqual(Message.objects.get(id=tricky.id).content, MARKER + 'abc')
+
+    def test_command_compresses_existing_rows(self):
+        message = Message.objects.create(chat=self.chat, author=self.user, content='legacy')
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE messenger_message SET content = %s WHERE id = %s', [self.long_text, message.id])
+
+        out = StringIO()
+        call_command('compress_messages', dry_run=True, stdout=out)
+        self.assertIn('Можно сжать сообщений: 1', out.getvalue())
+        self.assertFalse(self.raw_content(message.id).startswith(MARKER))
+
+        call_command('compress_messages', batch_size=1, stdout=out)
+        self.assertTrue(self.raw_content(message.id).startswith(MARKER))
+        message.refresh_from_db()
+        self.assertEqual(message.content, self.long_text)
+
+
+class ChunkedUploadTests(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.settings_override = self.settings(
+            MEDIA_ROOT=self.media_root.name,
+            UPLOADS={**uploads.DEFAULTS, 'MAX_CHUNK_SIZE': 1024, 'TEMP_DIR': self.temp_dir.name},
+        )
+        self.settings_override.enable()
+        self.user = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.other = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        self.chat = Chat.objects.create()
+        self.chat.participants.set([self.user, self.other])
+        self.client.force_authenticate(user=self.user)
+        self.data = os.urandom(2500)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.media_root.cleanup()
+        self.temp_dir.cleanup()
+
+    def start(self, **extra):
+        response = self.client.post(reverse('upload-start'), {
+            'filename': 'report.bin', 'size': len(self.data), 'content_type': 'application/octet-stream', **extra,
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['chunk_size'], 1024)
+        return response.data['id']
+
+    def put_chunk(self, upload_id, start, end):
+        return self.client.put(
+            reverse('upload-chunk', args=[upload_id]), self.data[start:end],
+            content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE='bytes %d-%d/%d' % (start, end - 1, len(self.data)),
+        )
+
+    def upload(self, upload_id):
+        for start in range(0, len(self.data), 1024):
+            response = self.put_chunk(upload_id, start, min(start + 1024, len(self.data)))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def finalize(self, upload_id, **extra):
+        # Файл части удаляется после фиксации транзакции
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('upload-finalize', args=[upload_id]),
+                                    {'chat_id': self.chat.id, **extra}, format='json')
+
+    def test_upload_and_finalize_creates_message_with_attachment(self):
+        upload_id = self.start(sha256=hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(self.upload(upload_id).data['offset'], len(self.data))
+
+        response = self.finalize(upload_id, content='Отчёт')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['content'], 'Отчёт')
+        self.assertEqual(len(response.data['attachments']), 1)
+        self.assertEqual(response.data['attachments'][0]['size'], len(self.data))
+
+        attachment = Attachment.objects.get()
+        with attachment.file.open('rb') as stored:
+            self.assertEqual(stored.read(), self.data)
+        self.assertEqual(attachment.sha256, hashlib.sha256(self.data).hexdigest())
+        # Файл части перемещён в хранилище, а не скопирован
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+        self.assertEqual(UploadSession.objects.get().status, UploadSession.STATUS_COMPLETE)
+
+        entry = ChangeLogEntry.objects.get(kind=ChangeLogEntry.KIND_MESSAGE, chat=self.chat)
+        self.assertEqual(entry.payload['attachments'][0]['filename'], 'report.bin')
+        self.assertEqual(InboxEntry.objects.get(user=self.other, chat=self.chat).unread, 1)
+
+        # Быстрая сериализация отдаёт вложения так же, как MessageSerializer
+        request = RequestFactory().get('/')
+        request.user = self.user
+        messages = Message.objects.filter(id=response.data['id'])
+        self.assertEqual(
+            JSONRenderer().render(MessageSerializer(messages, many=True, context={'request': request}).data),
+            FastJSONRenderer().render(serialize_messages(messages, request)),
+        )
+
+        # Повторное завершение не создаёт второе сообщение
+        self.assertEqual(self.finalize(upload_id).status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_finalize_can_be_retried_after_rollback(self):
+        upload_id = self.start(sha256=hashlib.sha256(self.data).hexdigest())
+        self.upload(upload_id)
+        with mock.patch.object(sharding, 'ensure_writable', side_effect=sharding.ChatMoving('Чат переносится')):
+            response = self.finalize(upload_id)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertFalse(Message.objects.exists())
+        session = UploadSession.objects.get()
+        self.assertEqual((session.status, session.received), (UploadSession.STATUS_UPLOADING, len(self.data)))
+        # Часть и хеш на месте, ссылка на файл в хранилище возвращена
+        self.assertEqual(os.listdir(self.temp_dir.name), ['%s.part' % session.pk.hex])
+        self.assertIn(session.pk, uploads._hashers)
+        self.assertEqual(StoredBlob.objects.get().refcount, 0)
+
+        self.assertEqual(self.finalize(upload_id).status_code, status.HTTP_201_CREATED)
+        attachment = Attachment.objects.get()
+        with attachment.file.open('rb') as stored:
+            self.assertEqual(stored.read(), self.data)
+        self.assertEqual(StoredBlob.objects.get(name=attachment.file.name).refcount, 1)
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+    def test_slow_chunk_at_claimed_offset_does_not_overwrite_part(self):
+        upload_id = self.start()
+        session = UploadSession.objects.get()
+        forged = os.urandom(1024)
+
+        class Slow:
+            # Пока тело медленного запроса читается, быстрый успевает засчитать то же смещение
+            def __init__(slow):
+                slow.body, slow.raced = forged, False
+
+            def read(slow, size):
+                if not slow.raced:
+                    slow.raced = True
+                    self.assertEqual(self.put_chunk(upload_id, 0, 1024).status_code, status.HTTP_200_OK)
+                block, slow.body = slow.body[:size], slow.body[size:]
+                return block
+
+        with self.assertRaises(uploads.OffsetMismatch):
+            uploads.write_chunk(session, 0, Slow(), 1024)
+        with open(uploads.part_path(session), 'rb') as part:
+            self.assertEqual(part.read(), self.data[:1024])
+        self.put_chunk(upload_id, 1024, 2048)
+        self.put_chunk(upload_id, 2048, len(self.data))
+        self.assertEqual(self.finalize(upload_id).status_code, status.HTTP_201_CREATED)
+        attachment = Attachment.objects.get()
+        with attachment.file.open('rb') as stored:
+            self.assertEqual(stored.read(), self.data)
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+    def test_part_changed_after_hashing_is_rejected(self):
+        upload_id = self.start()
+        self.upload(upload_id)
+        session = UploadSession.objects.get()
+        with open(uploads.part_path(session), 'r+b') as part:
+            part.write(b'x')
+        self.assertEqual(self.finalize(upload_id).status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertFalse(Attachment.objects.exists())
+        self.assertFalse(StoredBlob.objects.filter(refcount__gt=0).exists())
+
+    def test_wrong_offset_returns_current_offset_for_resume(self):
+        upload_id = self.start()
+        self.assertEqual(self.put_chunk(upload_id, 0, 1024).status_code, status.HTTP_200_OK)
+
+        response = self.put_chunk(upload_id, 2048, 2500)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['offset'], 1024)
+        self.assertEqual(self.client.get(reverse('upload-chunk', args=[upload_id])).data['offset'], 1024)
+
+        self.assertEqual(self.finalize(upload_id).status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.put_chunk(upload_id, 1024, 2048).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.put_chunk(upload_id, 2048, 2500).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.finalize(upload_id).status_code, status.HTTP_201_CREATED)
+
+    def test_same_file_is_stored_once(self):
+        for _ in range(2):
+            upload_id = self.start()
+            self.upload(upload_id)
+            self.assertEqual(self.finalize(upload_id).status_code, status.HTTP_201_CREATED)
+
+        first, second = Attachment.objects.order_by('id')
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(StoredBlob.objects.get(name=first.file.name).refcount, 2)
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+    def test_known_content_needs_no_chunks(self):
+        sha256 = hashlib.sha256(self.data).hexdigest()
+        upload_id = self.start(sha256=sha256)
+        self.upload(upload_id)
+        self.assertEqual(self.finalize(upload_id).status_code, status.HTTP_201_CREATED)
+
+        response = self.client.post(reverse('upload-start'), {
+            'filename': 'copy.bin', 'size': len(self.data), 'sha256': sha256,
+        })
+        self.assertEqual(response.data['received'], len(self.data))
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+        self.assertEqual(self.finalize(response.data['id']).status_code, status.HTTP_201_CREATED)
+        first, second = Attachment.objects.order_by('id')
+        self.assertEqual(second.file.name, first.file.name)
+        self.assertEqual(StoredBlob.objects.get(name=first.file.name).refcount, 2)
+
+    def test_known_content_of_other_user_is_not_revealed(self):
+        sha256 = hashlib.sha256(self.data).hexdigest()
+        upload_id = self.start(sha256=sha256)
+        self.upload(upload_id)
+        self.assertEqual(self.finalize(upload_id).status_code, status.HTTP_201_CREATED)
+
+        # Собеседник знает только хеш: ему придётся загрузить сам файл
+        self.client.force_authenticate(user=self.other)
+        response = self.client.post(reverse('upload-start'), {
+            'filename': 'copy.bin', 'size': len(self.data), 'sha256': sha256,
+        })
+        self.assertEqual(response.data['received'], 0)
+        self.assertEqual(self.finalize(response.data['id']).status_code, status.HTTP_409_CONFLICT)
+        self.upload(response.data['id'])
+        self.assertEqual(self.finalize(response.data['id']).status_code, status.HTTP_201_CREATED)
+        first, second = Attachment.objects.order_by('id')
+        self.assertEqual(second.file.name, first.file.name)
+        self.assertEqual(StoredBlob.objects.get(name=first.file.name).refcount, 2)
+
+    def test_known_content_removed_before_finalize_restarts_upload(self):
+        sha256 = hashlib.sha256(self.data).hexdigest()
+        upload_id = self.start(sha256=sha256)
+        self.upload(upload_id)
+        self.finalize(upload_id)
+        stored = Attachment.objects.get().file
+
+        upload_id = self.start(sha256=sha256)
+        # Файл удалили, пока клиент собирался завершить загрузку
+        os.remove(stored.path)
+        response = self.finalize(upload_id)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['offset'], 0)
+        self.upload(upload_id)
+        self.assertEqual(self.finalize(upload_id).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Attachment.objects.count(), 2)
+
+    def test_hash_is_recomputed_without_in_process_state(self):
+        upload_id = self.start(sha256=hashlib.sha256(self.data).hexdigest())
+        self.upload(upload_id)
+        # Как если бы части принимал другой процесс
+        uploads._hashers.clear()
+        self.assertEqual(self.finalize(upload_id).status_code, status.HTTP_201_CREATED)
+
+    def test_abandoned_hashes_are_evicted(self):
+        with mock.patch.object(uploads, 'MAX_HASHERS', 2):
+            first, second, third = [self.start() for _ in range(3)]
+        self.assertEqual(set(uploads._hashers), {uuid.UUID(second), uuid.UUID(third)})
+        # Хеш без новых частей дольше EXPIRE_HOURS выбрасывается при следующей записи
+        later = time.monotonic() + 25 * 3600
+        with mock.patch.object(uploads.time, 'monotonic', return_value=later):
+            self.put_chunk(third, 0, 1024)
+        self.assertEqual(set(uploads._hashers), {uuid.UUID(third)})
+        # Вытесненный хеш пересчитывается из файла
+        self.upload(first)
+        self.assertEqual(self.finalize(first).status_code, status.HTTP_201_CREATED)
+
+    def test_checksum_mismatch_discards_upload(self):
+        upload_id = self.start(sha256='0' * 64)
+        self.upload(upload_id)
+        self.assertEqual(self.finalize(upload_id).status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+        self.assertFalse(Message.objects.exists())
+
+    def test_limits_and_access(self):
+        upload_id = self.start()
+        response = self.client.put(
+            reverse('upload-chunk', args=[upload_id]), self.data[:2000], content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE='bytes 0-1999/%d' % len(self.data),
+        )
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        response = self.client.put(reverse('upload-chunk', args=[upload_id]), self.data[:10],
+                                   content_type='application/octet-stream')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        stranger = CustomUser.objects.create_user(phone_number='+10000000', password='testpass')
+        self.client.force_authenticate(user=stranger)
+        self.assertEqual(self.client.get(reverse('upload-chunk', args=[upload_id])).status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+    def test_cleanup_removes_expired_uploads(self):
+        upload_id = self.start()
+        self.put_chunk(upload_id, 0, 1024)
+        UploadSession.objects.update(updated_at=timezone.now() - datetime.timedelta(days=2))
+        out = StringIO()
+        call_command('cleanup_uploads', stdout=out)
+        self.assertIn('Удалено загрузок: 1', out.getvalue())
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.settings_override = self.settings(MEDIA_ROOT=self.media_root.name)
+        self.settings_override.enable()
+        self.user = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.chat = Chat.objects.create()
+        self.message = Message.objects.create(chat=self.chat, author=self.user, content='file')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.media_root.cleanup()
+
+    def files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.media_root.name)
+            for root, _, names in os.walk(self.media_root.name)
+            for name in names
+        )
+
+    def test_names_by_content_hash_and_deduplication(self):
+        data = b'same bytes'
+        digest = hashlib.sha256(data).hexdigest()
+        first = default_storage.save('avatars/a.PNG', ContentFile(data))
+        second = default_storage.save('attachments/b.png', ContentFile(data))
+
+        self.assertEqual(first, 'cas/%s/%s/%s.png' % (digest[:2], digest[2:4], digest))
+        self.assertEqual(first, second)
+        self.assertEqual(self.files(), [first])
+        self.assertEqual(StoredBlob.objects.get(name=first).refcount, 2)
+
+        # delete только уменьшает число ссылок: файл может быть нужен другим
+        default_storage.delete(first)
+        self.assertTrue(default_storage.exists(first))
+        self.assertEqual(StoredBlob.objects.get(name=first).refcount, 1)
+
+    def test_declared_hash_is_not_trusted(self):
+        content = ContentFile(b'real bytes')
+        content.sha256 = hashlib.sha256(b'other bytes').hexdigest()
+        name = default_storage.save('attachments/a.txt', content)
+        self.assertEqual(name, storage.stored_name(hashlib.sha256(b'real bytes').hexdigest(), 'a.txt'))
+
+    def test_gc_recounts_references_and_removes_unreferenced_files(self):
+        kept = default_storage.save('a.txt', ContentFile(b'kept'))
+        Attachment.objects.create(message=self.message, file=kept, filename='a.txt', size=4, sha256='')
+        dropped = default_storage.save('b.txt', ContentFile(b'dropped'))
+        orphan = os.path.join(self.media_root.name, 'cas', 'ff', 'ff', 'orphan.txt')
+        os.makedirs(os.path.dirname(orphan))
+        open(orphan, 'w').close()
+
+        out = StringIO()
+        call_command('gc_media', grace_hours=1, stdout=out)
+        # Файлы моложе срока ожидания не трогаем
+        self.assertIn('файлов без ссылок: 0, потерянных файлов: 0', out.getvalue())
+        self.assertTrue(default_storage.exists(dropped))
+
+        call_command('gc_media', grace_hours=0, dry_run=True, stdout=out)
+        self.assertTrue(default_storage.exists(dropped))
+
+        call_command('gc_media', grace_hours=0, stdout=out)
+        self.assertIn('Удалено файлов без ссылок: 1, потерянных файлов: 1', out.getvalue())
+        self.assertEqual(self.files(), [kept])
+        self.assertFalse(StoredBlob.objects.filter(name=dropped).exists())
+        self.assertEqual(StoredBlob.objects.get(name=kept).refcount, 1)
+        self.assertEqual(storage.referenced_names(default_storage), {kept: 1})
+
+
+class LargeTableAdminTests(TestCase):
+    def setUp(self):
+        self.admin = CustomUser.objects.create_superuser(phone_number='+10000000', password='testpass')
+        self.user = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.chat = Chat.objects.create(chat_name='Работа', is_group=True)
+        Message.objects.bulk_create(
+            Message(chat=self.chat, author=self.user, content='m%d' % i) for i in range(120)
+        )
+        self.client.force_login(self.admin)
+        self.url = reverse('admin:messenger_message_changelist')
+
+    def test_changelist_pages_by_keyset(self):
+        ids = list(Message.objects.order_by('-id').values_list('id', flat=True))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([obj.pk for obj in response.context['cl'].result_list], ids[:100])
+        self.assertIn('before=%d' % ids[99], response.context['cl'].older_url)
+
+        response = self.client.get(self.url, {'before': ids[99]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([obj.pk for obj in response.context['cl'].result_list], ids[100:])
+        self.assertIsNone(response.context['cl'].older_url)
+
+    def test_indexed_search(self):
+        response = self.client.get(self.url, {'q': '+12345678'})
+        self.assertEqual(response.context['cl'].result_count, 120)
+        response = self.client.get(self.url, {'q': 'm1'})
+        self.assertEqual(response.context['cl'].result_count, 0)
+
+        response = self.client.get(reverse('admin:messenger_chat_changelist'), {'q': 'Раб'})
+        self.assertEqual([chat.pk for chat in response.context['cl'].result_list], [self.chat.pk])
+        response = self.client.get(reverse('admin:users_customuser_changelist'), {'q': '+1234'})
+        self.assertEqual([user.pk for user in response.context['cl'].result_list], [self.user.pk])
+
+    def test_autocomplete_participants(self):
+        response = self.client.get(reverse('admin:autocomplete'), {
+            'app_label': 'messenger', 'model_name': 'chat', 'field_name': 'participants', 'term': '+123',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.json()['results']], [str(self.user.pk)])
+
+        message = Message.objects.first()
+        for url in [reverse('admin:messenger_chat_change', args=[self.chat.pk]),
+                    reverse('admin:messenger_message_change', args=[message.pk])]:
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_paginator_estimates_unfiltered_count(self):
+        paginator = EstimatedCountPaginator(Message.objects.order_by('-id'), 10)
+        paginator.exact_count_limit = 50
+        Message.objects.filter(id__in=list(Message.objects.values_list('id', flat=True)[:5])).delete()
+        # Без фильтров — оценка по наибольшему id, удалённые строки не вычитаются
+        self.assertEqual(paginator.count, Message.objects.order_by('-id').first().id)
+
+        filtered = EstimatedCountPaginator(Message.objects.filter(chat=self.chat).order_by('-id'), 10)
+        filtered.exact_count_limit = 50
+        self.assertEqual(filtered.count, 51)
+
+
+class OpenApiSchemaTests(TestCase):
+    def setUp(self):
+        self.schema_dir = tempfile.TemporaryDirectory()
+        self.settings_override = self.settings(OPENAPI_SCHEMA_DIR=self.schema_dir.name)
+        self.settings_override.enable()
+        openapi.reset()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.schema_dir.cleanup()
+        openapi.reset()
+
+    def test_build_command_writes_schema(self):
+        out = StringIO()
+        # Предупреждения генератора о view без сериализатора печатаются в stderr
+        with contextlib.redirect_stderr(StringIO()):
+            call_command('build_openapi_schema', stdout=out)
+        with open(os.path.join(self.schema_dir.name, 'schema.json')) as source:
+            schema = json.load(source)
+        self.assertIn('/api/v1/messages/', schema['paths'])
+        self.assertIn('schema.yaml', out.getvalue())
+
+        response = self.client.get(reverse('schema'), {'format': 'json'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), schema)
+
+    def test_schema_is_served_from_file_with_etag(self):
+        for filename in ('schema.yaml', 'schema.json'):
+            with open(os.path.join(self.schema_dir.name, filename), 'w') as output:
+                output.write('openapi: 3.0.3\n' if filename.endswith('yaml') else '{"openapi": "3.0.3"}')
+        response = self.client.get(reverse('schema'))
+        self.assertEqual(response.content, b'openapi: 3.0.3\n')
+        self.assertEqual(response['Content-Type'], 'application/vnd.oai.openapi; charset=utf-8')
+
+        cached = self.client.get(reverse('schema'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(self.client.get(reverse('docs')).status_code, 200)
+
+    def test_docs_views_are_not_imported_at_startup(self):
+        # Сам drf_spectacular.openapi загружает @extend_schema: откладываются
+        # только страницы документации и генератор схемы
+        code = (
+            'import django, sys; django.setup(); import messenger_project.urls; '
+            'print(sorted(m for m in ("drf_spectacular.views", "drf_spectacular.generators", "drf_yasg") '
+            'if m in sys.modules))'
+        )
+        output = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=settings.BASE_DIR,
+            env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'messenger_project.settings'},
+        )
+        self.assertEqual(output.stdout.strip(), '[]')
+
+
+class ProductionSqliteTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'production.sqlite3')
+        handler = ConnectionHandler({
+            'default': {**settings_production.DATABASES['default'], 'NAME': self.path},
+        })
+        self.production = handler['default']
+
+    def tearDown(self):
+        self.production.close()
+        self.directory.cleanup()
+
+    def test_pragmas_are_applied_on_connect(self):
+        with self.production.cursor() as cursor:
+            pragmas = {}
+            for name in ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size'):
+                cursor.execute('PRAGMA %s' % name)
+                pragmas[name] = cursor.fetchone()[0]
+        # synchronous: 1 — NORMAL
+        self.assertEqual(pragmas, {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000,
+                                   'cache_size': -64 * 1024})
+        self.assertEqual(settings_production.DATABASES['default']['CONN_MAX_AGE'], 600)
+        self.assertTrue(settings_production.DATABASES['default']['CONN_HEALTH_CHECKS'])
+
+    def test_atomic_takes_write_lock_immediately(self):
+        self.production.ensure_connection()
+        self.production._start_transaction_under_autocommit()
+        other = sqlite3.connect(self.path, timeout=0)
+        try:
+            with self.assertRaisesMessage(sqlite3.OperationalError, 'database is locked'):
+                other.execute('BEGIN IMMEDIATE')
+        finally:
+            other.close()
+            self.production.connection.rollback()
+
+    def test_maintenance_command(self):
+        out = StringIO()
+        call_command('sqlite_maintenance', '--optimize', stdout=out)
+        self.assertIn('PRAGMA optimize', out.getvalue())
+        # Тестовая база в памяти без WAL
+        self.assertIn('не в режиме WAL', out.getvalue())
+
+
+class GroupCommitTests(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.user2 = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        self.user3 = CustomUser.objects.create_user(phone_number='+11122222', password='testpass')
+        self.chat = Chat.objects.create(chat_name='Group', is_group=True)
+        self.chat.participants.set([self.user1, self.user2, self.user3])
+
+    def test_batch_has_same_effect_as_sequential_sends(self):
+        sent = services.send_batch([
+            (self.chat, self.user2, 'a', None),
+            (self.chat, self.user1, 'b', None),
+            (self.chat, self.user2, 'c', None),
+            (self.chat, self.user1, 'd', 'key-1'),
+            (self.chat, self.user1, 'd', 'key-1'),
+        ])
+        self.assertEqual([message.content for message in sent], ['a', 'b', 'c', 'd', 'd'])
+        self.assertIs(sent[3], sent[4])
+        self.assertEqual(Message.objects.filter(chat=self.chat).count(), 4)
+        self.assertEqual(ChangeLogEntry.objects.filter(kind=ChangeLogEntry.KIND_MESSAGE).count(), 4)
+        self.assertEqual(Task.objects.filter(name='messenger.message_created').count(), 4)
+
+        unread = dict(InboxEntry.objects.filter(chat=self.chat).values_list('user_id', 'unread'))
+        # Автор прочитал чат на своём последнем сообщении
+        self.assertEqual(unread, {self.user1.id: 0, self.user2.id: 1, self.user3.id: 4})
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_activity_at, sent[3].created_at)
+
+        again = services.send_batch([(self.chat, self.user1, 'd', 'key-1')])
+        self.assertEqual(again[0].pk, sent[3].pk)
+
+    def test_writer_batches_queued_items_and_falls_back_per_item(self):
+        batches = []
+        first_started, release = threading.Event(), threading.Event()
+
+        def write_batch(items):
+            batches.append(list(items))
+            if len(batches) == 1:
+                first_started.set()
+                release.wait(5)
+            if 'bad' in items:
+                raise ValueError('bad')
+            return [item.upper() for item in items]
+
+        def write_one(item):
+            if item == 'bad':
+                raise ValueError(item)
+            return item.upper()
+
+        writer = GroupCommitWriter(write_batch, write_one)
+        with self.settings(GROUP_COMMIT={'MAX_BATCH': 10, 'MAX_DELAY_MS': 0, 'TIMEOUT': 5}):
+            first = writer.submit('a')
+            self.assertTrue(first_started.wait(5))
+            # Пока пишется первая пачка, остальные копятся в очереди
+            queued = [writer.submit(item) for item in ('b', 'c', 'bad')]
+            with self.assertLogs('messenger.group_commit', 'ERROR'):
+                release.set()
+                self.assertEqual(first.result(5), 'A')
+                self.assertEqual([future.result(5) for future in queued[:2]], ['B', 'C'])
+            with self.assertRaises(ValueError):
+                queued[2].result(5)
+        self.assertEqual(batches, [['a'], ['b', 'c', 'bad']])
+        stats = writer.stats()
+        self.assertEqual((stats['batches'], stats['items'], stats['fallbacks']), (2, 4, 1))
+
+    def test_caller_stops_waiting_after_timeout(self):
+        release = threading.Event()
+        writer = GroupCommitWriter(lambda items: release.wait(5) and items, lambda item: item)
+        with self.settings(GROUP_COMMIT={'TIMEOUT': 0.05}):
+            with self.assertRaises(GroupCommitTimeout):
+                writer.call('a')
+        release.set()
+
+    def test_timeout_is_reported_as_503(self):
+        self.client.force_authenticate(user=self.user1)
+        with mock.patch('messenger.serializers.send_message', side_effect=GroupCommitTimeout('timeout')):
+            response = self.client.post(reverse('message-send'), {'chat_id': self.chat.id, 'content': 'hi'})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '1')
+
+
+SHARDS = ['shard_1', 'shard_2']
+
+
+class MessageShardingTests(APITransactionTestCase):
+    # Шардов нет в DATABASES, пока их не подключит setUpClass
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        # Шарды — временные файлы SQLite, подключаемые только на время этих тестов
+        cls.directory = tempfile.TemporaryDirectory()
+        for alias in SHARDS:
+            connections.settings[alias] = {
+                **connections.settings['default'],
+                'NAME': os.path.join(cls.directory.name, alias + '.sqlite3'),
+            }
+            call_command('migrate', database=alias, verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for alias in SHARDS:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        cls.directory.cleanup()
+
+    def setUp(self):
+        shards = self.settings(MESSAGE_SHARDS={'SHARDS': SHARDS, 'MOVE_GRACE_SECONDS': 0})
+        shards.enable()
+        self.addCleanup(shards.disable)
+        sharding.reset()
+        self.addCleanup(sharding.reset)
+        self.user1 = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.user2 = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        self.chat = Chat.objects.create(chat_name='Group', is_group=True)
+        self.chat.participants.set([self.user1, self.user2])
+
+    def test_ring_moves_few_keys_when_shard_added(self):
+        before = sharding.HashRing(['a', 'b', 'c'])
+        after = sharding.HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in range(10000) if before.node_for(key) != after.node_for(key)]
+        self.assertTrue(all(after.node_for(key) == 'd' for key in moved))
+        self.assertLess(len(moved), 4000)
+
+    def test_messages_live_in_chat_shard(self):
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.post(reverse('message-send'), {'chat_id': self.chat.id, 'content': 'hi'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        shard = ChatShard.objects.get(chat=self.chat).shard
+        self.assertIn(shard, SHARDS)
+        self.assertFalse(Message.objects.filter(chat=self.chat).exists())
+        message = Message.objects.using(shard).get(chat_id=self.chat.id)
+
+        self.client.force_authenticate(user=self.user2)
+        response = self.client.post(reverse('message-like', args=[message.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(sharding.likes(shard).values_list('customuser_id', flat=True)), [self.user2.id])
+
+        response = self.client.get(reverse('chat-messages', kwargs={'pk': self.chat.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['content'] for item in response.data['messages']], ['hi'])
+        self.assertEqual(InboxEntry.objects.get(chat=self.chat, user=self.user2).unread, 1)
+
+    def test_ids_are_unique_across_shards(self):
+        chats = [Chat.objects.create(chat_name='Chat %d' % index, is_group=True) for index in range(8)]
+        sent = [services.send_message(chat, self.user1, 'hi') for chat in chats]
+        self.assertEqual(len({message.pk for message in sent}), len(sent))
+        self.assertEqual({sharding.db_for_chat(chat.pk) for chat in chats}, set(SHARDS))
+
+    def test_move_chat_keeps_ids_and_likes(self):
+        sent = [services.send_message(self.chat, self.user1, text) for text in ('a', 'b')]
+        source = sharding.db_for_chat(self.chat.pk)
+        target = next(alias for alias in SHARDS if alias != source)
+        sent[0].likes.add(self.user2)
+
+        out = StringIO()
+        call_command('rebalance_message_shards', '--chat', str(self.chat.pk), '--to', target, stdout=out)
+        self.assertIn('сообщений: 2', out.getvalue())
+        self.assertEqual(sharding.db_for_chat(self.chat.pk), target)
+        self.assertFalse(Message.objects.using(source).exists())
+        self.assertEqual(list(sharding.messages(self.chat.pk).order_by('pk').values_list('pk', flat=True)),
+                         [message.pk for message in sent])
+        self.assertEqual(sharding.likes(target).get().message_id, sent[0].pk)
+
+    def test_chat_purge_deletes_messages_in_shard(self):
+        message = services.send_message(self.chat, self.user1, 'a')
+        shard = sharding.db_for_chat(self.chat.pk)
+        message.likes.add(self.user2)
+        purge.run(purge.schedule(PurgeJob.KIND_CHAT, self.chat.pk, background=False))
+        self.assertFalse(Message.objects.using(shard).exists())
+        self.assertFalse(sharding.likes(shard).exists())
+        self.assertFalse(ChatShard.objects.exists())
+        self.assertFalse(Chat.objects.filter(pk=self.chat.pk).exists())
+
+    def test_send_is_refused_while_chat_moves(self):
+        services.send_message(self.chat, self.user1, 'a')
+        ChatShard.objects.filter(chat=self.chat).update(moving_to='default')
+        with self.assertRaises(sharding.ChatMoving):
+            services.send_message(self.chat, self.user1, 'b')
+
+
+class SingleFlightTests(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.user2 = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        self.chat = Chat.objects.create(is_group=False)
+        self.chat.participants.set([self.user1, self.user2])
+        self.message = Message.objects.create(chat=self.chat, author=self.user1, content='hi')
+        self.message.likes.add(self.user1)
+
+    def test_concurrent_callers_share_one_computation(self):
+        flight = SingleFlight('test')
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {'value': len(calls)}
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('key', compute)))
+        leader.start()
+        self.assertTrue(started.wait(5))
+        waiters = [threading.Thread(target=lambda: results.append(flight.do('key', compute))) for _ in range(4)]
+        for thread in waiters:
+            thread.start()
+        # Ожидающие уже в таблице: вызовов больше, чем вычислений
+        while flight.stats()['calls'] < 5:
+            time.sleep(0.001)
+        release.set()
+        for thread in [leader, *waiters]:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result is results[0] for result in results))
+        stats = flight.stats()
+        self.assertEqual((stats['calls'], stats['leaders'], stats['shared'], stats['in_flight']), (5, 1, 4, 0))
+        # Это не кеш: следующий вызов вычисляет заново
+        flight.do('key', compute)
+        self.assertEqual(len(calls), 2)
+
+    def test_async_callers_share_one_computation(self):
+        flight = SingleFlight('test-async')
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        async def run():
+            return await asyncio.gather(*[flight.do_async('key', compute) for _ in range(10)])
+
+        self.assertEqual(asyncio.run(run()), [1] * 10)
+        self.assertEqual(flight.stats()['shared'], 9)
+
+    def test_error_reaches_waiters_and_frees_key(self):
+        flight = SingleFlight('test-errors')
+        with self.assertRaises(ValueError):
+            flight.do('key', mock.Mock(side_effect=ValueError('boom')))
+        self.assertEqual(flight.do('key', lambda: 'ok'), 'ok')
+        self.assertEqual(flight.stats()['errors'], 1)
+
+    def test_summary_is_logged_once_per_interval(self):
+        flight = SingleFlight('test-report')
+        with self.settings(SINGLE_FLIGHT={'REPORT_INTERVAL': 0}), \
+                self.assertLogs('messenger.singleflight', 'INFO') as logs:
+            flight.do('key', lambda: 'ok')
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('test-report за 0 с: вызовов 1, вычислений 1', logs.output[0])
+
+        with self.settings(SINGLE_FLIGHT={'REPORT_INTERVAL': 3600}), \
+                mock.patch('messenger.singleflight.logger') as logger:
+            flight.do('key', lambda: 'ok')
+        logger.log.assert_not_called()
+
+    def test_shared_detail_is_personalized(self):
+        request = RequestFactory().get('/')
+        request.user = self.user1
+        shared = shared_chat_detail(self.chat, request)
+        request2 = RequestFactory().get('/')
+        request2.user = self.user2
+
+        first = personal_chat_detail(shared, self.chat, request)
+        second = personal_chat_detail(shared, self.chat, request2)
+        self.assertEqual((first['chat_name'], second['chat_name']), ('+87654321', '+12345678'))
+        self.assertEqual((first['messages'][0]['liked'], second['messages'][0]['liked']), (True, False))
+        self.assertIsNone(shared[0]['chat_name'])
+
+    def test_detail_matches_uncoalesced_response(self):
+        self.client.force_authenticate(user=self.user2)
+        url = reverse('chat-detail-update', kwargs={'pk': self.chat.id})
+        with self.settings(SINGLE_FLIGHT={'ENABLED': False}):
+            expected = self.client.get(url).json()
+        views.chat_detail_flight.reset_stats()
+        self.assertEqual(self.client.get(url).json(), expected)
+        self.assertEqual(views.chat_detail_flight.stats()['leaders'], 1)
+
+
+class AdmissionControlTests(APITestCase):
+    def controller(self, max_concurrency=1, **classes):
+        config = {'MAX_CONCURRENCY': max_concurrency, 'CLASSES': {
+            name: {'PRIORITY': priority, 'CONCURRENCY': 1, 'QUEUE': queue, 'TIMEOUT_MS': timeout_ms}
+            for name, (priority, queue, timeout_ms) in classes.items()
+        }}
+        return admission.AdmissionController(config)
+
+    def test_full_queue_and_deadline_shed(self):
+        controller = self.controller(default=(1, 0, 50), bulk=(2, 1, 20))
+        self.assertIsNone(controller.acquire('default'))
+        self.assertEqual(controller.acquire('default'), admission.SHED_QUEUE_FULL)
+        self.assertEqual(controller.acquire('bulk'), admission.SHED_TIMEOUT)
+        controller.release('default')
+        self.assertIsNone(controller.acquire('bulk'))
+        stats = controller.stats()
+        self.assertEqual((stats['default']['shed'], stats['bulk']['shed'], stats['bulk']['peak_queue']), (1, 1, 1))
+        self.assertEqual((stats['bulk']['active'], stats['bulk']['queued']), (1, 0))
+
+    def test_higher_priority_waiter_goes_first(self):
+        controller = self.controller(critical=(0, 5, 5000), default=(1, 5, 5000), bulk=(2, 5, 5000))
+        self.assertIsNone(controller.acquire('default'))
+        admitted = []
+
+        def wait(name):
+            controller.acquire(name)
+            admitted.append(name)
+            controller.release(name)
+
+        threads = [threading.Thread(target=wait, args=(name,)) for name in ('bulk', 'critical')]
+        for thread in threads:
+            thread.start()
+            # Ждём, пока поток встанет в очередь, чтобы bulk был первым
+            while sum(item['queued'] for item in controller.stats().values()) < threads.index(thread) + 1:
+                time.sleep(0.001)
+        controller.release('default')
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(admitted, ['critical', 'bulk'])
+
+    def test_middleware_sheds_with_503_and_releases_slots(self):
+        user = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.client.force_authenticate(user=user)
+        with self.settings(ADMISSION_CONTROL={**settings.ADMISSION_CONTROL, 'ENABLED': True}):
+            response = self.client.get(reverse('chat-search'), {'q': 'x'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(admission.stats()['bulk']['admitted'], 1)
+            self.assertEqual(admission.stats()['bulk']['active'], 0)
+
+            with mock.patch.object(admission.AdmissionController, 'acquire', return_value=admission.SHED_TIMEOUT):
+                response = self.client.get(reverse('chat-search'), {'q': 'x'})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '1')
+
+
+class PurgeTests(APITestCase):
+    def setUp(self):
+        purge_settings = self.settings(PURGE={'CHUNK_SIZE': 2, 'PAUSE_MS': 0, 'TASK_SECONDS': 60})
+        purge_settings.enable()
+        self.addCleanup(purge_settings.disable)
+        self.user1 = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.user2 = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        self.user3 = CustomUser.objects.create_user(phone_number='+11122222', password='testpass')
+        self.chat = Chat.objects.create(chat_name='Group', is_group=True)
+        self.chat.participants.set([self.user1, self.user2, self.user3])
+        self.other = Chat.objects.create(chat_name='Other', is_group=True)
+        self.other.participants.set([self.user1, self.user2])
+        self.sent = [services.send_message(self.chat, [self.user1, self.user2][i % 2], 'm%d' % i) for i in range(5)]
+        self.kept = services.send_message(self.other, self.user2, 'kept')
+        self.sent[0].likes.add(self.user2, self.user3)
+        self.kept.likes.add(self.user1)
+        self.attachment = Attachment.objects.create(
+            message=self.sent[1], file='attachments/a.txt', filename='a.txt', size=1, sha256='0' * 64)
+
+    def test_chat_purge_deletes_everything_of_chat_only(self):
+        changes = ChangeLogEntry.objects.filter(chat_id=self.chat.pk).count()
+        out = StringIO()
+        call_command('purge', '--chat', str(self.chat.pk), stdout=out)
+        self.assertIn('удалено строк', out.getvalue())
+
+        self.assertFalse(Chat.objects.filter(pk=self.chat.pk).exists())
+        self.assertFalse(Message.objects.filter(chat_id=self.chat.pk).exists())
+        self.assertFalse(Attachment.objects.exists())
+        self.assertEqual(list(Message.likes.through.objects.values_list('message_id', flat=True)), [self.kept.pk])
+        self.assertFalse(InboxEntry.objects.filter(chat_id=self.chat.pk).exists())
+        self.assertFalse(ChangeLogEntry.objects.filter(chat_id=self.chat.pk).exists())
+        self.assertEqual(Message.objects.get().pk, self.kept.pk)
+        job = PurgeJob.objects.get()
+        self.assertEqual((job.status, job.stage), (PurgeJob.STATUS_DONE, 'chat'))
+        # 5 сообщений, 2 лайка, вложение, 3 строки списков, 3 участника, журнал и сам чат
+        self.assertEqual(job.deleted, 5 + 2 + 1 + 3 + 3 + changes + 1)
+
+    def test_interrupted_job_resumes_from_cursor(self):
+        job = purge.schedule(PurgeJob.KIND_CHAT, self.chat.pk, background=False)
+        self.assertFalse(purge.run(job, seconds=0))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.stage, job.deleted), (PurgeJob.STATUS_RUNNING, 'inbox', 2))
+        self.assertEqual(InboxEntry.objects.filter(chat_id=self.chat.pk).count(), 1)
+        # Повторное планирование находит незавершённое задание
+        self.assertEqual(purge.schedule(PurgeJob.KIND_CHAT, self.chat.pk, background=False).pk, job.pk)
+
+        call_command('purge', '--resume', stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, PurgeJob.STATUS_DONE)
+        self.assertFalse(Chat.objects.filter(pk=self.chat.pk).exists())
+
+    def test_background_job_continues_in_new_tasks(self):
+        purge.schedule(PurgeJob.KIND_CHAT, self.chat.pk)
+        with self.settings(PURGE={'CHUNK_SIZE': 2, 'PAUSE_MS': 0, 'TASK_SECONDS': 0}):
+            for _ in range(20):
+                if not task_queue.run_pending():
+                    break
+        self.assertEqual(PurgeJob.objects.get().status, PurgeJob.STATUS_DONE)
+        self.assertGreater(Task.objects.filter(name=purge.TASK_NAME, status=Task.STATUS_DONE).count(), 1)
+        self.assertFalse(Chat.objects.filter(pk=self.chat.pk).exists())
+
+    def test_user_purge_keeps_chats_consistent(self):
+        job = purge.schedule(PurgeJob.KIND_USER, self.user2.pk, background=False)
+        purge.run(job)
+        self.assertFalse(CustomUser.objects.filter(pk=self.user2.pk).exists())
+        self.assertEqual(set(Message.objects.values_list('author_id', flat=True)), {self.user1.pk})
+        # Лайк user2 снят, лайк user3 на сообщении user1 остался, а лайк user1 был на сообщении user2
+        self.assertEqual(list(Message.likes.through.objects.values_list('customuser_id', flat=True)), [self.user3.pk])
+        self.chat.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual((self.chat.member_count, self.other.member_count), (2, 1))
+
+    def test_user_purge_announces_deletions_in_changelog(self):
+        ChangeLogEntry.objects.create(kind=ChangeLogEntry.KIND_CHAT_RENAME, chat=self.chat, user=self.user2,
+                                      payload={'chat_name': 'Group'})
+        start = changelog.latest_seq()
+        purge.run(purge.schedule(PurgeJob.KIND_USER, self.user2.pk, background=False))
+
+        self.assertFalse(ChangeLogEntry.objects.filter(kind=ChangeLogEntry.KIND_MESSAGE, payload__message_id__in=[
+            self.sent[1].pk, self.sent[3].pk, self.kept.pk]).exists())
+        # Переименование осталось, но без автора
+        rename = ChangeLogEntry.objects.get(kind=ChangeLogEntry.KIND_CHAT_RENAME)
+        self.assertIsNone(rename.user_id)
+        new = ChangeLogEntry.objects.filter(seq__gt=start)
+        deleted = new.filter(kind=ChangeLogEntry.KIND_MESSAGES_DELETED)
+        self.assertEqual(
+            sorted((entry.chat_id, message_id) for entry in deleted for message_id in entry.payload['message_ids']),
+            [(self.chat.pk, self.sent[1].pk), (self.chat.pk, self.sent[3].pk), (self.other.pk, self.kept.pk)],
+        )
+        removed = new.filter(kind=ChangeLogEntry.KIND_MEMBERS)
+        self.assertEqual(sorted((entry.chat_id, entry.payload['removed']) for entry in removed),
+                         [(self.chat.pk, [self.user2.pk]), (self.other.pk, [self.user2.pk])])
+        self.assertFalse(ChangeLogCompaction.objects.exists())
+
+    def test_expired_messages_are_deleted_by_chat_ttl(self):
+        old = timezone.now() - datetime.timedelta(days=3)
+        Message.objects.filter(pk__in=[message.pk for message in self.sent[:3]]).update(created_at=old)
+        Message.objects.filter(pk=self.kept.pk).update(created_at=old)
+        ChangeLogEntry.objects.create(kind=ChangeLogEntry.KIND_CHAT_RENAME, chat=self.chat, user=self.user1,
+                                      payload={'chat_name': 'Group'})
+        ChangeLogEntry.objects.filter(chat=self.chat).update(created_at=old)
+        Chat.objects.filter(pk=self.chat.pk).update(message_ttl_days=2)
+
+        call_command('purge', '--expired', stdout=StringIO())
+        self.assertEqual(list(Message.objects.filter(chat=self.chat).values_list('content', flat=True)), ['m3', 'm4'])
+        self.assertTrue(Message.objects.filter(pk=self.kept.pk).exists())
+        self.assertFalse(Attachment.objects.exists())
+        # Из журнала уходят только тексты истёкших сообщений, а клиенты узнают об их удалении
+        kinds = list(ChangeLogEntry.objects.filter(chat=self.chat).values_list('kind', flat=True))
+        self.assertNotIn(ChangeLogEntry.KIND_MESSAGE, kinds)
+        self.assertIn(ChangeLogEntry.KIND_CHAT_RENAME, kinds)
+        deleted = ChangeLogEntry.objects.filter(chat=self.chat, kind=ChangeLogEntry.KIND_MESSAGES_DELETED)
+        self.assertEqual([message_id for entry in deleted for message_id in entry.payload['message_ids']],
+                         [message.pk for message in self.sent[:3]])
+        self.assertFalse(ChangeLogCompaction.objects.exists())
+
+    def test_ttl_is_set_through_api(self):
+        self.user1.is_staff = True
+        self.user1.save(update_fields=['is_staff'])
+        self.client.force_authenticate(user=self.user1)
+        url = reverse('chat-detail-update', kwargs={'pk': self.chat.id})
+        response = self.client.patch(url, {'message_ttl_days': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.patch(url, {'message_ttl_days': 7})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(url).data['message_ttl_days'], 7)
+
+    def test_only_members_update_chat_and_only_staff_set_group_ttl(self):
+        outsider = CustomUser.objects.create_user(phone_number='+19999999', password='testpass')
+        url = reverse('chat-detail-update', kwargs={'pk': self.chat.id})
+        self.client.force_authenticate(user=outsider)
+        self.assertEqual(self.client.patch(url, {'message_ttl_days': 1}).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.client.patch(url, {'chat_name': 'Mine'}).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.user2)
+        self.assertEqual(self.client.patch(url, {'message_ttl_days': 1}).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.client.patch(url, {'chat_name': 'Renamed'}).status_code, status.HTTP_200_OK)
+        self.chat.refresh_from_db()
+        self.assertEqual((self.chat.chat_name, self.chat.message_ttl_days), ('Renamed', None))
+
+
+class BulkMembershipTests(APITestCase):
+    def setUp(self):
+        self.owner = CustomUser.objects.create_user(phone_number='+10000000', password='testpass')
+        self.users = [CustomUser.objects.create_user(phone_number='+2%07d' % i, password='testpass') for i in range(6)]
+        self.chat = Chat.objects.create(chat_name='Group', is_group=True)
+        self.chat.participants.set([self.owner, self.users[0]])
+        self.add_url = reverse('chat-participants-add', kwargs={'pk': self.chat.pk})
+        self.remove_url = reverse('chat-participants-remove', kwargs={'pk': self.chat.pk})
+        self.client.force_authenticate(user=self.owner)
+
+    def members(self):
+        return set(self.chat.participants.values_list('id', flat=True))
+
+    def test_add_by_phone_and_id_skips_members_and_reports_missing(self):
+        changes = ChangeLogEntry.objects.count()
+        response = self.client.post(self.add_url, {
+            'phone_numbers': [self.users[0].phone_number, self.users[1].phone_number, '+99999999'],
+            'user_ids': [self.users[2].id, self.users[1].id, 987654],
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['added'], [self.users[1].id, self.users[2].id])
+        self.assertEqual(response.data['already_members'], [self.users[0].id])
+        self.assertEqual(response.data['not_found'], {'phone_numbers': ['+99999999'], 'user_ids': [987654]})
+        self.assertEqual(response.data['member_count'], 4)
+        self.assertEqual(self.members(), {self.owner.id, *[user.id for user in self.users[:3]]})
+        self.assertTrue(InboxEntry.objects.filter(chat=self.chat, user=self.users[2]).exists())
+        # Одна запись журнала на всё изменение
+        self.assertEqual(ChangeLogEntry.objects.count(), changes + 1)
+        entry = ChangeLogEntry.objects.latest('seq')
+        self.assertEqual((entry.kind, entry.user_id), (ChangeLogEntry.KIND_MEMBERS, self.owner.id))
+        self.assertEqual(entry.payload, {'added': [self.users[1].id, self.users[2].id]})
+
+        # Повтор ничего не меняет и не пишет в журнал
+        response = self.client.post(self.add_url, {'user_ids': [self.users[1].id]}, format='json')
+        self.assertEqual((response.data['added'], response.data['member_count']), ([], 4))
+        self.assertEqual(ChangeLogEntry.objects.count(), changes + 1)
+
+    def test_remove_members(self):
+        self.owner.is_staff = True
+        self.owner.save(update_fields=['is_staff'])
+        self.chat.participants.add(*self.users[1:4])
+        response = self.client.post(self.remove_url, {
+            'phone_numbers': [self.users[1].phone_number],
+            'user_ids': [self.users[2].id, self.users[5].id],
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['removed'], [self.users[1].id, self.users[2].id])
+        self.assertEqual(response.data['not_members'], [self.users[5].id])
+        self.assertEqual(response.data['member_count'], 3)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.member_count, 3)
+        self.assertEqual(self.members(), {self.owner.id, self.users[0].id, self.users[3].id})
+        self.assertFalse(InboxEntry.objects.filter(chat=self.chat, user__in=self.users[1:3]).exists())
+        self.assertEqual(ChangeLogEntry.objects.latest('seq').payload, {'removed': [self.users[1].id, self.users[2].id]})
+
+    def test_member_can_remove_only_themself(self):
+        self.chat.participants.add(self.users[1])
+        response = self.client.post(self.remove_url, {'user_ids': [self.users[0].id, self.users[1].id]},
+                                    format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.members(), {self.owner.id, self.users[0].id, self.users[1].id})
+
+        response = self.client.post(self.remove_url, {'user_ids': [self.owner.id]}, format='json')
+        self.assertEqual((response.status_code, response.data['removed']), (200, [self.owner.id]))
+        self.assertEqual(self.members(), {self.users[0].id, self.users[1].id})
+
+    def test_query_count_does_not_grow_with_batch(self):
+        extra = [CustomUser(phone_number='+3%07d' % i) for i in range(40)]
+        CustomUser.objects.bulk_create(extra)
+        small = CustomUser.objects.filter(phone_number__startswith='+3').order_by('id')[:2]
+        with CaptureQueriesContext(connection) as few:
+            self.client.post(self.add_url, {'phone_numbers': [user.phone_number for user in small]}, format='json')
+        with CaptureQueriesContext(connection) as many:
+            self.client.post(self.add_url, {
+                'phone_numbers': list(CustomUser.objects.filter(phone_number__startswith='+3')
+                                      .values_list('phone_number', flat=True)),
+            }, format='json')
+        self.assertEqual(self.chat.participants.count(), 2 + 40)
+        self.assertEqual(len(many), len(few))
+
+    def test_rejects_non_members_private_chats_and_empty_requests(self):
+        self.assertEqual(self.client.post(self.add_url, {}, format='json').status_code, 400)
+        private = Chat.objects.create(is_group=False)
+        private.participants.set([self.owner, self.users[0]])
+        url = reverse('chat-participants-add', kwargs={'pk': private.pk})
+        self.assertEqual(self.client.post(url, {'user_ids': [self.users[1].id]}, format='json').status_code, 400)
+        self.client.force_authenticate(user=self.users[5])
+        response = self.client.post(self.add_url, {'user_ids': [self.users[5].id]}, format='json')
+        self.assertEqual(response.status_code, 403)
+
+
+class ScheduledMessageTests(APITestCase):
+    def setUp(self):
+        scheduled_settings = self.settings(SCHEDULED_MESSAGES={
+            **scheduled.DEFAULTS, 'BATCH_SIZE': 2, 'PRELOAD': 4, 'REFRESH_SECONDS': 0,
+        })
+        scheduled_settings.enable()
+        self.addCleanup(scheduled_settings.disable)
+        self.user1 = CustomUser.objects.create_user(phone_number='+12345678', password='testpass')
+        self.user2 = CustomUser.objects.create_user(phone_number='+87654321', password='testpass')
+        self.chat = Chat.objects.create(chat_name='Group', is_group=True)
+        self.chat.participants.set([self.user1, self.user2])
+        self.url = reverse('scheduled-messages')
+        self.client.force_authenticate(user=self.user1)
+        self.now = timezone.now()
+
+    def schedule(self, minutes, content='later', author=None):
+        return ScheduledMessage.objects.create(
+            chat=self.chat, author=author or self.user1, content=content,
+            send_at=self.now + datetime.timedelta(minutes=minutes),
+        )
+
+    def test_create_list_and_cancel(self):
+        send_at = self.now + datetime.timedelta(hours=1)
+        response = self.client.post(self.url, {'chat_id': self.chat.id, 'content': 'hi', 'send_at': send_at},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['status'], ScheduledMessage.STATUS_PENDING)
+        self.assertEqual([item['id'] for item in self.client.get(self.url).data], [response.data['id']])
+
+        past = self.client.post(self.url, {'chat_id': self.chat.id, 'content': 'hi', 'send_at': self.now},
+                                format='json')
+        self.assertEqual(past.status_code, 400)
+        other = Chat.objects.create(chat_name='Other', is_group=True)
+        foreign = self.client.post(self.url, {'chat_id': other.id, 'content': 'hi', 'send_at': send_at},
+                                   format='json')
+        self.assertEqual(foreign.status_code, 400)
+
+        cancel_url = reverse('scheduled-message-cancel', kwargs={'pk': response.data['id']})
+        self.client.force_authenticate(user=self.user2)
+        self.assertEqual(self.client.delete(cancel_url).status_code, 404)
+        self.client.force_authenticate(user=self.user1)
+        self.assertEqual(self.client.delete(cancel_url).status_code, 204)
+        self.assertEqual(self.client.delete(cancel_url).status_code, 404)
+        self.assertEqual(self.client.get(self.url).data, [])
+
+    def test_dispatcher_sends_due_messages_through_send_path(self):
+        due = [self.schedule(minutes, 'm%d' % minutes) for minutes in (1, 2)]
+        future = self.schedule(120)
+        cancelled = self.schedule(1)
+        scheduled.cancel(self.user1, cancelled.pk)
+
+        dispatcher = scheduled.Dispatcher()
+        sleep = dispatcher.tick(self.now + datetime.timedelta(minutes=5))
+        self.assertEqual(dispatcher.stats()['sent'], 2)
+        for item in due:
+            item.refresh_from_db()
+            self.assertEqual(item.status, ScheduledMessage.STATUS_SENT)
+            message = Message.objects.get(pk=item.message_id)
+            self.assertEqual((message.content, message.author_id), (item.content, self.user1.id))
+            self.assertEqual(message.client_message_id, 'scheduled:%d' % item.pk)
+        self.assertEqual(Message.objects.count(), 2)
+        # Сообщение прошло тем же путём: журнал и строки списков чатов
+        self.assertEqual(ChangeLogEntry.objects.filter(kind=ChangeLogEntry.KIND_MESSAGE).count(), 2)
+        self.assertEqual(InboxEntry.objects.get(chat=self.chat, user=self.user2).unread, 2)
+        future.refresh_from_db()
+        self.assertEqual(future.status, ScheduledMessage.STATUS_PENDING)
+        # REFRESH_SECONDS=0: следующий проход сразу
+        self.assertEqual(sleep, 0)
+
+    def test_restart_after_crash_does_not_send_twice(self):
+        item = self.schedule(1)
+        # Прошлый диспетчер отправил сообщение и упал, не успев отметить расписание
+        [message] = services.send_batch([(self.chat, self.user1, item.content, item.client_message_id)])
+        scheduled.Dispatcher().tick(self.now + datetime.timedelta(minutes=5))
+        item.refresh_from_db()
+        self.assertEqual((item.status, item.message_id), (ScheduledMessage.STATUS_SENT, message.pk))
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_window_is_loaded_in_parts_and_picks_up_new_schedules(self):
+        items = [self.schedule(minutes) for minutes in range(1, 8)]
+        dispatcher = scheduled.Dispatcher()
+        later = self.now + datetime.timedelta(minutes=30)
+        dispatcher.tick(later)
+        # PRELOAD=4: за проход загружается и отправляется не больше четырёх
+        self.assertEqual(dispatcher.stats()['sent'], 4)
+        fresh = self.schedule(10)
+        for _ in range(3):
+            dispatcher.tick(later)
+        self.assertEqual(dispatcher.stats()['sent'], len(items) + 1)
+        self.assertFalse(scheduled.pending().exists())
+        fresh.refresh_from_db()
+        self.assertEqual(fresh.status, ScheduledMessage.STATUS_SENT)
+
+    def test_author_who_left_chat_is_not_sent(self):
+        item = self.schedule(1, author=self.user2)
+        self.chat.participants.remove(self.user2)
+        out = StringIO()
+        with mock.patch('django.utils.timezone.now', return_value=self.now + datetime.timedelta(minutes=5)):
+            call_command('run_scheduler', '--once', stdout=out)
+        self.assertIn('не отправлено: 1', out.getvalue())
+        item.refresh_from_db()
+        self.assertEqual(item.status, ScheduledMessage.STATUS_FAILED)
+        self.assertFalse(Message.objects.exists())
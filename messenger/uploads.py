@@ -0,0 +1,385 @@
+"""Загрузка вложений по частям с продолжением после обрыва
+
+Протокол:
+
+1. POST /api/v1/uploads/ с именем, размером и (необязательно) SHA-256
+   файла создаёт UploadSession и пустой файл части в TEMP_DIR.
+2. PUT /api/v1/uploads/<id>/ с заголовком Content-Range: bytes a-b/size
+   дописывает часть со смещения a. Смещение должно совпадать с уже
+   полученным объёмом, иначе 409 с текущим offset. GET/HEAD того же
+   адреса возвращает offset, с которого продолжать после обрыва.
+3. POST /api/v1/uploads/<id>/finalize/ проверяет размер и хеш и в одной
+   транзакции создаёт сообщение с вложением.
+
+Тело части читается из запроса блоками по BLOCK_SIZE во временный файл
+рядом с частью, минуя обработчики загрузки Django, поэтому память не
+зависит от размера части. В файл части оно переносится только под
+блокировкой этого файла и после повторной проверки смещения: медленный
+запрос с тем же offset не перезапишет часть, которую уже засчитали
+другому. SHA-256 считается по мере переноса объектом hashlib в памяти
+процесса; если части приходили в разные процессы или процесс
+перезапускался, хеш пересчитывается потоковым чтением файла при
+завершении. Хранилище этому хешу не верит и само хеширует файл. Если при начале загрузки указан SHA-256 файла, который уже
+есть в хранилище и на который ссылается сам пользователь (его вложение или
+аватар), части не нужны: загрузка сразу считается полученной (received ==
+size), и finalize прикрепляет существующий файл. Чужие файлы так не
+находятся: иначе по одному хешу можно было бы узнать, загружал ли кто-то
+документ, и прикрепить его, не имея содержимого; их загрузка идёт
+обычным путём, а повторно файл не сохранится уже в хранилище.
+
+Готовый файл не копируется: в хранилище перемещается жёсткая ссылка на
+часть, а сама часть удаляется после фиксации сообщения, так что после
+отката finalize можно повторить.
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File, locks
+from django.db import transaction
+from django.utils import timezone
+
+from messenger_project.storage import stored_name
+from users.models import CustomUser
+from . import sharding
+from .models import Attachment, UploadSession
+from .services import send_message
+
+DEFAULTS = {
+    'MAX_SIZE': 100 * 1024 * 1024,
+    'MAX_CHUNK_SIZE': 8 * 1024 * 1024,
+    'TEMP_DIR': None,
+    'EXPIRE_HOURS': 24,
+}
+
+# Такими блоками читается тело части и файл при пересчёте хеша
+BLOCK_SIZE = 64 * 1024
+
+# Столько незавершённых хешей держит процесс; вытесненный хеш
+# пересчитается из файла при завершении
+MAX_HASHERS = 1000
+
+# {id загрузки: (offset, hashlib-объект по первым offset байтам, время
+# последней части)} в порядке последнего обращения. Загрузки, брошенные
+# клиентом, удаляет cleanup() — часто в другом процессе, поэтому хеши без
+# новых частей дольше EXPIRE_HOURS выбрасываются здесь же
+_hashers = OrderedDict()
+_hashers_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """Запрос загрузки нельзя выполнить; status — код ответа"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class OffsetMismatch(UploadError):
+    """Часть пришла не с того смещения; offset — сколько уже получено"""
+
+    def __init__(self, offset):
+        super().__init__('Ожидается часть со смещения %d' % offset, status=409)
+        self.offset = offset
+
+
+def get_config():
+    """Настройки загрузки с подставленными значениями по умолчанию"""
+    return {**DEFAULTS, **getattr(settings, 'UPLOADS', {})}
+
+
+def temp_dir():
+    return get_config()['TEMP_DIR'] or os.path.join(settings.BASE_DIR, 'upload_tmp')
+
+
+def part_path(session):
+    """Файл, в который пишутся части загрузки"""
+    return os.path.join(temp_dir(), '%s.part' % session.pk.hex)
+
+
+def parse_content_range(header, length, size):
+    """Смещение части из 'bytes a-b/size'; UploadError, если заголовок неверен"""
+    try:
+        unit, _, spec = header.partition(' ')
+        span, _, total = spec.partition('/')
+        start, _, end = span.partition('-')
+        start, end = int(start), int(end)
+        if unit != 'bytes' or (total != '*' and int(total) != size):
+            raise ValueError(header)
+    except ValueError:
+        raise UploadError('Ожидается заголовок Content-Range: bytes начало-конец/%d' % size) from None
+    if end - start + 1 != length:
+        raise UploadError('Content-Range не совпадает с длиной тела')
+    return start
+
+
+def _take_hasher(session_id, offset):
+    """Забирает хеш, если он посчитан ровно по первым offset байтам"""
+    with _hashers_lock:
+        state = _hashers.pop(session_id, None)
+    if state is None or state[0] != offset:
+        return None
+    return state[1]
+
+
+def _put_hasher(session_id, offset, digest):
+    now = time.monotonic()
+    idle_since = now - get_config()['EXPIRE_HOURS'] * 3600
+    with _hashers_lock:
+        _hashers[session_id] = (offset, digest, now)
+        _hashers.move_to_end(session_id)
+        while _hashers:
+            oldest = next(iter(_hashers.values()))
+            if len(_hashers) <= MAX_HASHERS and oldest[2] >= idle_since:
+                break
+            _hashers.popitem(last=False)
+
+
+def file_sha256(path):
+    """SHA-256 файла, читая его блоками"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as part:
+        for block in iter(lambda: part.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _references(user, name):
+    """Ссылается ли пользователь на файл name своим вложением или аватаром"""
+    if CustomUser.objects.filter(pk=user.pk, avatar=name).exists():
+        return True
+    return any(
+        Attachment.objects.using(db).filter(file=name, message__author_id=user.pk).exists()
+        for db in sharding.message_databases()
+    )
+
+
+def _known_blob(user, sha256, filename, size):
+    """Имя уже сохранённого файла пользователя с этим хешем и размером или None"""
+    storage = Attachment._meta.get_field('file').storage
+    if not sha256 or not hasattr(storage, 'reference'):
+        return None
+    name = stored_name(sha256, filename)
+    if not storage.exists(name) or storage.size(name) != size or not _references(user, name):
+        return None
+    return name
+
+
+def start(user, filename, size, content_type='', sha256=''):
+    """Создаёт загрузку и пустой файл для её частей
+
+    Если файл с объявленным sha256 у пользователя уже есть в хранилище,
+    загружать нечего: загрузка сразу получает received == size, и finalize
+    прикрепит этот файл.
+    """
+    filename = os.path.basename(filename)
+    known = _known_blob(user, sha256, filename, size) is not None
+    session = UploadSession.objects.create(
+        user=user, filename=filename, content_type=content_type, size=size, sha256=sha256,
+        received=size if known else 0,
+    )
+    if known:
+        return session
+    os.makedirs(temp_dir(), exist_ok=True)
+    open(part_path(session), 'wb').close()
+    _put_hasher(session.pk, 0, hashlib.sha256())
+    return session
+
+
+def write_chunk(session, offset, stream, length):
+    """Дописывает length байт из stream со смещения offset; возвращает новый offset
+
+    Если тело оборвалось раньше, засчитывается то, что успело прийти:
+    клиент узнает offset из ответа и продолжит с него.
+    """
+    config = get_config()
+    if session.status != UploadSession.STATUS_UPLOADING:
+        raise UploadError('Загрузка уже завершена', status=409)
+    if length > config['MAX_CHUNK_SIZE']:
+        raise UploadError('Часть больше %d байт' % config['MAX_CHUNK_SIZE'], status=413)
+    if offset + length > session.size:
+        raise UploadError('Часть выходит за объявленный размер файла')
+    if offset != session.received:
+        raise OffsetMismatch(session.received)
+
+    path = part_path(session)
+    chunk = '%s.%s' % (path, uuid.uuid4().hex[:12])
+    try:
+        # Тело читается из сети без блокировки, во временный файл
+        written = 0
+        with open(chunk, 'wb') as spooled:
+            while written < length:
+                block = stream.read(min(BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                spooled.write(block)
+                written += len(block)
+        # O_CREAT без O_TRUNC: файл части мог потеряться, но уже записанное не затираем
+        with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600), 'wb') as part:
+            locks.lock(part, locks.LOCK_EX)
+            # Под блокировкой в часть пишет только тот, кому досталось смещение
+            session.refresh_from_db(fields=['received', 'status'])
+            if session.status != UploadSession.STATUS_UPLOADING:
+                raise UploadError('Загрузка уже завершена', status=409)
+            if session.received != offset:
+                raise OffsetMismatch(session.received)
+            digest = _take_hasher(session.pk, offset)
+            part.seek(offset)
+            with open(chunk, 'rb') as spooled:
+                for block in iter(lambda: spooled.read(BLOCK_SIZE), b''):
+                    part.write(block)
+                    if digest is not None:
+                        digest.update(block)
+            part.flush()
+            UploadSession.objects.filter(pk=session.pk).update(received=offset + written, updated_at=timezone.now())
+            if digest is not None:
+                _put_hasher(session.pk, offset + written, digest)
+    finally:
+        _remove(chunk)
+    session.received = offset + written
+    return session.received
+
+
+class PartFile(File):
+    """Файл части: хранилище переместит его, а не скопирует"""
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def discard(session):
+    """Удаляет загрузку вместе с файлом части"""
+    with _hashers_lock:
+        _hashers.pop(session.pk, None)
+    _remove(part_path(session))
+    session.delete()
+
+
+def finalize(session, chat, author, content=''):
+    """Проверяет файл и создаёт сообщение с вложением; возвращает сообщение"""
+    if session.status != UploadSession.STATUS_UPLOADING:
+        raise UploadError('Загрузка уже завершена', status=409)
+    if session.received != session.size:
+        raise UploadError('Файл загружен не полностью: %d из %d байт' % (session.received, session.size),
+                          status=409)
+
+    path = part_path(session)
+    digest = None
+    if not os.path.exists(path):
+        # Файл с объявленным хешем уже был в хранилище при start()
+        name = _reference_known(session)
+        if name is None:
+            _restart(session)
+        sha256 = session.sha256
+    else:
+        digest = _take_hasher(session.pk, session.size)
+        sha256 = digest.hexdigest() if digest is not None else file_sha256(path)
+        if session.sha256 and sha256 != session.sha256:
+            discard(session)
+            raise UploadError('Контрольная сумма не совпадает, загрузите файл заново', status=422)
+        # Файл сохраняется в хранилище до транзакции отправки, из жёсткой
+        # ссылки на часть: если транзакция откатится, часть и хеш останутся
+        # на месте и повтор finalize пройдёт заново, а ссылку на файл мы вернём сами
+        name = _store(session, path, sha256)
+        if name is None:
+            discard(session)
+            raise UploadError('Контрольная сумма не совпадает, загрузите файл заново', status=422)
+    # id выделяется до транзакции отправки (см. messenger/sharding.py)
+    [attachment_id] = sharding.allocate_ids(Attachment, 1)
+
+    def attach(message):
+        # Условный UPDATE: два одновременных finalize не создадут два сообщения
+        claimed = UploadSession.objects.filter(pk=session.pk, status=UploadSession.STATUS_UPLOADING).update(
+            status=UploadSession.STATUS_COMPLETE)
+        if not claimed:
+            raise UploadError('Загрузка уже завершена', status=409)
+        attachment = Attachment(
+            id=attachment_id, message=message, filename=session.filename, content_type=session.content_type,
+            size=session.size, sha256=sha256,
+        )
+        attachment.file.name = name
+        attachment.save(force_insert=True)
+        UploadSession.objects.filter(pk=session.pk).update(attachment=attachment)
+        return [attachment]
+
+    try:
+        message = send_message(chat, author, content, attach=attach)
+    except Exception:
+        Attachment._meta.get_field('file').storage.delete(name)
+        if digest is not None:
+            _put_hasher(session.pk, session.size, digest)
+        raise
+    # Часть больше не нужна, когда сообщение зафиксировано
+    transaction.on_commit(lambda: _remove(path))
+    session.status = UploadSession.STATUS_COMPLETE
+    return message
+
+
+def _reference_known(session):
+    """Ссылка на уже сохранённый файл загрузки; его имя или None"""
+    name = _known_blob(session.user, session.sha256, session.filename, session.size)
+    if name is None or not Attachment._meta.get_field('file').storage.reference(name):
+        return None
+    return name
+
+
+def _restart(session):
+    """Файла нет ни в части, ни в хранилище: загрузка начинается сначала"""
+    UploadSession.objects.filter(pk=session.pk, status=UploadSession.STATUS_UPLOADING).update(
+        received=0, updated_at=timezone.now())
+    os.makedirs(temp_dir(), exist_ok=True)
+    open(part_path(session), 'wb').close()
+    _put_hasher(session.pk, 0, hashlib.sha256())
+    session.received = 0
+    raise OffsetMismatch(0)
+
+
+def _store(session, path, sha256):
+    """Сохраняет файл части в хранилище, не трогая саму часть
+
+    Возвращает имя в хранилище или None, если хранилище по хешу насчитало
+    не sha256: файл части изменился после подсчёта хеша.
+    """
+    staged = '%s.%s' % (path, uuid.uuid4().hex[:12])
+    try:
+        os.link(path, staged)
+    except OSError:
+        # Файловая система без жёстких ссылок
+        shutil.copyfile(path, staged)
+    field = Attachment._meta.get_field('file')
+    filename = field.generate_filename(None, session.filename)
+    try:
+        with open(staged, 'rb') as part:
+            name = field.storage.save(filename, PartFile(part))
+    finally:
+        # Хранилище перемещает файл к себе или удаляет, если такой уже есть
+        _remove(staged)
+    if hasattr(field.storage, 'reference') and name != stored_name(sha256, filename):
+        field.storage.delete(name)
+        return None
+    return name
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def cleanup(hours=None):
+    """Удаляет загрузки без новых частей дольше hours часов; возвращает их число"""
+    hours = hours if hours is not None else get_config()['EXPIRE_HOURS']
+    expired = UploadSession.objects.filter(updated_at__lt=timezone.now() - timedelta(hours=hours))
+    count = 0
+    for session in expired.iterator():
+        discard(session)
+        count += 1
+    return count
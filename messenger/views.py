@@ -3,8 +3,20 @@ from rest_framework.generics import CreateAPIView
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from django.db import transaction
+from django.db.models import Q
 from django.shortcuts import get_object_or_404
-from .models import Chat, Message
+from . import changelog, inbox, membership, scheduled, sharding, singleflight, uploads
+from .group_commit import GroupCommitTimeout
+from .models import ChangeLogEntry, Chat, InboxEntry, Message, UploadSession
+from users.fast_serializers import serialize_users
+from users.models import CustomUser
+from .fast_serializers import (
+    serialize_inbox,
+    serialize_messages,
+    serialize_messages_normalized,
+    wants_normalized,
+)
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
 
 from .serializers import (
@@ -12,19 +24,85 @@ from .serializers import (
     ChatListSerializer,
     MessageCreateSerializer,
     ChatDetailSerializer,
-    ChatUpdateSerializer
+    ChatUpdateSerializer,
+    InboxSettingsSerializer,
+    MembershipChangeSerializer,
+    ScheduledMessageSerializer,
+    UploadFinalizeSerializer,
+    UploadStartSerializer,
+    chat_detail_version,
+    participants_preview,
+    personal_chat_detail,
+    shared_chat_detail,
 )
 
+# Одновременные одинаковые запросы GET /api/v1/chats/<pk>/ в процессе
+# ждут одно вычисление (messenger/singleflight.py)
+chat_detail_flight = singleflight.SingleFlight('chat-detail')
+
+
+def retry_later(exc):
+    """503 с Retry-After: запись временно невозможна, повтор безопасен"""
+    return Response({'detail': str(exc)}, status=503, headers={'Retry-After': '1'})
+
+
 @extend_schema(
     summary="Создать сообщение",
     description="Создаёт новое сообщение в чате",
     request=MessageCreateSerializer,
-    responses={201: MessageCreateSerializer}
+    responses={
+        201: MessageCreateSerializer,
+        503: OpenApiResponse(description="Запись не подтверждена вовремя, повторите с тем же client_message_id"),
+    }
 )
 class MessageCreateAPIView(CreateAPIView):
     """Создание сообщения и добавление его в чат"""
     permission_classes = [IsAuthenticated]
     serializer_class = MessageCreateSerializer
+    throttle_scope = 'message_send'
+    admission_class = 'critical'
+
+    def create(self, request, *args, **kwargs):
+        try:
+            return super().create(request, *args, **kwargs)
+        except (GroupCommitTimeout, sharding.ChatMoving) as exc:
+            return retry_later(exc)
+
+
+@extend_schema(
+    summary="Запланированные сообщения",
+    description="GET — ожидающие отправки сообщения пользователя по времени; POST — запланировать сообщение "
+                "в чат на send_at. Отправляет их диспетчер python manage.py run_scheduler",
+    request=ScheduledMessageSerializer,
+    responses={200: ScheduledMessageSerializer(many=True), 201: ScheduledMessageSerializer},
+)
+class ScheduledMessageListCreateAPIView(generics.ListCreateAPIView):
+    """Запланировать сообщение или посмотреть запланированные"""
+    permission_classes = [IsAuthenticated]
+    serializer_class = ScheduledMessageSerializer
+
+    def get_queryset(self):
+        # Ожидающих у пользователя не больше MAX_PENDING_PER_USER
+        return scheduled.pending().filter(author=self.request.user).order_by('send_at', 'id')
+
+
+@extend_schema(
+    summary="Отменить запланированное сообщение",
+    description="Отменяет сообщение, которое ещё не отправлено",
+    parameters=[OpenApiParameter(name='pk', location=OpenApiParameter.PATH, required=True, type=int)],
+    responses={
+        204: OpenApiResponse(description="Отменено"),
+        404: OpenApiResponse(description="Нет такого ожидающего сообщения"),
+    }
+)
+class ScheduledMessageCancelAPIView(APIView):
+    """Отмена запланированного сообщения автором"""
+    permission_classes = [IsAuthenticated]
+
+    def delete(self, request, pk):
+        if not scheduled.cancel(request.user, pk):
+            return Response({'detail': 'Сообщение не найдено или уже отправлено.'}, status=404)
+        return Response(status=204)
 
 
 @extend_schema(
@@ -36,37 +114,84 @@ class MessageCreateAPIView(CreateAPIView):
 class MessageLikeAPIView(APIView):
     """Поставить или снять лайк с сообщения"""
     permission_classes = [IsAuthenticated]
+    throttle_scope = 'message_like'
+    admission_class = 'critical'
 
     def post(self, request, message_id):
         user = request.user
-        message = get_object_or_404(Message, id=message_id)
+        message = get_object_or_404(Message.objects.using(sharding.find_message_db(message_id)), id=message_id)
 
         # Проверяем, есть ли пользователь в этом чате
-        if user not in message.chat.participants.all():
+        if not message.chat.participants.filter(id=user.id).exists():
             return Response(status=403)
 
+        try:
+            db = sharding.db_for_write(message.chat_id)
+        except sharding.ChatMoving as exc:
+            return retry_later(exc)
+        # Лайки лежат в базе сообщения, а пользователи — в default, поэтому
+        # работаем с таблицей лайков напрямую, а не через message.likes
+        like = sharding.likes(db).filter(message_id=message.id, customuser_id=user.id)
         # Если лайк уже был  убираем, иначе добавляем
-        if message.likes.filter(id=user.id).exists():
-            message.likes.remove(user)
-            liked = False
-        else:
-            message.likes.add(user)
-            liked = True
+        with transaction.atomic():
+            with transaction.atomic(using=db):
+                if like.exists():
+                    like.delete()
+                    liked = False
+                else:
+                    sharding.likes(db).create(message_id=message.id, customuser_id=user.id)
+                    liked = True
+                sharding.ensure_writable(message.chat_id, db)
+            changelog.record(
+                ChangeLogEntry.KIND_LIKE,
+                chat_id=message.chat_id,
+                user_id=user.id,
+                message_id=message.id,
+                liked=liked,
+            )
         return Response({'liked': liked}, status=200)
 
 
+class InboxPageMixin:
+    """Страница списка чатов по курсору: {'results': [...], 'next': курсор или None}"""
+    default_limit = 30
+    max_limit = 100
+
+    def inbox_page(self, request, search=None):
+        try:
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            return Response({'error': 'limit должен быть числом.'}, status=400)
+        if limit < 1:
+            return Response({'error': 'limit должен быть больше нуля.'}, status=400)
+        try:
+            entries, next_cursor = inbox.chat_list(
+                request.user.id, cursor=request.query_params.get('cursor'), limit=limit, search=search)
+        except inbox.InvalidCursor:
+            return Response({'error': 'Неверный курсор.'}, status=400)
+        return Response({'results': serialize_inbox(entries, request), 'next': next_cursor})
+
+
+INBOX_PAGE_PARAMETERS = [
+    OpenApiParameter(name='cursor', location='query', required=False, type=str),
+    OpenApiParameter(name='limit', location='query', required=False, type=int),
+]
+
+
 @extend_schema(
     summary="Список чатов и создание",
-    description="Показывает чаты пользователя или создаёт новый чат",
+    description="Показывает чаты пользователя по последней активности страницами по курсору "
+                "(next из ответа) или создаёт новый чат",
+    parameters=INBOX_PAGE_PARAMETERS,
     responses={200: ChatListSerializer, 201: ChatCreateSerializer}
 )
-class ChatListCreateAPIView(generics.ListCreateAPIView):
+class ChatListCreateAPIView(InboxPageMixin, generics.ListCreateAPIView):
     """Показать список чатов или создать новый чат"""
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
         # Вернуть все чаты, где участвует пользователь
-        return Chat.objects.filter(participants=self.request.user).order_by('-created_at')
+        return Chat.objects.filter(participants=self.request.user).order_by('-last_activity_at')
 
     def get_serializer_class(self):
         # Для создания чата один сериализатор, для списка другой
@@ -74,10 +199,15 @@ class ChatListCreateAPIView(generics.ListCreateAPIView):
             return ChatCreateSerializer
         return ChatListSerializer
 
+    def list(self, request, *args, **kwargs):
+        # Страница строк InboxEntry пользователя, по последней активности
+        return self.inbox_page(request)
+
 
 @extend_schema(
     summary="Получить или обновить чат",
-    description="Получает детали чата или обновляет его",
+    description="Получает детали чата или обновляет его. Обновлять чат могут только участники, "
+                "а срок хранения сообщений в группе — только администратор (is_staff)",
     responses={
         200: ChatDetailSerializer,
         403: OpenApiResponse(description="Нет доступа")
@@ -101,14 +231,15 @@ class ChatRetrieveUpdateAPIView(generics.RetrieveUpdateAPIView):
         chat = self.get_object()
 
         # Если пользователь не участвует в чате
-        if request.user not in chat.participants.all():
+        if not chat.participants.filter(id=request.user.id).exists():
             if chat.is_group:
                 # Если это группа — покажем базовую инфу без сообщений
                 return Response({
                     'chat_id': chat.id,
                     'chat_name': chat.chat_name,
                     'is_group': chat.is_group,
-                    'participants': [p.phone_number for p in chat.participants.all()],
+                    'participants': participants_preview(chat),
+                    'member_count': chat.member_count,
                     'messages': [],
                     'access': False,  # Пользователь не в чате
                 })
@@ -116,10 +247,214 @@ class ChatRetrieveUpdateAPIView(generics.RetrieveUpdateAPIView):
             return Response({'detail': 'Forbidden'}, status=403)
 
         # Если пользователь участник  покажем полную инфу
-        data = self.get_serializer(chat).data
+        inbox.mark_read(request.user.id, chat)
+        if singleflight.enabled():
+            # Страница ответа: формат и адрес сервера в ссылках на вложения
+            page = (wants_normalized(request), request.scheme, request.get_host())
+            key = (chat.pk, chat_detail_version(chat), page)
+            shared = chat_detail_flight.do(key, lambda: shared_chat_detail(chat, request))
+            data = personal_chat_detail(shared, chat, request)
+        else:
+            data = self.get_serializer(chat).data
         data['access'] = True  # Есть доступ
         return Response(data, status=200)
 
+    def update(self, request, *args, **kwargs):
+        chat = self.get_object()
+        if not chat.participants.filter(id=request.user.id).exists():
+            return Response({'detail': 'Forbidden'}, status=403)
+        # Срок хранения удаляет историю всех участников, а ролей в группах нет
+        if chat.is_group and 'message_ttl_days' in request.data and not request.user.is_staff:
+            return Response({'detail': 'Forbidden'}, status=403)
+        return super().update(request, *args, **kwargs)
+
+
+@extend_schema(
+    summary="История сообщений чата",
+    description="Страница сообщений старше before, по возрастанию времени. "
+                "С normalized=true авторы и лайкнувшие вынесены в общий словарь users",
+    parameters=[
+        OpenApiParameter(name='pk', location=OpenApiParameter.PATH, required=True, type=int),
+        OpenApiParameter(name='before', location='query', required=False, type=int),
+        OpenApiParameter(name='limit', location='query', required=False, type=int),
+        OpenApiParameter(name='normalized', location='query', required=False, type=bool),
+    ],
+    responses={
+        200: OpenApiResponse(description="Сообщения и курсор next_before"),
+        403: OpenApiResponse(description="Нет доступа")
+    }
+)
+class ChatMessagesAPIView(APIView):
+    """История сообщений чата страницами от новых к старым"""
+    permission_classes = [IsAuthenticated]
+    default_limit = 50
+    max_limit = 200
+
+    def get(self, request, pk):
+        chat = get_object_or_404(Chat, pk=pk)
+        if not chat.participants.filter(id=request.user.id).exists():
+            return Response({'detail': 'Forbidden'}, status=403)
+
+        try:
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+            before = request.query_params.get('before')
+            before = int(before) if before else None
+        except ValueError:
+            return Response({'error': 'before и limit должны быть числами.'}, status=400)
+        if limit < 1:
+            return Response({'error': 'limit должен быть больше нуля.'}, status=400)
+
+        # Keyset по id: страница не дороже первой, сколько бы её ни листали
+        messages = sharding.messages(chat.pk)
+        ids = messages.order_by('-id')
+        if before is not None:
+            ids = ids.filter(id__lt=before)
+        page_ids = list(ids.values_list('id', flat=True)[:limit + 1])
+        next_before = page_ids[limit - 1] if len(page_ids) > limit else None
+        page = messages.filter(id__in=page_ids[:limit]).order_by('created_at', 'id')
+
+        if wants_normalized(request):
+            messages, users = serialize_messages_normalized(page, request)
+            return Response({'messages': messages, 'users': users, 'next_before': next_before})
+        return Response({'messages': serialize_messages(page, request), 'next_before': next_before})
+
+
+@extend_schema(
+    summary="Участники чата",
+    description="Участники чата страницами по id, с поиском по началу номера или имени. Только для участников чата",
+    parameters=[
+        OpenApiParameter(name='pk', location=OpenApiParameter.PATH, required=True, type=int),
+        OpenApiParameter(name='after', location='query', required=False, type=int),
+        OpenApiParameter(name='search', location='query', required=False, type=str),
+        OpenApiParameter(name='limit', location='query', required=False, type=int),
+    ],
+    responses={
+        200: OpenApiResponse(description="Участники, member_count и курсор next_after"),
+        403: OpenApiResponse(description="Нет доступа")
+    }
+)
+class ChatParticipantsAPIView(APIView):
+    """Участники чата постранично, для больших групп"""
+    permission_classes = [IsAuthenticated]
+    default_limit = 50
+    max_limit = 200
+
+    def get(self, request, pk):
+        chat = get_object_or_404(Chat, pk=pk)
+        # Профили участников видят только участники: не участнику группы
+        # детали чата показывают лишь номера первых из них
+        if not chat.participants.filter(id=request.user.id).exists():
+            return Response({'detail': 'Forbidden'}, status=403)
+
+        try:
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+            after = int(request.query_params.get('after', 0))
+        except ValueError:
+            return Response({'error': 'after и limit должны быть числами.'}, status=400)
+        if limit < 1:
+            return Response({'error': 'limit должен быть больше нуля.'}, status=400)
+
+        members = CustomUser.objects.filter(chats=chat, id__gt=after)
+        search = request.query_params.get('search', '').strip()
+        if search:
+            members = members.filter(Q(phone_number__startswith=search) | Q(first_name__istartswith=search))
+        # Keyset по id: каждая страница — короткий проход по индексу участников
+        page = list(serialize_users(members.order_by('id')[:limit + 1], request))
+        next_after = page[limit - 1]['id'] if len(page) > limit else None
+        return Response({
+            'results': page[:limit],
+            'member_count': chat.member_count,
+            'next_after': next_after,
+        })
+
+
+class MembershipChangeAPIView(APIView):
+    """Общая часть массового добавления и удаления участников группы"""
+    permission_classes = [IsAuthenticated]
+    admission_class = 'bulk'
+
+    def post(self, request, pk):
+        chat = get_object_or_404(Chat, pk=pk)
+        if not chat.is_group:
+            return Response({'error': 'Это не групповой чат.'}, status=400)
+        if not chat.participants.filter(id=request.user.id).exists():
+            return Response({'detail': 'Forbidden'}, status=403)
+        serializer = MembershipChangeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        members, others, missing = membership.resolve(chat, **serializer.validated_data)
+        if not self.allowed(request.user, members):
+            return Response({'detail': 'Forbidden'}, status=403)
+        result = self.change(chat, members, others, request.user.id)
+        chat.refresh_from_db(fields=['member_count'])
+        return Response({**result, 'not_found': missing, 'member_count': chat.member_count})
+
+    def allowed(self, user, members):
+        return True
+
+
+@extend_schema(
+    summary="Добавить участников",
+    description="Добавляет в группу пользователей по номерам телефонов и id, до 5000 за запрос. "
+                "Уже состоящие в группе пропускаются",
+    request=MembershipChangeSerializer,
+    parameters=[OpenApiParameter(name='pk', location=OpenApiParameter.PATH, required=True, type=int)],
+    responses={
+        200: OpenApiResponse(description="added, already_members, not_found и member_count"),
+        400: OpenApiResponse(description="Не групповой чат или неверные данные"),
+        403: OpenApiResponse(description="Нет доступа"),
+    }
+)
+class ChatParticipantsAddAPIView(MembershipChangeAPIView):
+    """Массовое добавление участников в группу"""
+
+    def change(self, chat, members, others, actor_id):
+        membership.add(chat, others, actor_id)
+        return {'added': others, 'already_members': members}
+
+
+@extend_schema(
+    summary="Убрать участников",
+    description="Убирает из группы пользователей по номерам телефонов и id, до 5000 за запрос. "
+                "Других участников может убирать только администратор (is_staff), остальные — только себя",
+    request=MembershipChangeSerializer,
+    parameters=[OpenApiParameter(name='pk', location=OpenApiParameter.PATH, required=True, type=int)],
+    responses={
+        200: OpenApiResponse(description="removed, not_members, not_found и member_count"),
+        400: OpenApiResponse(description="Не групповой чат или неверные данные"),
+        403: OpenApiResponse(description="Нет доступа или нет прав убирать других участников"),
+    }
+)
+class ChatParticipantsRemoveAPIView(MembershipChangeAPIView):
+    """Массовое удаление участников из группы"""
+
+    def allowed(self, user, members):
+        # Ролей в группах нет: других убирает только администратор сервиса
+        return user.is_staff or set(members) <= {user.id}
+
+    def change(self, chat, members, others, actor_id):
+        membership.remove(chat, members, actor_id)
+        return {'removed': members, 'not_members': others}
+
+
+@extend_schema(
+    summary="Настройки чата в списке",
+    description="Отключает уведомления (muted) или закрепляет чат (pinned) в списке пользователя",
+    request=InboxSettingsSerializer,
+    responses={
+        200: InboxSettingsSerializer,
+        404: OpenApiResponse(description="Пользователь не участвует в чате")
+    },
+    parameters=[OpenApiParameter(name='pk', location=OpenApiParameter.PATH, required=True, type=int)]
+)
+class ChatInboxSettingsAPIView(generics.UpdateAPIView):
+    """Изменить muted/pinned своей строки списка чатов"""
+    permission_classes = [IsAuthenticated]
+    serializer_class = InboxSettingsSerializer
+    http_method_names = ['patch']
+
+    def get_object(self):
+        return get_object_or_404(InboxEntry, user=self.request.user, chat_id=self.kwargs['pk'])
+
 
 @extend_schema(
     summary="Вступить в групповой чат",
@@ -138,22 +473,25 @@ class ChatJoinAPIView(APIView):
         chat = get_object_or_404(Chat, id=chat_id)
         if not chat.is_group:
             return Response({'error': 'Это не групповой чат.'}, status=400)
-        if request.user in chat.participants.all():
+        if chat.participants.filter(id=request.user.id).exists():
             return Response({'message': 'Вы уже участник чата.'}, status=200)
-        chat.participants.add(request.user)
+        with transaction.atomic():
+            chat.participants.add(request.user)
+            changelog.record(ChangeLogEntry.KIND_JOIN, chat_id=chat.id, user_id=request.user.id)
         return Response({'message': 'Вы вступили в группу.'}, status=200)
 
 
 @extend_schema(
     summary="Поиск чатов",
-    description="Ищет чаты по названию, где участвует пользователь",
-    parameters=[OpenApiParameter(name='q', location='query', required=False, type=str)],
+    description="Ищет чаты по названию, где участвует пользователь; страницы по курсору, как в списке чатов",
+    parameters=[OpenApiParameter(name='q', location='query', required=False, type=str)] + INBOX_PAGE_PARAMETERS,
     responses={200: ChatListSerializer(many=True)}
 )
-class ChatSearchAPIView(generics.ListAPIView):
+class ChatSearchAPIView(InboxPageMixin, generics.ListAPIView):
     """Поиск чатов по названию"""
     serializer_class = ChatListSerializer
     permission_classes = [IsAuthenticated]
+    admission_class = 'bulk'
 
     def get_queryset(self):
         user = self.request.user
@@ -163,3 +501,137 @@ class ChatSearchAPIView(generics.ListAPIView):
             participants=user,
             chat_name__icontains=query # Поиск без учёта регистра
         )
+
+    def list(self, request, *args, **kwargs):
+        # Те же строки InboxEntry, что и в списке чатов, с фильтром по названию
+        return self.inbox_page(request, search=request.query_params.get('q', ''))
+
+
+@extend_schema(
+    summary="Дельта-синхронизация",
+    description="Изменения в чатах пользователя и профилях собеседников после since. "
+                "410 с resync=true означает, что журнал уже очищен и нужна полная загрузка",
+    parameters=[
+        OpenApiParameter(name='since', location='query', required=False, type=int),
+        OpenApiParameter(name='limit', location='query', required=False, type=int),
+    ],
+    responses={
+        200: OpenApiResponse(description="Изменения, новый seq и has_more"),
+        410: OpenApiResponse(description="Нужна полная пересинхронизация"),
+    }
+)
+class SyncAPIView(APIView):
+    """Изменения для переподключившегося клиента по журналу изменений"""
+    permission_classes = [IsAuthenticated]
+    default_limit = 500
+    max_limit = 1000
+
+    def get(self, request):
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            return Response({'error': 'since и limit должны быть числами.'}, status=400)
+        if since < 0 or limit < 1:
+            return Response({'error': 'since не может быть отрицательным, limit — меньше 1.'}, status=400)
+
+        try:
+            changes, has_more, seq = changelog.changes_since(request.user, since, limit)
+        except changelog.ResyncRequired as exc:
+            return Response({'resync': True, 'seq': exc.seq}, status=410)
+
+        return Response({
+            'changes': [changelog.serialize_entry(entry) for entry in changes],
+            'seq': seq,
+            'has_more': has_more,
+        })
+
+
+def upload_error(exc):
+    """Ответ на UploadError; при неверном смещении — с текущим offset"""
+    data = {'error': exc.message}
+    if isinstance(exc, uploads.OffsetMismatch):
+        data['offset'] = exc.offset
+    return Response(data, status=exc.status)
+
+
+@extend_schema(
+    summary="Начать загрузку вложения",
+    description="Создаёт загрузку файла по частям. Части отправляются PUT на /api/v1/uploads/<id>/ "
+                "не больше chunk_size байт, затем загрузка завершается POST на /finalize/",
+    request=UploadStartSerializer,
+    responses={201: UploadStartSerializer}
+)
+class UploadStartAPIView(CreateAPIView):
+    """Начало загрузки вложения по частям"""
+    permission_classes = [IsAuthenticated]
+    serializer_class = UploadStartSerializer
+
+
+@extend_schema(
+    summary="Часть вложения",
+    description="PUT дописывает тело запроса со смещения из заголовка Content-Range: bytes начало-конец/размер. "
+                "Смещение должно совпадать с offset, иначе 409 с текущим offset. "
+                "GET возвращает offset, с которого продолжить загрузку после обрыва",
+    request={'application/octet-stream': bytes},
+    responses={
+        200: OpenApiResponse(description="offset, size и status загрузки"),
+        409: OpenApiResponse(description="Неверное смещение или загрузка уже завершена"),
+    },
+    parameters=[OpenApiParameter(name='pk', location=OpenApiParameter.PATH, required=True, type=str)]
+)
+class UploadChunkAPIView(APIView):
+    """Состояние загрузки и запись очередной части"""
+    permission_classes = [IsAuthenticated]
+    admission_class = 'bulk'
+
+    def get_session(self, request, pk):
+        return get_object_or_404(UploadSession, pk=pk, user=request.user)
+
+    def get(self, request, pk):
+        session = self.get_session(request, pk)
+        return Response({'offset': session.received, 'size': session.size, 'status': session.status})
+
+    def put(self, request, pk):
+        session = self.get_session(request, pk)
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+            offset = uploads.parse_content_range(request.META.get('HTTP_CONTENT_RANGE', ''), length, session.size)
+            # Тело читаем сами блоками, без парсеров DRF и обработчиков загрузки Django
+            offset = uploads.write_chunk(session, offset, request._request, length)
+        except ValueError:
+            return Response({'error': 'Неверный Content-Length.'}, status=400)
+        except uploads.UploadError as exc:
+            return upload_error(exc)
+        return Response({'offset': offset, 'size': session.size, 'status': session.status})
+
+
+@extend_schema(
+    summary="Завершить загрузку вложения",
+    description="Проверяет размер и SHA-256 файла и отправляет в чат сообщение с вложением",
+    request=UploadFinalizeSerializer,
+    responses={
+        201: OpenApiResponse(description="Созданное сообщение в формате истории чата"),
+        409: OpenApiResponse(description="Файл загружен не полностью или загрузка уже завершена"),
+        422: OpenApiResponse(description="Контрольная сумма не совпадает"),
+    },
+    parameters=[OpenApiParameter(name='pk', location=OpenApiParameter.PATH, required=True, type=str)]
+)
+class UploadFinalizeAPIView(APIView):
+    """Сообщение с загруженным вложением"""
+    permission_classes = [IsAuthenticated]
+    throttle_scope = 'message_send'
+
+    def post(self, request, pk):
+        session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+        serializer = UploadFinalizeSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        chat = Chat.objects.get(pk=serializer.validated_data['chat_id'])
+        try:
+            message = uploads.finalize(session, chat, request.user, serializer.validated_data['content'])
+        except uploads.UploadError as exc:
+            return upload_error(exc)
+        except sharding.ChatMoving as exc:
+            return retry_later(exc)
+        return Response(
+            serialize_messages(Message.objects.using(message._state.db).filter(pk=message.pk), request)[0], status=201)
@@ -0,0 +1,196 @@
+"""Контроль допуска: сколько запросов процесс обрабатывает одновременно
+
+Когда база отвечает медленно, запросы копятся в воркере, пока не
+истекут все сразу, в том числе дешёвые вроде входа. С
+ADMISSION_CONTROL['ENABLED'] AdmissionControlMiddleware пускает к view не
+больше MAX_CONCURRENCY запросов процесса, а запросы каждого класса — не
+больше его CONCURRENCY. Остальные ждут в очереди своего класса не дольше
+TIMEOUT_MS; если очередь уже длиной QUEUE или срок вышел, запрос сразу
+получает 503 с Retry-After, а не ждёт таймаута клиента.
+
+Класс view задаётся атрибутом admission_class (как throttle_scope),
+без него — DEFAULT_CLASS. Освободившееся место получает первый в
+очереди класса с наименьшим PRIORITY, у которого ещё есть свободные
+места: отправка сообщений и вход обгоняют массовые чтения вроде поиска,
+а низкий CONCURRENCY у bulk оставляет место остальным.
+
+Ограничение действует на процесс: в нескольких воркерах лимиты у
+каждого свои. stats() — активные запросы, глубина очереди и число
+отклонённых по классам; раз в REPORT_INTERVAL секунд, если были
+отклонения, сводка пишется в лог messenger.admission.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.http import JsonResponse
+
+logger = logging.getLogger('messenger.admission')
+
+DEFAULTS = {
+    'ENABLED': False,
+    'MAX_CONCURRENCY': 32,
+    'DEFAULT_CLASS': 'default',
+    'CLASSES': {
+        'critical': {'PRIORITY': 0, 'CONCURRENCY': 32, 'QUEUE': 64, 'TIMEOUT_MS': 2000},
+        'default': {'PRIORITY': 1, 'CONCURRENCY': 24, 'QUEUE': 32, 'TIMEOUT_MS': 1000},
+        'bulk': {'PRIORITY': 2, 'CONCURRENCY': 8, 'QUEUE': 8, 'TIMEOUT_MS': 300},
+    },
+    'RETRY_AFTER': 1,
+    'REPORT_INTERVAL': 60,
+}
+
+SHED_QUEUE_FULL = 'queue_full'
+SHED_TIMEOUT = 'timeout'
+
+_controller = None
+
+
+def get_config():
+    """Настройки контроля допуска с подставленными значениями по умолчанию"""
+    return {**DEFAULTS, **getattr(settings, 'ADMISSION_CONTROL', {})}
+
+
+class AdmissionController:
+    """Места для запросов: общий лимит, лимиты и очереди классов"""
+
+    def __init__(self, config):
+        self.max_concurrency = config['MAX_CONCURRENCY']
+        self.classes = config['CLASSES']
+        # Классы в порядке приоритета: места раздаются в этом порядке
+        self.order = sorted(self.classes, key=lambda name: self.classes[name]['PRIORITY'])
+        self._cond = threading.Condition()
+        self._active = dict.fromkeys(self.classes, 0)
+        self._waiting = {name: deque() for name in self.classes}
+        self._counters = {
+            name: {'admitted': 0, SHED_QUEUE_FULL: 0, SHED_TIMEOUT: 0, 'peak_queue': 0}
+            for name in self.classes
+        }
+
+    def _free(self, name):
+        return (sum(self._active.values()) < self.max_concurrency
+                and self._active[name] < self.classes[name]['CONCURRENCY'])
+
+    def _next_waiter(self, up_to=None):
+        """Ожидающий, который получит следующее место; только классы не ниже up_to"""
+        for name in self.order:
+            if self._waiting[name] and self._free(name):
+                return self._waiting[name][0]
+            if name == up_to:
+                return None
+        return None
+
+    def _admit(self, name):
+        self._active[name] += 1
+        self._counters[name]['admitted'] += 1
+
+    def acquire(self, name):
+        """Занимает место класса name; None или причина отказа"""
+        config = self.classes[name]
+        with self._cond:
+            waiting = self._waiting[name]
+            # Без очереди своего класса и более важных ожидающих — сразу
+            if not waiting and self._free(name) and self._next_waiter(up_to=name) is None:
+                self._admit(name)
+                return None
+            if len(waiting) >= config['QUEUE']:
+                self._counters[name][SHED_QUEUE_FULL] += 1
+                return SHED_QUEUE_FULL
+            waiter = object()
+            waiting.append(waiter)
+            self._counters[name]['peak_queue'] = max(self._counters[name]['peak_queue'], len(waiting))
+            deadline = time.monotonic() + config['TIMEOUT_MS'] / 1000
+            while self._next_waiter() is not waiter:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    waiting.remove(waiter)
+                    self._counters[name][SHED_TIMEOUT] += 1
+                    # Место могло достаться следующему за нами
+                    self._cond.notify_all()
+                    return SHED_TIMEOUT
+                self._cond.wait(remaining)
+            waiting.popleft()
+            self._admit(name)
+            self._cond.notify_all()
+            return None
+
+    def release(self, name):
+        with self._cond:
+            self._active[name] -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """{класс: активные, в очереди, пик очереди, пропущено, отклонено}"""
+        with self._cond:
+            result = {}
+            for name in self.order:
+                counters = self._counters[name]
+                result[name] = {
+                    'active': self._active[name],
+                    'queued': len(self._waiting[name]),
+                    **counters,
+                    'shed': counters[SHED_QUEUE_FULL] + counters[SHED_TIMEOUT],
+                }
+            return result
+
+
+def stats():
+    """Статистика контроллера этого процесса; пустой словарь, если он выключен"""
+    return _controller.stats() if _controller is not None else {}
+
+
+class AdmissionControlMiddleware:
+    """Пускает запрос к view, только если у его класса есть место"""
+
+    def __init__(self, get_response):
+        global _controller
+        config = get_config()
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed
+        if config['DEFAULT_CLASS'] not in config['CLASSES']:
+            raise ImproperlyConfigured('ADMISSION_CONTROL: DEFAULT_CLASS нет в CLASSES')
+        self.get_response = get_response
+        self.config = config
+        self.controller = _controller = AdmissionController(config)
+        self._reported_at = time.monotonic()
+        self._reported_shed = 0
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            name = request.__dict__.pop('_admission_class', None)
+            if name is not None:
+                self.controller.release(name)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None)
+        name = getattr(view_class, 'admission_class', None) or self.config['DEFAULT_CLASS']
+        if name not in self.controller.classes:
+            raise ImproperlyConfigured('admission_class %r нет в ADMISSION_CONTROL["CLASSES"]' % name)
+        reason = self.controller.acquire(name)
+        if reason is None:
+            request._admission_class = name
+            return None
+        self.report()
+        response = JsonResponse({'detail': 'Сервер перегружен, повторите позже.'}, status=503)
+        response['Retry-After'] = str(self.config['RETRY_AFTER'])
+        return response
+
+    def report(self):
+        """Сводка в лог не чаще раза в REPORT_INTERVAL секунд"""
+        now = time.monotonic()
+        if now - self._reported_at < self.config['REPORT_INTERVAL']:
+            return
+        current = self.controller.stats()
+        shed = sum(item['shed'] for item in current.values())
+        self._reported_at = now
+        logger.warning(
+            'Отклонено запросов за %d с: %d; %s', self.config['REPORT_INTERVAL'], shed - self._reported_shed,
+            ', '.join('%s: активных %d, в очереди %d, отклонено %d' % (
+                name, item['active'], item['queued'], item['shed']) for name, item in current.items()),
+        )
+        self._reported_shed = shed
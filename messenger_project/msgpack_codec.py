@@ -0,0 +1,244 @@
+"""Кодек MessagePack без внешних зависимостей
+
+Поддерживает типы, которые встречаются в ответах API: None, bool, int,
+float, str, bytes, list/tuple и dict; остальные типы приводятся функцией
+default, как в json.dumps.
+Спецификация формата: https://github.com/msgpack/msgpack/blob/master/spec.md
+"""
+import struct
+
+_UINT8 = struct.Struct('>B')
+_UINT16 = struct.Struct('>H')
+_UINT32 = struct.Struct('>I')
+_UINT64 = struct.Struct('>Q')
+_INT8 = struct.Struct('>b')
+_INT16 = struct.Struct('>h')
+_INT32 = struct.Struct('>i')
+_INT64 = struct.Struct('>q')
+_FLOAT32 = struct.Struct('>f')
+_FLOAT64 = struct.Struct('>d')
+
+_pack_uint8 = _UINT8.pack
+_pack_uint16 = _UINT16.pack
+_pack_uint32 = _UINT32.pack
+_pack_uint64 = _UINT64.pack
+_pack_int8 = _INT8.pack
+_pack_int16 = _INT16.pack
+_pack_int32 = _INT32.pack
+_pack_int64 = _INT64.pack
+_pack_float64 = _FLOAT64.pack
+
+
+class PackError(TypeError):
+    """Значение нельзя закодировать в MessagePack"""
+
+
+class UnpackError(ValueError):
+    """Повреждённые или неподдерживаемые данные MessagePack"""
+
+
+# Готовые однобайтовые заголовки для самых частых значений
+_FIXINT = [bytes([i]) for i in range(0x80)]
+_FIXSTR = [bytes([0xa0 | i]) for i in range(32)]
+_FIXMAP = [bytes([0x80 | i]) for i in range(16)]
+_FIXARRAY = [bytes([0x90 | i]) for i in range(16)]
+
+
+def _pack_int(value, write):
+    if value >= 0:
+        if value < 0x80:
+            write(_pack_uint8(value))
+        elif value <= 0xff:
+            write(b'\xcc' + _pack_uint8(value))
+        elif value <= 0xffff:
+            write(b'\xcd' + _pack_uint16(value))
+        elif value <= 0xffffffff:
+            write(b'\xce' + _pack_uint32(value))
+        elif value <= 0xffffffffffffffff:
+            write(b'\xcf' + _pack_uint64(value))
+        else:
+            raise PackError('Целое слишком большое для MessagePack: %d' % value)
+    elif value >= -32:
+        write(_pack_int8(value))
+    elif value >= -0x80:
+        write(b'\xd0' + _pack_int8(value))
+    elif value >= -0x8000:
+        write(b'\xd1' + _pack_int16(value))
+    elif value >= -0x80000000:
+        write(b'\xd2' + _pack_int32(value))
+    elif value >= -0x8000000000000000:
+        write(b'\xd3' + _pack_int64(value))
+    else:
+        raise PackError('Целое слишком маленькое для MessagePack: %d' % value)
+
+
+def _pack_str(data, write):
+    size = len(data)
+    if size < 32:
+        write(_pack_uint8(0xa0 | size))
+    elif size <= 0xff:
+        write(b'\xd9' + _pack_uint8(size))
+    elif size <= 0xffff:
+        write(b'\xda' + _pack_uint16(size))
+    else:
+        write(b'\xdb' + _pack_uint32(size))
+    write(data)
+
+
+def _pack_bin(value, write):
+    size = len(value)
+    if size <= 0xff:
+        write(b'\xc4' + _pack_uint8(size))
+    elif size <= 0xffff:
+        write(b'\xc5' + _pack_uint16(size))
+    else:
+        write(b'\xc6' + _pack_uint32(size))
+    write(bytes(value))
+
+
+def _container_header(size, fixed, code16, code32):
+    if size < len(fixed):
+        return fixed[size]
+    if size <= 0xffff:
+        return code16 + _pack_uint16(size)
+    return code32 + _pack_uint32(size)
+
+
+def packb(obj, default=None):
+    """Кодирует объект в bytes; default(obj) вызывается для прочих типов"""
+    parts = []
+    write = parts.append
+
+    def pack(value):
+        kind = type(value)
+        if kind is str:
+            data = value.encode('utf-8')
+            if len(data) < 32:
+                write(_FIXSTR[len(data)])
+                write(data)
+            else:
+                _pack_str(data, write)
+        elif kind is int:
+            if 0 <= value < 0x80:
+                write(_FIXINT[value])
+            else:
+                _pack_int(value, write)
+        elif value is None:
+            write(b'\xc0')
+        elif kind is bool:
+            write(b'\xc3' if value else b'\xc2')
+        elif kind is float:
+            write(b'\xcb' + _pack_float64(value))
+        elif isinstance(value, dict):
+            write(_container_header(len(value), _FIXMAP, b'\xde', b'\xdf'))
+            for key, item in value.items():
+                pack(key)
+                pack(item)
+        elif isinstance(value, (list, tuple)):
+            write(_container_header(len(value), _FIXARRAY, b'\xdc', b'\xdd'))
+            for item in value:
+                pack(item)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            _pack_bin(value, write)
+        elif isinstance(value, int):
+            _pack_int(int(value), write)
+        elif isinstance(value, str):
+            _pack_str(str(value).encode('utf-8'), write)
+        elif default is not None:
+            pack(default(value))
+        else:
+            raise PackError('Тип %s не поддерживается MessagePack' % kind.__name__)
+
+    pack(obj)
+    return b''.join(parts)
+
+
+class _Reader:
+    __slots__ = ('data', 'pos')
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def take(self, size):
+        start = self.pos
+        end = start + size
+        if end > len(self.data):
+            raise UnpackError('Неожиданный конец данных MessagePack')
+        self.pos = end
+        return self.data[start:end]
+
+    def unpack(self, fmt):
+        return fmt.unpack(self.take(fmt.size))[0]
+
+
+_SCALARS = {
+    0xcc: _UINT8, 0xcd: _UINT16, 0xce: _UINT32, 0xcf: _UINT64,
+    0xd0: _INT8, 0xd1: _INT16, 0xd2: _INT32, 0xd3: _INT64,
+    0xca: _FLOAT32, 0xcb: _FLOAT64,
+}
+_STR_SIZES = {0xd9: _UINT8, 0xda: _UINT16, 0xdb: _UINT32}
+_BIN_SIZES = {0xc4: _UINT8, 0xc5: _UINT16, 0xc6: _UINT32}
+_ARRAY_SIZES = {0xdc: _UINT16, 0xdd: _UINT32}
+_MAP_SIZES = {0xde: _UINT16, 0xdf: _UINT32}
+
+
+def _decode_str(raw):
+    try:
+        return str(raw, 'utf-8')
+    except UnicodeDecodeError as exc:
+        raise UnpackError('Строка MessagePack не в UTF-8') from exc
+
+
+def _unpack(reader):
+    code = reader.take(1)[0]
+    if code <= 0x7f:
+        return code
+    if code >= 0xe0:
+        return code - 0x100
+    if 0xa0 <= code <= 0xbf:
+        return _decode_str(reader.take(code & 0x1f))
+    if 0x90 <= code <= 0x9f:
+        return [_unpack(reader) for _ in range(code & 0x0f)]
+    if 0x80 <= code <= 0x8f:
+        return _unpack_map(reader, code & 0x0f)
+    if code == 0xc0:
+        return None
+    if code == 0xc2:
+        return False
+    if code == 0xc3:
+        return True
+    if code in _SCALARS:
+        return reader.unpack(_SCALARS[code])
+    if code in _STR_SIZES:
+        return _decode_str(reader.take(reader.unpack(_STR_SIZES[code])))
+    if code in _BIN_SIZES:
+        return bytes(reader.take(reader.unpack(_BIN_SIZES[code])))
+    if code in _ARRAY_SIZES:
+        return [_unpack(reader) for _ in range(reader.unpack(_ARRAY_SIZES[code]))]
+    if code in _MAP_SIZES:
+        return _unpack_map(reader, reader.unpack(_MAP_SIZES[code]))
+    raise UnpackError('Неподдерживаемый тип MessagePack: 0x%02x' % code)
+
+
+def _unpack_map(reader, size):
+    result = {}
+    for _ in range(size):
+        key = _unpack(reader)
+        try:
+            result[key] = _unpack(reader)
+        except TypeError as exc:
+            raise UnpackError('Недопустимый ключ словаря MessagePack') from exc
+    return result
+
+
+def unpackb(data):
+    """Декодирует bytes в объект Python"""
+    reader = _Reader(memoryview(data))
+    try:
+        result = _unpack(reader)
+    except RecursionError as exc:
+        raise UnpackError('Слишком глубокая вложенность MessagePack') from exc
+    if reader.pos != len(reader.data):
+        raise UnpackError('Лишние данные после объекта MessagePack')
+    return result
@@ -0,0 +1,126 @@
+"""Схема OpenAPI, собранная заранее, и ленивые страницы документации
+
+python manage.py build_openapi_schema один раз при сборке генерирует
+схему drf-spectacular и пишет schema.yaml и schema.json в
+OPENAPI_SCHEMA_DIR. schema_view отдаёт готовый файл с ETag, а не
+разбирает все view на каждый запрос, как SpectacularAPIView. Если файла
+нет (например, при разработке), схема генерируется при первом запросе
+один раз на процесс.
+
+Страницы документации (drf_spectacular.views) и генератор схемы
+импортируются только при генерации схемы и при первом обращении к
+swagger_view/redoc_view, а не при загрузке urls.py. Остальной
+drf-spectacular загружается при старте: @extend_schema на view
+обращается к DEFAULT_SCHEMA_CLASS (drf_spectacular.openapi.AutoSchema), а
+с ней — к plumbing и yaml. Поэтому старт воркера почти не ускоряется,
+выигрыш — в первом и повторных запросах схемы.
+"""
+import hashlib
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+
+logger = logging.getLogger('messenger_project.openapi')
+
+FORMATS = {
+    'yaml': ('schema.yaml', 'application/vnd.oai.openapi; charset=utf-8'),
+    'json': ('schema.json', 'application/vnd.oai.openapi+json; charset=utf-8'),
+}
+
+# {(каталог, формат): (тело, ETag)}
+_schemas = {}
+_schemas_lock = threading.Lock()
+_docs_views = {}
+
+
+def schema_dir():
+    return str(settings.OPENAPI_SCHEMA_DIR)
+
+
+def generate():
+    """Схема по всем view проекта: {формат: байты}"""
+    from drf_spectacular.renderers import OpenApiJsonRenderer, OpenApiYamlRenderer
+    from drf_spectacular.settings import spectacular_settings
+
+    schema = spectacular_settings.DEFAULT_GENERATOR_CLASS().get_schema(request=None, public=True)
+    return {
+        'yaml': OpenApiYamlRenderer().render(schema, renderer_context={}),
+        'json': OpenApiJsonRenderer().render(schema, renderer_context={}),
+    }
+
+
+def build(directory=None):
+    """Генерирует схему и записывает файлы; возвращает их пути"""
+    directory = directory or schema_dir()
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for schema_format, body in generate().items():
+        path = os.path.join(directory, FORMATS[schema_format][0])
+        # Через временный файл: работающие процессы не прочитают половину схемы
+        with open(path + '.tmp', 'wb') as output:
+            output.write(body)
+        os.replace(path + '.tmp', path)
+        paths.append(path)
+    reset()
+    return paths
+
+
+def load(schema_format):
+    """(тело, ETag) схемы: из файла сборки или сгенерированная один раз"""
+    key = (schema_dir(), schema_format)
+    cached = _schemas.get(key)
+    if cached is not None:
+        return cached
+    with _schemas_lock:
+        if key not in _schemas:
+            try:
+                bodies = {}
+                for name, (filename, _) in FORMATS.items():
+                    with open(os.path.join(key[0], filename), 'rb') as source:
+                        bodies[name] = source.read()
+            except FileNotFoundError:
+                logger.warning('Схема OpenAPI не собрана (python manage.py build_openapi_schema), '
+                               'генерируем при запросе')
+                bodies = generate()
+            for name, body in bodies.items():
+                _schemas[(key[0], name)] = (body, '"%s"' % hashlib.sha256(body).hexdigest()[:32])
+    return _schemas[key]
+
+
+def reset():
+    """Забывает загруженную схему: следующий запрос перечитает файлы"""
+    with _schemas_lock:
+        _schemas.clear()
+
+
+def schema_view(request):
+    """Схема OpenAPI: YAML, с ?format=json — JSON"""
+    schema_format = 'json' if request.GET.get('format') == 'json' else 'yaml'
+    body, etag = load(schema_format)
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type=FORMATS[schema_format][1])
+    response['ETag'] = etag
+    return response
+
+
+def _docs_view(name):
+    view = _docs_views.get(name)
+    if view is None:
+        from drf_spectacular.views import SpectacularRedocView, SpectacularSwaggerView
+
+        view_class = {'swagger': SpectacularSwaggerView, 'redoc': SpectacularRedocView}[name]
+        view = _docs_views[name] = view_class.as_view(url_name='schema')
+    return view
+
+
+def swagger_view(request, *args, **kwargs):
+    return _docs_view('swagger')(request, *args, **kwargs)
+
+
+def redoc_view(request, *args, **kwargs):
+    return _docs_view('redoc')(request, *args, **kwargs)
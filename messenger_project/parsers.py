@@ -0,0 +1,15 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+from .msgpack_codec import UnpackError, unpackb
+
+
+class MessagePackParser(BaseParser):
+    """Разбирает тело запроса в MessagePack (Content-Type: application/msgpack)"""
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return unpackb(stream.read())
+        except UnpackError as exc:
+            raise ParseError('Ошибка разбора MessagePack: %s' % exc)
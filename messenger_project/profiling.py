@@ -0,0 +1,168 @@
+"""Профилирование отдельных запросов по требованию сотрудника
+
+Запрос профилируется, если пришёл заголовок X-Profile или параметр
+?_profile=<режим> и пользователь — staff. Режим sample снимает стеки
+потока раз в SAMPLE_INTERVAL_MS и сохраняет их в свёрнутом формате
+(collapsed stacks) для flamegraph.pl/speedscope, режим cprofile
+сохраняет вывод pstats. Результаты лежат в RequestProfile и видны в
+админке, ID профиля возвращается в заголовке X-Profile-Id.
+"""
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+DEFAULTS = {
+    'ENABLED': True,
+    'HEADER': 'HTTP_X_PROFILE',
+    'QUERY_PARAM': '_profile',
+    'SAMPLE_INTERVAL_MS': 5,
+    'MAX_PROFILES': 500,
+}
+
+MODES = ('sample', 'cprofile')
+
+
+def get_config():
+    """Настройки профилировщика с подставленными значениями по умолчанию"""
+    return {**DEFAULTS, **getattr(settings, 'REQUEST_PROFILER', {})}
+
+
+class SamplingProfiler:
+    """Фоновый поток, периодически снимающий стек профилируемого потока"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.sample_count = 0
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            self.stacks[self._collapse(frame)] += 1
+            self.sample_count += 1
+
+    @staticmethod
+    def _collapse(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def collapsed(self):
+        """Стеки в формате 'f1;f2;f3 <число сэмплов>' по строке на стек"""
+        return '\n'.join('%s %d' % (stack, count) for stack, count in self.stacks.most_common())
+
+
+def is_staff_request(request):
+    """Проверяет staff по сессии или, как DRF, по заголовку авторизации"""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.is_staff, user
+    drf_request = Request(request)
+    for authentication_class in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+        try:
+            result = authentication_class().authenticate(drf_request)
+        except Exception:
+            return False, None
+        if result is not None:
+            return result[0].is_staff, result[0]
+    return False, None
+
+
+class RequestProfilerMiddleware:
+    """Снимает профиль запроса, если его запросил сотрудник"""
+
+    def __init__(self, get_response):
+        self.config = get_config()
+        if not self.config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def requested_mode(self, request):
+        value = request.META.get(self.config['HEADER']) or request.GET.get(self.config['QUERY_PARAM'])
+        if not value:
+            return None
+        value = value.strip().lower()
+        return value if value in MODES else 'sample'
+
+    def __call__(self, request):
+        mode = self.requested_mode(request)
+        if mode is None:
+            return self.get_response(request)
+        is_staff, user = is_staff_request(request)
+        if not is_staff:
+            return self.get_response(request)
+
+        request_id = uuid.uuid4().hex
+        start = time.perf_counter()
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+            response = profiler.runcall(self.get_response, request)
+        else:
+            profiler = SamplingProfiler(self.config['SAMPLE_INTERVAL_MS'] / 1000)
+            profiler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.stop()
+        duration = time.perf_counter() - start
+
+        self.save_profile(request, response, request_id, mode, profiler, duration, user)
+        response['X-Profile-Id'] = request_id
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None)
+        request.profile_view_name = view_class.__name__ if view_class else view_func.__name__
+
+    def save_profile(self, request, response, request_id, mode, profiler, duration, user):
+        from messenger.models import RequestProfile
+
+        profile = RequestProfile(
+            request_id=request_id,
+            user=user,
+            method=request.method,
+            path=request.get_full_path()[:255],
+            view_name=getattr(request, 'profile_view_name', ''),
+            status_code=response.status_code,
+            mode=mode,
+            duration_ms=round(duration * 1000, 3),
+        )
+        if mode == 'cprofile':
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(50)
+            profile.stats = stream.getvalue()
+        else:
+            profile.sample_count = profiler.sample_count
+            profile.collapsed_stacks = profiler.collapsed()
+        profile.save()
+
+        # Храним только последние MAX_PROFILES профилей
+        stale = RequestProfile.objects.order_by('-created_at', '-id').values_list('id', flat=True)[
+            self.config['MAX_PROFILES']:]
+        RequestProfile.objects.filter(id__in=list(stale)).delete()
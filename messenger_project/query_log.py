@@ -0,0 +1,167 @@
+"""Журнал медленных SQL-запросов с захватом плана выполнения
+
+Включается настройкой SLOW_QUERY_LOG['ENABLED']. Middleware оборачивает
+каждое подключение к БД через connection.execute_wrapper и записывает
+запросы дольше порога: нормализованный отпечаток, view, метод
+сериализатора (например ChatListSerializer.get_last_time) и вывод
+EXPLAIN QUERY PLAN. Отчёт строит команда slow_query_report.
+"""
+import hashlib
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger('messenger.slow_queries')
+
+DEFAULTS = {
+    'ENABLED': False,
+    'THRESHOLD_MS': 100,
+    'LOG_FILE': None,
+    'EXPLAIN': True,
+}
+
+_current_view = ContextVar('slow_query_view', default=None)
+_explaining = ContextVar('slow_query_explaining', default=False)
+_file_lock = threading.Lock()
+
+_RE_STRING = re.compile(r"'(?:[^']|'')*'")
+_RE_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_IN_LIST = re.compile(r'\bIN\s*\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)', re.IGNORECASE)
+_RE_SPACES = re.compile(r'\s+')
+
+# Кадры из этих мест не считаются источником запроса
+_SKIP_PATHS = ('site-packages', 'query_log.py')
+
+
+def get_config():
+    """Настройки журнала с подставленными значениями по умолчанию"""
+    return {**DEFAULTS, **getattr(settings, 'SLOW_QUERY_LOG', {})}
+
+
+def fingerprint(sql):
+    """Нормализует SQL и возвращает (нормализованный текст, короткий хеш)"""
+    normalized = _RE_STRING.sub('?', sql)
+    normalized = _RE_NUMBER.sub('?', normalized)
+    normalized = normalized.replace('%s', '?')
+    normalized = _RE_IN_LIST.sub('IN (...)', normalized)
+    normalized = _RE_SPACES.sub(' ', normalized).strip()
+    digest = hashlib.md5(normalized.encode('utf-8')).hexdigest()[:12]
+    return normalized, digest
+
+
+def find_source():
+    """Первый кадр стека из кода проекта, например ChatListSerializer.get_last_time"""
+    base_dir = str(settings.BASE_DIR)
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        filename = code.co_filename
+        if filename.startswith(base_dir) and not any(p in filename[len(base_dir):] for p in _SKIP_PATHS):
+            owner = frame.f_locals.get('self')
+            if owner is not None:
+                return '%s.%s' % (type(owner).__name__, code.co_name)
+            return code.co_name
+        frame = frame.f_back
+    return None
+
+
+def explain(connection, sql, params):
+    """Возвращает план выполнения запроса или None, если его не получить"""
+    if not sql.lstrip().upper().startswith('SELECT'):
+        return None
+    token = _explaining.set(True)
+    try:
+        prefix = connection.ops.explain_query_prefix()
+        with connection.cursor() as cursor:
+            cursor.execute('%s %s' % (prefix, sql), params)
+            rows = cursor.fetchall()
+    except Exception:
+        return None
+    finally:
+        _explaining.reset(token)
+    # У SQLite текст шага плана лежит в последней колонке
+    return '\n'.join(str(row[-1]) for row in rows)
+
+
+def write_record(record, log_file):
+    """Пишет запись в лог и, если задан файл, добавляет её строкой JSON"""
+    logger.warning(
+        'Медленный запрос %.1f мс [%s] view=%s source=%s',
+        record['duration_ms'], record['fingerprint'], record['view'], record['source'],
+    )
+    if log_file:
+        line = json.dumps(record, ensure_ascii=False)
+        with _file_lock, open(log_file, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+class SlowQueryRecorder:
+    """execute_wrapper, замеряющий время запросов на одном подключении"""
+
+    def __init__(self, config):
+        self.threshold = config['THRESHOLD_MS'] / 1000
+        self.explain = config['EXPLAIN']
+        self.log_file = config['LOG_FILE']
+
+    def __call__(self, execute, sql, params, many, context):
+        if _explaining.get():
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            if duration >= self.threshold:
+                self.record(sql, params, many, context['connection'], duration)
+
+    def record(self, sql, params, many, connection, duration):
+        normalized, digest = fingerprint(sql)
+        plan = None
+        if self.explain and not many:
+            plan = explain(connection, sql, params)
+        write_record({
+            'ts': datetime.now(timezone.utc).isoformat(),
+            'alias': connection.alias,
+            'duration_ms': round(duration * 1000, 3),
+            'fingerprint': digest,
+            'normalized': normalized,
+            'sql': sql,
+            'view': _current_view.get(),
+            'source': find_source(),
+            'plan': plan,
+        }, self.log_file)
+
+
+class SlowQueryLogMiddleware:
+    """Подключает SlowQueryRecorder ко всем БД на время обработки запроса"""
+
+    def __init__(self, get_response):
+        config = get_config()
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.recorder = SlowQueryRecorder(config)
+
+    def __call__(self, request):
+        token = _current_view.set(request.path)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(self.recorder))
+                return self.get_response(request)
+        finally:
+            _current_view.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None)
+        _current_view.set(view_class.__name__ if view_class else view_func.__name__)
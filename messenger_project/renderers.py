@@ -0,0 +1,63 @@
+import datetime
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils import encoders
+
+from .msgpack_codec import packb
+
+
+def format_datetime(value, tz=None):
+    """Строка даты-времени в том же виде, что отдаёт serializers.DateTimeField
+
+    tz — текущая зона, её можно передать заранее, чтобы не искать на каждое значение.
+    """
+    if settings.USE_TZ and value.tzinfo is not None:
+        value = value.astimezone(tz or timezone.get_current_timezone())
+    text = value.isoformat()
+    if text.endswith('+00:00'):
+        text = text[:-6] + 'Z'
+    return text
+
+
+class FastJSONEncoder(encoders.JSONEncoder):
+    """JSONEncoder DRF, который сразу кодирует даты из values()-сериализации"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Текущая зона одна на весь ответ
+        self.timezone = timezone.get_current_timezone() if settings.USE_TZ else None
+
+    def default(self, obj):
+        kind = type(obj)
+        if kind is datetime.datetime:
+            return format_datetime(obj, self.timezone)
+        if kind is datetime.date:
+            return obj.isoformat()
+        return super().default(obj)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSONRenderer для ответов с необработанными datetime из values_list
+
+    Вывод побайтно совпадает с JSONRenderer поверх ModelSerializer.
+    """
+    encoder_class = FastJSONEncoder
+
+
+class MessagePackRenderer(BaseRenderer):
+    """Компактный бинарный ответ в MessagePack (Accept: application/msgpack)
+
+    Структура ответа совпадает с JSON: даты и прочие типы приводятся тем
+    же FastJSONEncoder, что и в JSON-ответах.
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return packb(data, default=FastJSONEncoder().default)
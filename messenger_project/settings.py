@@ -42,7 +42,6 @@ INSTALLED_APPS = [
     'rest_framework.authtoken',
     'corsheaders',
     'drf_spectacular',
-    'drf_yasg',
     'users',
     'messenger',
 ]
@@ -50,12 +49,15 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'messenger_project.admission.AdmissionControlMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'messenger_project.query_log.SlowQueryLogMiddleware',
+    'messenger_project.profiling.RequestProfilerMiddleware',
 
 ]
 #
@@ -96,6 +98,157 @@ DATABASES = {
     }
 }
 
+# Шардирование сообщений по chat_id (messenger/sharding.py): SHARDS —
+# псевдонимы баз из DATABASES для сообщений, лайков и вложений; пустой
+# список — всё в default. Перенос чатов: python manage.py rebalance_message_shards,
+# локально с несколькими файлами SQLite: settings_sharded.py
+DATABASE_ROUTERS = ['messenger.sharding.MessageShardRouter']
+
+MESSAGE_SHARDS = {
+    'SHARDS': [],
+    'VIRTUAL_NODES': 64,
+    'ID_BLOCK_SIZE': 100,
+    'MOVE_BATCH_SIZE': 1000,
+    'MOVE_GRACE_SECONDS': 2.0,
+}
+
+# Журнал медленных запросов (messenger_project/query_log.py),
+# отчёт: python manage.py slow_query_report
+SLOW_QUERY_LOG = {
+    'ENABLED': False,
+    'THRESHOLD_MS': 100,
+    'LOG_FILE': BASE_DIR / 'slow_queries.log',
+    'EXPLAIN': True,
+}
+
+# Профилирование запросов сотрудниками по заголовку X-Profile: sample|cprofile
+# (messenger_project/profiling.py), профили видны в админке
+REQUEST_PROFILER = {
+    'ENABLED': True,
+    'SAMPLE_INTERVAL_MS': 5,
+    'MAX_PROFILES': 500,
+}
+
+# Сколько дней хранить журнал изменений для /api/v1/sync/
+# (очистка: python manage.py compact_changelog)
+CHANGELOG_RETENTION_DAYS = 30
+
+# Сколько часов помнить client_message_id для повторной отправки сообщений
+# (очистка: python manage.py expire_client_message_ids)
+CLIENT_MESSAGE_ID_RETENTION_HOURS = 48
+
+# Групповая фиксация отправки сообщений (messenger/group_commit.py): поток-
+# писатель пишет сообщения пачками до MAX_BATCH одной транзакцией, дожидаясь
+# новых не дольше MAX_DELAY_MS; запрос ждёт запись не дольше TIMEOUT секунд
+GROUP_COMMIT = {
+    'ENABLED': False,
+    'MAX_BATCH': 64,
+    'MAX_DELAY_MS': 1,
+    'TIMEOUT': 5.0,
+    'QUEUE_SIZE': 10000,
+}
+
+# Склейка одинаковых чтений (messenger/singleflight.py): одновременные
+# запросы одного чата одной версии ждут одно вычисление, но не дольше
+# TIMEOUT секунд; сводка склеек — в лог messenger.singleflight раз в
+# REPORT_INTERVAL секунд
+SINGLE_FLIGHT = {
+    'ENABLED': True,
+    'TIMEOUT': 10.0,
+    'REPORT_INTERVAL': 60,
+}
+
+# Удаление чатов, пользователей и исчезающих сообщений (messenger/purge.py):
+# пачками по CHUNK_SIZE строк с паузой PAUSE_MS между ними; фоновая задача
+# работает не дольше TASK_SECONDS и ставит продолжение в очередь
+PURGE = {
+    'CHUNK_SIZE': 1000,
+    'PAUSE_MS': 50,
+    'TASK_SECONDS': 60,
+}
+
+# Запланированные сообщения (messenger/scheduled.py), диспетчер:
+# python manage.py run_scheduler. В памяти — сроки ближайших
+# LOOKAHEAD_SECONDS, не больше PRELOAD; новые расписания подхватываются раз в
+# REFRESH_SECONDS, наступившие отправляются пачками по BATCH_SIZE
+SCHEDULED_MESSAGES = {
+    'BATCH_SIZE': 500,
+    'LOOKAHEAD_SECONDS': 3600,
+    'PRELOAD': 10000,
+    'REFRESH_SECONDS': 5.0,
+    'RETRY_SECONDS': 5,
+    'MAX_ATTEMPTS': 5,
+    'MAX_DELAY_DAYS': 365,
+    'MAX_PENDING_PER_USER': 1000,
+}
+
+# Контроль допуска (messenger_project/admission.py): не больше
+# MAX_CONCURRENCY запросов процесса одновременно и CONCURRENCY на класс view
+# (атрибут admission_class); остальные ждут в очереди класса длиной QUEUE не
+# дольше TIMEOUT_MS, иначе получают 503. Места раздаются по PRIORITY
+ADMISSION_CONTROL = {
+    'ENABLED': False,
+    'MAX_CONCURRENCY': 32,
+    'DEFAULT_CLASS': 'default',
+    'CLASSES': {
+        'critical': {'PRIORITY': 0, 'CONCURRENCY': 32, 'QUEUE': 64, 'TIMEOUT_MS': 2000},
+        'default': {'PRIORITY': 1, 'CONCURRENCY': 24, 'QUEUE': 32, 'TIMEOUT_MS': 1000},
+        'bulk': {'PRIORITY': 2, 'CONCURRENCY': 8, 'QUEUE': 8, 'TIMEOUT_MS': 300},
+    },
+    'RETRY_AFTER': 1,
+    'REPORT_INTERVAL': 60,
+}
+
+# Список чатов пользователя (messenger/inbox.py): в группах больше
+# FANOUT_LIMIT участников активность не разносится по строкам при отправке,
+# а подставляется при чтении
+INBOX = {
+    'FANOUT_LIMIT': 500,
+}
+
+# Очередь фоновых задач (messenger/task_queue.py),
+# воркер: python manage.py run_task_worker, метрики: python manage.py task_stats
+TASK_QUEUE = {
+    'POLL_INTERVAL': 1.0,
+    'MAX_ATTEMPTS': 5,
+    'BACKOFF_BASE': 2.0,
+    'BACKOFF_MAX': 600,
+    'LEASE_SECONDS': 300,
+    'KEEP_DONE_HOURS': 24,
+}
+
+# Загрузка вложений по частям (messenger/uploads.py): части пишутся в
+# TEMP_DIR (None — BASE_DIR / 'upload_tmp'), незавершённые загрузки
+# старше EXPIRE_HOURS удаляет python manage.py cleanup_uploads
+UPLOADS = {
+    'MAX_SIZE': 100 * 1024 * 1024,
+    'MAX_CHUNK_SIZE': 8 * 1024 * 1024,
+    'TEMP_DIR': None,
+    'EXPIRE_HOURS': 24,
+}
+
+# Медиа хранятся по хешу содержимого (messenger_project/storage.py): одинаковые
+# файлы лежат один раз, файлы без ссылок удаляет python manage.py gc_media
+STORAGES = {
+    'default': {
+        'BACKEND': 'messenger_project.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
+CONTENT_STORAGE = {
+    'PREFIX': 'cas',
+    'SHARD_DEPTH': 2,
+    'SHARD_WIDTH': 2,
+    'GC_GRACE_HOURS': 24,
+}
+
+
+# Каталог заранее собранной схемы OpenAPI (messenger_project/openapi.py),
+# сборка: python manage.py build_openapi_schema
+OPENAPI_SCHEMA_DIR = BASE_DIR / 'openapi'
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -128,8 +281,37 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.TokenAuthentication',
 
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        # Кодирует datetime из values()-сериализации напрямую
+        'messenger_project.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        # Бинарный формат по заголовку Accept: application/msgpack
+        'messenger_project.renderers.MessagePackRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+        'messenger_project.parsers.MessagePackParser',
+    ],
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    # Лимиты для view с throttle_scope (messenger_project/throttling.py)
+    'DEFAULT_THROTTLE_CLASSES': [
+        'messenger_project.throttling.ScopedSlidingWindowThrottle',
+    ],
+    'DEFAULT_THROTTLE_RATES': {
+        'message_send': '30/min',
+        'message_like': '60/min',
+        'user_search': '30/min',
+    },
+}
 
+# Хранилище счётчиков ограничителя: 'memory' — в памяти процесса,
+# 'cache' — кеш CACHE_ALIAS, общий для нескольких процессов
+THROTTLING = {
+    'STORE': 'memory',
+    'CACHE_ALIAS': 'default',
+    'MAX_KEYS': 100000,
 }
 
 
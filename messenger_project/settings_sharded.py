@@ -0,0 +1,21 @@
+"""Шардирование сообщений локально: default и два шарда в файлах SQLite
+
+DJANGO_SETTINGS_MODULE=messenger_project.settings_sharded
+python manage.py migrate
+python manage.py migrate --database shard_1
+python manage.py migrate --database shard_2
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, DATABASES, MESSAGE_SHARDS
+
+SHARD_NAMES = ['shard_1', 'shard_2']
+
+DATABASES = {
+    **DATABASES,
+    **{
+        name: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / ('%s.sqlite3' % name)}
+        for name in SHARD_NAMES
+    },
+}
+
+MESSAGE_SHARDS = {**MESSAGE_SHARDS, 'SHARDS': SHARD_NAMES}
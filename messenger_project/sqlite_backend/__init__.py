@@ -0,0 +1,15 @@
+"""Бэкенд SQLite для продакшена: pragma при подключении и BEGIN IMMEDIATE
+
+ENGINE 'messenger_project.sqlite_backend' понимает в OPTIONS те же ключи,
+что django.db.backends.sqlite3 в Django 5.1, поэтому после обновления
+Django достаточно вернуть стандартный ENGINE:
+
+- init_command — SQL через «;», выполняется на каждом новом подключении
+  (PRAGMA journal_mode, synchronous, cache_size и т. д.);
+- transaction_mode — DEFERRED, IMMEDIATE или EXCLUSIVE для BEGIN в
+  transaction.atomic(). С IMMEDIATE транзакция сразу берёт блокировку
+  записи и ждёт её busy_timeout, а не получает «database is locked», когда
+  читающая транзакция пытается начать запись.
+
+Обслуживание базы — maintenance.py и python manage.py sqlite_maintenance.
+"""
@@ -0,0 +1,35 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """SQLite с init_command и transaction_mode в OPTIONS"""
+
+    def get_connection_params(self):
+        options = self.settings_dict['OPTIONS']
+        # sqlite3.connect() не знает этих ключей
+        self.init_command = options.get('init_command') or ''
+        transaction_mode = options.get('transaction_mode')
+        if transaction_mode is not None and transaction_mode.upper() not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(
+                'OPTIONS["transaction_mode"] должен быть одним из: %s' % ', '.join(TRANSACTION_MODES))
+        self.transaction_mode = transaction_mode.upper() if transaction_mode else None
+        params = super().get_connection_params()
+        params.pop('init_command', None)
+        params.pop('transaction_mode', None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for statement in self.init_command.split(';'):
+            if statement.strip():
+                conn.execute(statement)
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode is None:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute('BEGIN ' + self.transaction_mode)
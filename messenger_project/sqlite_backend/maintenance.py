@@ -0,0 +1,33 @@
+"""Периодическое обслуживание базы SQLite
+
+ANALYZE обновляет статистику, по которой планировщик выбирает индексы;
+PRAGMA optimize делает то же только для таблиц, где статистика устарела,
+и годится для частого запуска. wal_checkpoint переносит страницы из
+журнала WAL в файл базы: с режимом TRUNCATE файл -wal обрезается до нуля
+и не растёт, пока есть долгие читатели.
+"""
+from django.db import connections
+
+CHECKPOINT_MODES = ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE')
+
+
+def analyze(using='default', full=True):
+    """ANALYZE всей базы или, с full=False, PRAGMA optimize"""
+    with connections[using].cursor() as cursor:
+        cursor.execute('ANALYZE' if full else 'PRAGMA optimize')
+
+
+def checkpoint(using='default', mode='TRUNCATE'):
+    """Контрольная точка WAL; (занята ли база, страниц в журнале, перенесено страниц)"""
+    mode = mode.upper()
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError('Режим контрольной точки должен быть одним из: %s' % ', '.join(CHECKPOINT_MODES))
+    with connections[using].cursor() as cursor:
+        cursor.execute('PRAGMA wal_checkpoint(%s)' % mode)
+        return tuple(cursor.fetchone())
+
+
+def journal_mode(using='default'):
+    with connections[using].cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode')
+        return cursor.fetchone()[0]
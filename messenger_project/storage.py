@@ -0,0 +1,262 @@
+"""Хранилище медиа по хешу содержимого
+
+ContentAddressedStorage — FileSystemStorage, в котором имя файла задаёт
+не клиент, а SHA-256 содержимого: cas/ab/cd/abcd….png (каталоги — первые
+символы хеша, чтобы в одном каталоге не копились миллионы файлов).
+Одинаковые файлы — один и тот же аватар, пересланное вложение — хранятся
+один раз: повторное сохранение только считает хеш и ничего не пишет.
+Хеш всегда считается по самому сохраняемому содержимому, а не берётся у
+вызывающего: иначе под чужим хешем можно было бы сохранить другой файл.
+reference() берёт ссылку на уже сохранённый файл вовсе без содержимого. Расширение остаётся
+в имени, чтобы файл отдавался с правильным типом.
+
+Число ссылок на файл хранит StoredBlob: save() его увеличивает, delete()
+уменьшает, но файл не удаляет — его в этот же момент может сохранять
+кто-то ещё. Файлы без ссылок удаляет python manage.py gc_media: он
+пересчитывает ссылки по всем FileField моделей (Django не вызывает
+delete() при удалении или замене файла в модели) и удаляет то, на что
+никто не ссылается дольше GC_GRACE_HOURS.
+
+Файлы со старыми именами (avatars/...) читаются как обычно, а delete()
+удаляет их сразу, как FileSystemStorage.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, models, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+
+DEFAULTS = {
+    'PREFIX': 'cas',
+    'SHARD_DEPTH': 2,
+    'SHARD_WIDTH': 2,
+    'GC_GRACE_HOURS': 24,
+}
+
+# Каталог внутри хранилища для файлов, хеш которых ещё считается
+INCOMING_DIR = '.incoming'
+BLOCK_SIZE = 64 * 1024
+MAX_EXTENSION_LENGTH = 16
+
+
+def get_config():
+    """Настройки хранилища с подставленными значениями по умолчанию"""
+    return {**DEFAULTS, **getattr(settings, 'CONTENT_STORAGE', {})}
+
+
+def blob_name(sha256, extension=''):
+    """Имя файла по хешу: cas/ab/cd/abcd….ext"""
+    config = get_config()
+    width = config['SHARD_WIDTH']
+    shards = [sha256[index * width:(index + 1) * width] for index in range(config['SHARD_DEPTH'])]
+    return '/'.join([config['PREFIX'], *shards, sha256 + extension])
+
+
+def stored_name(sha256, filename):
+    """Имя, под которым файл filename с хешем sha256 лежит в хранилище"""
+    extension = os.path.splitext(filename)[1].lower()
+    return blob_name(sha256, extension if len(extension) <= MAX_EXTENSION_LENGTH else '')
+
+
+def file_sha256(path):
+    """SHA-256 файла, читая его блоками"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage с именами по хешу содержимого и дедупликацией"""
+
+    def is_blob(self, name):
+        return name.startswith(get_config()['PREFIX'] + '/')
+
+    def get_available_name(self, name, max_length=None):
+        # Имя всё равно заменит хеш в _save: проверять его занятость незачем
+        return name
+
+    def _spool(self, content):
+        """Пишет содержимое во временный файл, считая хеш; (путь, sha256)"""
+        incoming = self.path(INCOMING_DIR)
+        os.makedirs(incoming, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, path = tempfile.mkstemp(dir=incoming)
+        try:
+            with os.fdopen(fd, 'wb') as spooled:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks(BLOCK_SIZE):
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    spooled.write(chunk)
+                    digest.update(chunk)
+        except BaseException:
+            _remove(path)
+            raise
+        return path, digest.hexdigest()
+
+    def _save(self, name, content):
+        # Как FileSystemStorage, готовый временный файл перемещаем, а не копируем
+        source = content.temporary_file_path() if hasattr(content, 'temporary_file_path') else None
+        spooled = None
+        try:
+            if source is None:
+                spooled, sha256 = self._spool(content)
+            else:
+                sha256 = file_sha256(source)
+
+            name = stored_name(sha256, name)
+            path = self.path(name)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Одновременное сохранение того же содержимого перезапишет файл тем же
+                file_move_safe(spooled or source, path, allow_overwrite=True)
+                spooled = source = None
+                if self.file_permissions_mode is not None:
+                    os.chmod(path, self.file_permissions_mode)
+        finally:
+            # Файл уже есть: временная копия не нужна
+            for leftover in (spooled, source):
+                if leftover is not None:
+                    _remove(leftover)
+        self._reference(name, os.path.getsize(path))
+        return name
+
+    def _reference(self, name, size):
+        from messenger.models import StoredBlob
+
+        now = timezone.now()
+        blobs = StoredBlob.objects.filter(name=name)
+        if blobs.update(refcount=F('refcount') + 1, referenced_at=now):
+            return
+        try:
+            with transaction.atomic():
+                StoredBlob.objects.create(name=name, size=size, refcount=1, referenced_at=now)
+        except IntegrityError:
+            # Строку успел создать параллельный save того же содержимого
+            blobs.update(refcount=F('refcount') + 1, referenced_at=now)
+
+    def reference(self, name):
+        """Ещё одна ссылка на уже сохранённый файл name; False, если его нет
+
+        Так файл с известным хешем прикрепляется без повторной загрузки.
+        """
+        if not self.exists(name):
+            return False
+        self._reference(name, self.size(name))
+        # gc_media мог удалить файл между проверкой и ссылкой: после ссылки
+        # referenced_at свежий, и следующий сбор его уже не тронет
+        if not self.exists(name):
+            self.delete(name)
+            return False
+        return True
+
+    def delete(self, name):
+        if not self.is_blob(name):
+            return super().delete(name)
+        from messenger.models import StoredBlob
+
+        # Файл удалит gc_media, когда на него не останется ссылок
+        StoredBlob.objects.filter(name=name, refcount__gt=0).update(refcount=F('refcount') - 1)
+
+
+def databases_for(model):
+    """Базы, в которых лежат строки модели: вложения бывают и в шардах"""
+    from messenger import sharding
+
+    return sharding.message_databases() if sharding.is_sharded(model) else [DEFAULT_DB_ALIAS]
+
+
+def referenced_names(storage):
+    """Counter имён файлов хранилища по всем FileField всех моделей"""
+    prefix = get_config()['PREFIX'] + '/'
+    names = Counter()
+    for model in apps.get_models():
+        for field in model._meta.concrete_fields:
+            if not isinstance(field, models.FileField):
+                continue
+            if getattr(field.storage, 'location', None) != storage.location:
+                continue
+            for db in databases_for(model):
+                names.update(
+                    model._default_manager.using(db).filter(**{field.attname + '__startswith': prefix})
+                    .values_list(field.attname, flat=True).iterator()
+                )
+    return names
+
+
+def collect_garbage(storage, grace_hours=None, dry_run=False):
+    """Пересчитывает ссылки и удаляет файлы без ссылок; возвращает статистику
+
+    Удаляются файлы StoredBlob без ссылок, сохранённые раньше grace_hours
+    часов назад, и файлы без строки StoredBlob (остались после отката
+    транзакции или сбоя) старше того же срока.
+    """
+    from messenger.models import StoredBlob
+
+    grace_hours = grace_hours if grace_hours is not None else get_config()['GC_GRACE_HOURS']
+    cutoff = timezone.now() - timedelta(hours=grace_hours)
+    result = {'recounted': 0, 'deleted': 0, 'orphans': 0, 'freed_bytes': 0}
+
+    references = referenced_names(storage)
+    known = dict(StoredBlob.objects.values_list('name', 'refcount'))
+    for name, refcount in known.items():
+        if references.get(name, 0) != refcount:
+            result['recounted'] += 1
+            if not dry_run:
+                StoredBlob.objects.filter(name=name).update(refcount=references.get(name, 0))
+    for name in references.keys() - known.keys():
+        # Ссылка на файл без строки: восстанавливаем строку, если файл на месте
+        if storage.exists(name):
+            result['recounted'] += 1
+            if not dry_run:
+                StoredBlob.objects.get_or_create(
+                    name=name, defaults={'size': storage.size(name), 'refcount': references[name]})
+
+    garbage = [
+        (name, size)
+        for name, size in StoredBlob.objects.filter(refcount=0, referenced_at__lt=cutoff).values_list('name', 'size')
+        if not references.get(name)
+    ]
+    for name, size in garbage:
+        result['deleted'] += 1
+        result['freed_bytes'] += size
+        if not dry_run:
+            # Условие повторяет выборку: файл, сохранённый после неё, остаётся
+            if StoredBlob.objects.filter(name=name, refcount=0, referenced_at__lt=cutoff).delete()[0]:
+                _remove(storage.path(name))
+
+    cutoff_timestamp = time.time() - grace_hours * 3600
+    tracked = set(known) | set(references)
+    for directory in (get_config()['PREFIX'], INCOMING_DIR):
+        for root, _, files in os.walk(storage.path(directory)):
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, storage.location).replace(os.sep, '/')
+                if name in tracked or os.path.getmtime(path) >= cutoff_timestamp:
+                    continue
+                result['orphans'] += 1
+                result['freed_bytes'] += os.path.getsize(path)
+                if not dry_run and not StoredBlob.objects.filter(name=name).exists():
+                    _remove(path)
+    return result
@@ -0,0 +1,182 @@
+"""Ограничение частоты запросов скользящим окном
+
+ScopedSlidingWindowThrottle — замена ScopedRateThrottle из DRF: лимит
+задаётся для view атрибутом throttle_scope и берётся из
+REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'] ('30/min'), ключ — пользователь
+(для анонимов IP) и scope.
+
+Вместо списка отметок времени в кеше, как у DRF, хранятся только два
+счётчика на ключ: текущего и предыдущего окна. Оценка числа запросов за
+последние window секунд — текущий счётчик плюс доля предыдущего, которая
+ещё попадает в окно. Проверка — O(1) по времени и памяти.
+
+Хранилище задаётся настройкой THROTTLING: 'memory' — словарь в памяти
+процесса с вытеснением давно не встречавшихся ключей (по умолчанию), или
+'cache' — кеш Django, общий для нескольких процессов.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+DEFAULTS = {
+    'STORE': 'memory',
+    'CACHE_ALIAS': 'default',
+    'MAX_KEYS': 100000,
+}
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_config():
+    """Настройки ограничителя с подставленными значениями по умолчанию"""
+    return {**DEFAULTS, **getattr(settings, 'THROTTLING', {})}
+
+
+def parse_rate(rate):
+    """'30/min' -> (30, 60); None -> (None, None), как в DRF"""
+    if rate is None:
+        return None, None
+    num, period = rate.split('/')
+    return int(num), PERIODS[period[0]]
+
+
+def estimate(current, previous, elapsed, window):
+    """Оценка числа запросов за последние window секунд"""
+    return current + previous * (window - elapsed) / window
+
+
+def retry_after(current, previous, elapsed, window, limit):
+    """Через сколько секунд оценка опустится ниже limit"""
+    if limit < 1:
+        return window
+    if current < limit:
+        # Хватит того, что доля предыдущего окна уйдёт из оценки, но не
+        # дольше конца окна: тогда текущий счётчик станет предыдущим
+        wait = (estimate(current, previous, elapsed, window) - limit + 1) * window / previous
+        return min(wait, window - elapsed)
+    # Ждём конца текущего окна, затем пока его счётчик не «состарится»
+    return (window - elapsed) + window * (1 - (limit - 1) / current)
+
+
+class MemoryStore:
+    """Счётчики окон в памяти процесса, не больше max_keys ключей
+
+    Ключи упорядочены по последнему обращению; при переполнении
+    вытесняются самые старые — это пользователи, которые давно не
+    отправляли запросов, и их окна всё равно уже истекли.
+    """
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.counters = OrderedDict()
+        self.lock = threading.Lock()
+
+    def hit(self, key, limit, window, now):
+        """Учитывает запрос; возвращает None или сколько секунд ждать"""
+        index, elapsed = divmod(now, window)
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None or counter[0] < index - 1:
+                counter = [index, 0, 0]
+            elif counter[0] == index - 1:
+                counter = [index, 0, counter[1]]
+            self.counters[key] = counter
+            self.counters.move_to_end(key)
+            if len(self.counters) > self.max_keys:
+                self.counters.popitem(last=False)
+
+            _, current, previous = counter
+            if estimate(current, previous, elapsed, window) + 1 > limit:
+                return retry_after(current, previous, elapsed, window, limit)
+            counter[1] += 1
+        return None
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+
+
+class CacheStore:
+    """Счётчики окон в кеше Django: ключ на окно, живёт два окна"""
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def hit(self, key, limit, window, now):
+        index, elapsed = divmod(now, window)
+        current_key = 'throttle:%s:%d' % (key, index)
+        previous_key = 'throttle:%s:%d' % (key, index - 1)
+        values = self.cache.get_many([current_key, previous_key])
+        current = values.get(current_key, 0)
+        previous = values.get(previous_key, 0)
+        if estimate(current, previous, elapsed, window) + 1 > limit:
+            return retry_after(current, previous, elapsed, window, limit)
+        # add не перезапишет счётчик, созданный другим процессом
+        self.cache.add(current_key, 0, timeout=int(window * 2) + 1)
+        try:
+            self.cache.incr(current_key)
+        except ValueError:
+            # Ключ успели вытеснить между add и incr
+            self.cache.set(current_key, 1, timeout=int(window * 2) + 1)
+        return None
+
+
+def get_store():
+    """Хранилище по настройке THROTTLING, одно на процесс"""
+    config = get_config()
+    key = (config['STORE'], config['CACHE_ALIAS'], config['MAX_KEYS'])
+    store = _stores.get(key)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(key)
+            if store is None:
+                if config['STORE'] == 'memory':
+                    store = MemoryStore(config['MAX_KEYS'])
+                elif config['STORE'] == 'cache':
+                    store = CacheStore(config['CACHE_ALIAS'])
+                else:
+                    raise ImproperlyConfigured('Неизвестное хранилище THROTTLING: %s' % config['STORE'])
+                _stores[key] = store
+    return store
+
+
+def reset():
+    """Сбрасывает счётчики в памяти процесса (для тестов)"""
+    with _stores_lock:
+        for store in _stores.values():
+            if isinstance(store, MemoryStore):
+                store.clear()
+
+
+class ScopedSlidingWindowThrottle(BaseThrottle):
+    """Лимит на пользователя и throttle_scope view скользящим окном"""
+    scope_attr = 'throttle_scope'
+    timer = time.time
+
+    def __init__(self):
+        self.wait_seconds = None
+
+    def allow_request(self, request, view):
+        scope = getattr(view, self.scope_attr, None)
+        if not scope:
+            return True
+        limit, window = parse_rate(api_settings.DEFAULT_THROTTLE_RATES.get(scope))
+        if limit is None:
+            return True
+
+        user = request.user
+        ident = user.pk if user and user.is_authenticated else 'ip:%s' % self.get_ident(request)
+        self.wait_seconds = get_store().hit('%s:%s' % (scope, ident), limit, window, self.timer())
+        return self.wait_seconds is None
+
+    def wait(self):
+        return self.wait_seconds
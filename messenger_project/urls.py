@@ -2,35 +2,25 @@ from django.contrib import admin
 from django.conf import settings
 from django.conf.urls.static import static
 from django.urls import path, include
-from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
+from messenger_project import openapi
 from users.views import (
     UserRegistrationAPIView, UserLoginAPIView, UserSearchAPIView,
     UserProfileAPIView
 )
 from messenger.views import (
-    MessageCreateAPIView, MessageLikeAPIView, ChatJoinAPIView, ChatSearchAPIView, ChatListCreateAPIView,
-    ChatRetrieveUpdateAPIView
-)
-from rest_framework import permissions
-from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
-
-schema_view = get_schema_view(
-   openapi.Info(
-      title="Messenger API",
-      default_version='v1',
-      description="Документация для API чата",
-   ),
-   public=True,
-   permission_classes=[permissions.AllowAny,],
+    MessageCreateAPIView, MessageLikeAPIView, ScheduledMessageListCreateAPIView, ScheduledMessageCancelAPIView, ChatJoinAPIView, ChatSearchAPIView, ChatListCreateAPIView,
+    ChatRetrieveUpdateAPIView, ChatMessagesAPIView, SyncAPIView,
+    ChatParticipantsAPIView, ChatParticipantsAddAPIView, ChatParticipantsRemoveAPIView, ChatInboxSettingsAPIView,
+    UploadStartAPIView, UploadChunkAPIView, UploadFinalizeAPIView
 )
 
 urlpatterns = [
     path('admin/', admin.site.urls),
 
-    path('swagger/docs/', SpectacularAPIView.as_view(), name='schema'),
-    path('swagger/', SpectacularSwaggerView.as_view(url_name='schema'), name='docs'),
-    path('api/schema/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
+    # Схема собирается заранее: python manage.py build_openapi_schema
+    path('swagger/docs/', openapi.schema_view, name='schema'),
+    path('swagger/', openapi.swagger_view, name='docs'),
+    path('api/schema/redoc/', openapi.redoc_view, name='redoc'),
 
     # Аутентификация и профиль
     path('api/v1/login/', UserLoginAPIView.as_view(), name='login'),
@@ -43,13 +33,32 @@ urlpatterns = [
     # Чаты
     path('api/v1/chats/', ChatListCreateAPIView.as_view(), name='chat-list-create'),  # GET и POST
     path('api/v1/chats/<int:pk>/', ChatRetrieveUpdateAPIView.as_view(), name='chat-detail-update'),  # GET, PUT/PATCH
+    path('api/v1/chats/<int:pk>/messages/', ChatMessagesAPIView.as_view(), name='chat-messages'),  # GET
+    path('api/v1/chats/<int:pk>/participants/', ChatParticipantsAPIView.as_view(), name='chat-participants'),
+    path('api/v1/chats/<int:pk>/participants/add/', ChatParticipantsAddAPIView.as_view(),
+         name='chat-participants-add'),  # POST
+    path('api/v1/chats/<int:pk>/participants/remove/', ChatParticipantsRemoveAPIView.as_view(),
+         name='chat-participants-remove'),  # POST
+    path('api/v1/chats/<int:pk>/settings/', ChatInboxSettingsAPIView.as_view(), name='chat-settings'),  # PATCH
     path('api/v1/chats/<int:chat_id>/join/', ChatJoinAPIView.as_view(), name='chat-join'),
     path('api/v1/chats/search/', ChatSearchAPIView.as_view(), name='chat-search'),
 
     # Сообщения
     path('api/v1/messages/', MessageCreateAPIView.as_view(), name='message-send'),  # POST
+    path('api/v1/messages/scheduled/', ScheduledMessageListCreateAPIView.as_view(),
+         name='scheduled-messages'),  # GET и POST
+    path('api/v1/messages/scheduled/<int:pk>/', ScheduledMessageCancelAPIView.as_view(),
+         name='scheduled-message-cancel'),  # DELETE
     path('api/v1/messages/<int:message_id>/like/', MessageLikeAPIView.as_view(), name='message-like'),
 
+    # Вложения: загрузка по частям
+    path('api/v1/uploads/', UploadStartAPIView.as_view(), name='upload-start'),  # POST
+    path('api/v1/uploads/<uuid:pk>/', UploadChunkAPIView.as_view(), name='upload-chunk'),  # GET/HEAD, PUT
+    path('api/v1/uploads/<uuid:pk>/finalize/', UploadFinalizeAPIView.as_view(), name='upload-finalize'),  # POST
+
+    # Дельта-синхронизация
+    path('api/v1/sync/', SyncAPIView.as_view(), name='sync'),  # GET ?since=<seq>
+
 
 ]
 
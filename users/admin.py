@@ -1,3 +1,42 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.db.models import Q
 
-# Register your models here.
+from messenger import purge
+from messenger.admin_scaling import LargeTableAdmin, prefix_q
+from messenger.models import PurgeJob
+from .models import CustomUser
+
+
+@admin.register(CustomUser)
+class CustomUserAdmin(LargeTableAdmin):
+    list_display = ('id', 'phone_number', 'first_name', 'last_name', 'is_staff', 'last_seen')
+    list_filter = ('is_staff', 'is_active')
+    exclude = ('password',)
+    readonly_fields = ('last_login', 'last_seen')
+    filter_horizontal = ('groups', 'user_permissions')
+    # Поиск нужен и автодополнению участников в ChatAdmin/MessageAdmin
+    search_fields = ('phone_number',)
+    search_help_text = 'ID или начало номера телефона'
+    actions = ['purge_selected']
+
+    def has_delete_permission(self, request, obj=None):
+        # Каскад загрузил бы все сообщения и лайки пользователя; удаляем пачками
+        return False
+
+    def has_purge_permission(self, request):
+        return request.user.has_perm('users.delete_customuser')
+
+    @admin.action(description='Удалить пачками в фоне', permissions=['purge'])
+    def purge_selected(self, request, queryset):
+        for user_id in queryset.values_list('pk', flat=True):
+            purge.schedule(PurgeJob.KIND_USER, user_id)
+        self.message_user(request, 'Пользователи поставлены в очередь на удаление', messages.SUCCESS)
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        query = prefix_q('phone_number', term)
+        if term.isdigit():
+            query |= Q(pk=int(term))
+        return queryset.filter(query), False
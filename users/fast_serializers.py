@@ -0,0 +1,77 @@
+"""Быстрая read-only сериализация пользователей через values_list
+
+Даёт тот же результат, что UserSerializer, но без ModelSerializer на
+каждый объект: строки берутся кортежами и раскладываются в словари
+заранее собранным RowMapper.
+"""
+from .models import CustomUser
+
+USER_FIELDS = (
+    'id',
+    'phone_number',
+    'first_name',
+    'last_name',
+    'avatar',
+    'date_of_birth',
+)
+
+# Столько значений уходит в один запрос с id__in (лимит переменных SQLite)
+IN_CHUNK_SIZE = 900
+
+
+def chunked(values, size=IN_CHUNK_SIZE):
+    """Разбивает значения на списки для запросов с __in"""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class RowMapper:
+    """Заранее собранное отображение кортежа values_list в словарь ответа"""
+
+    def __init__(self, fields, converters=None):
+        self.fields = tuple(fields)
+        self.converters = [
+            (self.fields.index(name), name, convert)
+            for name, convert in (converters or {}).items()
+        ]
+
+    def __call__(self, row):
+        item = dict(zip(self.fields, row))
+        for index, name, convert in self.converters:
+            item[name] = convert(row[index])
+        return item
+
+
+def avatar_url_getter(request=None, absolute=True):
+    """URL аватара по имени файла, как его отдаёт ImageField в DRF"""
+    storage = CustomUser._meta.get_field('avatar').storage
+    build_absolute_uri = request.build_absolute_uri if absolute and request is not None else None
+
+    def avatar_url(name):
+        if not name:
+            return None
+        url = storage.url(name)
+        return build_absolute_uri(url) if build_absolute_uri else url
+
+    return avatar_url
+
+
+def user_mapper(request=None):
+    return RowMapper(USER_FIELDS, {'avatar': avatar_url_getter(request)})
+
+
+def serialize_users(queryset, request=None):
+    """Список пользователей в формате UserSerializer"""
+    mapper = user_mapper(request)
+    return [mapper(row) for row in queryset.values_list(*USER_FIELDS)]
+
+
+def users_by_id(user_ids, request=None):
+    """Словарь {id: пользователь в формате UserSerializer} для набора id"""
+    mapper = user_mapper(request)
+    users = {}
+    for chunk in chunked(user_ids):
+        for row in CustomUser.objects.filter(id__in=chunk).values_list(*USER_FIELDS):
+            users[row[0]] = mapper(row)
+    return users
@@ -1,6 +1,10 @@
 from django.contrib.auth.password_validation import validate_password
+from django.db import transaction
 from rest_framework import serializers
+from messenger import changelog
+from messenger.models import ChangeLogEntry
 from .models import CustomUser
+from .tasks import process_avatar
 
 
 class UserProfileUpdateSerializer(serializers.ModelSerializer):
@@ -28,6 +32,15 @@ class UserProfileUpdateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError('Этот номер телефона уже занят')
         return value
 
+    def update(self, instance, validated_data):
+        with transaction.atomic():
+            user = super().update(instance, validated_data)
+            if 'avatar' in validated_data and user.avatar:
+                process_avatar.enqueue(user_id=user.id, name=user.avatar.name)
+            # Собеседники получат новый профиль через /api/v1/sync/
+            changelog.record(ChangeLogEntry.KIND_PROFILE, user_id=user.id, **UserSerializer(user).data)
+        return user
+
 
 class UserSerializer(serializers.ModelSerializer):
     """Сериализатор для основных данных пользователя"""
@@ -0,0 +1,35 @@
+"""Фоновые задачи пользователей, см. messenger/task_queue.py"""
+import io
+
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+from messenger.task_queue import task
+from .models import CustomUser
+
+# Аватары больше этого размера уменьшаются
+AVATAR_MAX_SIZE = (512, 512)
+
+
+@task('users.process_avatar', priority=-1)
+def process_avatar(user_id, name):
+    """Уменьшает загруженный аватар и убирает EXIF-поворот"""
+    user = CustomUser.objects.filter(id=user_id, avatar=name).first()
+    if user is None:
+        # Аватар успели заменить, обработается своей задачей
+        return
+    with user.avatar.open('rb') as source:
+        image = Image.open(source)
+        image.load()
+    if image.width <= AVATAR_MAX_SIZE[0] and image.height <= AVATAR_MAX_SIZE[1]:
+        return
+    image_format = image.format or 'PNG'
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail(AVATAR_MAX_SIZE)
+    output = io.BytesIO()
+    image.save(output, format=image_format)
+
+    storage = user.avatar.storage
+    storage.delete(name)
+    saved = storage.save(name, ContentFile(output.getvalue()))
+    CustomUser.objects.filter(id=user_id, avatar=name).update(avatar=saved)
@@ -1,7 +1,15 @@
+import io
+import json
+import tempfile
+
 from rest_framework.test import APITestCase
 from rest_framework import status
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.urls import reverse
+from PIL import Image
+from messenger import task_queue
 from messenger.models import CustomUser
+from messenger_project.msgpack_codec import unpackb
 
 
 class UserProfileAPITest(APITestCase):
@@ -41,6 +49,19 @@ class UserProfileAPITest(APITestCase):
         self.user.refresh_from_db()
         self.assertEqual(self.user.first_name, 'Adilet')
 
+    def test_large_avatar_is_downscaled_in_background(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (1200, 800), 'red').save(buffer, format='PNG')
+        upload = SimpleUploadedFile('avatar.png', buffer.getvalue(), content_type='image/png')
+        with tempfile.TemporaryDirectory() as media_root, self.settings(MEDIA_ROOT=media_root):
+            response = self.client.patch(self.url, {'avatar': upload}, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(task_queue.run_pending(), 1)
+
+            self.user.refresh_from_db()
+            with self.user.avatar.open('rb') as stored:
+                self.assertEqual(Image.open(stored).size, (512, 341))
+
 
 class AuthTests(APITestCase):
     def setUp(self):
@@ -110,6 +131,13 @@ class UserSearchAPITest(APITestCase):
         self.assertEqual(len(response.data), 1)
         self.assertEqual(response.data[0]['first_name'], 'Adilet')
 
+    def test_search_msgpack_matches_json(self):
+        url = reverse('user-search')
+        json_response = self.client.get(url, {'search': 'a'}, HTTP_ACCEPT='application/json')
+        msgpack_response = self.client.get(url, {'search': 'a'}, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(msgpack_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(unpackb(msgpack_response.content), json.loads(json_response.content))
+
     def test_search_excludes_current_user(self):
         url = reverse('user-search')
         response = self.client.get(url, {'search': '123'})
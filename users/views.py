@@ -6,6 +6,7 @@ from rest_framework import generics
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.authtoken.models import Token
 from .models import CustomUser
+from .fast_serializers import serialize_users
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
 
 from .serializers import (
@@ -76,6 +77,7 @@ class UserRegistrationAPIView(APIView):
 class UserLoginAPIView(APIView):
     """Вход пользователя"""
     permission_classes = [AllowAny]
+    admission_class = 'critical'
 
     def post(self, request):
         serializer = UserLoginSerializer(data=request.data)
@@ -115,6 +117,8 @@ class UserSearchAPIView(generics.ListAPIView):
     """Поиск пользователей по номеру телефона"""
     serializer_class = UserSerializer
     permission_classes = [IsAuthenticated]
+    throttle_scope = 'user_search'
+    admission_class = 'bulk'
 
     def get_queryset(self):
         """Фильтрация пользователей по запросу"""
@@ -127,7 +131,11 @@ class UserSearchAPIView(generics.ListAPIView):
         queryset = CustomUser.objects.filter(
             Q(phone_number__icontains=search_query) |
             Q(first_name__icontains=search_query)
-        ).exclude(id=user.id)
+        ).exclude(id=user.id).order_by('id')
 
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        # Формат UserSerializer, собранный через values_list
+        return Response(serialize_users(self.get_queryset(), request))
+